@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'publications.middleware.TreeMetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -81,6 +82,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+    },
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -129,3 +140,57 @@ STATIC_ROOT = Path(BASE_DIR).joinpath('staticfiles').resolve()
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Django REST framework
+# TreeJSONRenderer использует orjson, если он установлен
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'publications.renderers.TreeJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+
+# Comments tree
+# Настройки приложения publications, значения по умолчанию см. в publications/conf.py
+
+COMMENTS_TREE = {
+    'VOTE_BUFFER': False,
+    'VOTE_FLUSH_INTERVAL': 1.0,
+    'VOTE_MAX_PENDING': 1000,
+    'RERANK_INTERVAL': None,
+    'RERANK_BATCH_SIZE': 500,
+    'RERANK_MAX_PENDING': 1000,
+    # Кэш деревьев требует общего для всех процессов кэша TREE_CACHE_ALIAS, а здесь используется LocMemCache.
+    'TREE_CACHE': False,
+    'TREE_CACHE_ALIAS': 'default',
+    'TREE_CACHE_TIMEOUT': 300,
+    'STREAM_CHUNK_SIZE': 65536,
+    'STREAM_BATCH_SIZE': 2000,
+    'METRICS': False,
+    'IMPORT_BATCH_SIZE': 1000,
+    'SCORERS': {},
+    'COLLAPSE_MIN_RATING': -5,
+    'COLLAPSE_DEPTH': 8,
+    'SYNC_LAG': 5,
+    'SYNC_RETENTION': 86400,
+    'LIVE_BROKER': 'publications.live.LocalBroker',
+    'LIVE_SOCKET_DIR': None,
+    'LIVE_COALESCE_INTERVAL': 0.1,
+    'LIVE_HEARTBEAT': 15,
+    'LIVE_MAX_PENDING': 1000,
+    'ASYNC_WORKERS': 4,
+    'TOMBSTONE_RETENTION': 86400,
+    'COMPACT_BATCH_SIZE': 500,
+    'PERMALINK_DEPTH': 5,
+    # Базы данных, по которым распределяются деревья комментариев, например ('default', 'comments_1', 'comments_2').
+    'SHARDS': None,
+    # Бэкенд полнотекстового поиска по комментариям: SQLiteSearchBackend (FTS5) или PostgreSQLSearchBackend.
+    'SEARCH_BACKEND': 'publications.search.SQLiteSearchBackend',
+    # Количество результатов поиска по умолчанию.
+    'SEARCH_LIMIT': 20,
+    # Количество лучших комментариев первого уровня у каждого поста в ленте.
+    'FEED_TOP_COMMENTS': 3,
+}
@@ -0,0 +1,23 @@
+"""
+Настройки тестов: базы данных шардов комментариев и маршрутизатор, с которыми тесты шардирования
+включают `COMMENTS_TREE['SHARDS']` через `override_settings`, и приложение `usage.tests` с моделями
+тестов и бенчмарков (ThreadComment со списком смежности), у которого нет миграций.
+"""
+from .settings import *  # noqa: F401, F403
+from .settings import BASE_DIR, DATABASES, INSTALLED_APPS
+
+INSTALLED_APPS = [*INSTALLED_APPS, 'usage.tests']
+
+DATABASES = {
+    **DATABASES,
+    'comments_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'comments_1.sqlite3',
+    },
+    'comments_2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'comments_2.sqlite3',
+    },
+}
+
+DATABASE_ROUTERS = ['publications.sharding.CommentShardRouter']
@@ -0,0 +1,151 @@
+import operator
+from collections import defaultdict
+from functools import reduce
+
+from django.db.models import Case, Count, F, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .sync import revision_clock
+
+# Количество предков, обновляемых одним запросом с CASE.
+UPDATE_BATCH_SIZE = 250
+
+AGGREGATE_FIELDS = ('descendant_count', 'max_subtree_rating', 'last_activity')
+
+
+def get_ancestor_paths(model_class, path):
+    """Возвращает пути всех предков узла, от корня к родителю."""
+    return [path[:end] for end in range(model_class.steplen, len(path), model_class.steplen)]
+
+
+def compute_aggregates(rows, steplen):
+    """
+    Вычисляет агрегаты поддеревьев в памяти за один проход от листьев к корням.
+
+    ## Args:
+    - rows (iterable): Тройки (path, rating, created_at) всех узлов одного поста.
+    - steplen (int): Длина шага пути.
+
+    ## Returns:
+    - dict: {path: (descendant_count, max_subtree_rating, last_activity)}.
+    """
+    rows = sorted(rows, reverse=True)
+    aggregates = {path: [0, None, created_at] for path, _, created_at in rows}
+    for path, rating, _ in rows:
+        parent = aggregates.get(path[:-steplen])
+        if parent is None:
+            continue
+        count, max_rating, last_activity = aggregates[path]
+        parent[0] += count + 1
+        parent[1] = max(value for value in (parent[1], max_rating, rating) if value is not None)
+        parent[2] = max(parent[2], last_activity)
+    return {path: tuple(values) for path, values in aggregates.items()}
+
+
+def get_descendants_subquery(model_class, aggregate):
+    """Коррелированный подзапрос, вычисляющий агрегат по всем потомкам узла из внешнего запроса."""
+    descendants = model_class.objects.filter(
+        post_id=OuterRef('post_id'), path__startswith=OuterRef('path'), depth__gt=OuterRef('depth'),
+    ).order_by().values('post_id')
+    return Subquery(descendants.annotate(value=aggregate).values('value'))
+
+
+def get_refreshed_values(model_class, fields=AGGREGATE_FIELDS):
+    """Возвращает выражения для UPDATE, пересчитывающие агрегаты узла по его текущим потомкам."""
+    values = {
+        'descendant_count': Coalesce(get_descendants_subquery(model_class, Count('pk')), 0),
+        'max_subtree_rating': get_descendants_subquery(model_class, Max('rating')),
+        'last_activity': Greatest(
+            F('created_at'), Coalesce(get_descendants_subquery(model_class, Max('created_at')), F('created_at')),
+        ),
+    }
+    return {name: values[name] for name in fields}
+
+
+def refresh_aggregates(model_class, post_id, paths):
+    """
+    Пересчитывает агрегаты узлов с указанными путями одним запросом UPDATE.
+    Используется там, где инкрементальное обновление невозможно, например после удаления веток.
+    """
+    if paths:
+        model_class.objects.filter(post_id=post_id, path__in=paths).update(
+            revision=revision_clock.next(), **get_refreshed_values(model_class),
+        )
+
+
+def register_insert(node):
+    """
+    Учитывает новый узел в агрегатах его предков одним запросом UPDATE. Сам узел уже вставлен
+    с `last_activity`, равным времени создания, поэтому у комментария первого уровня запросов нет.
+    """
+    model_class = node.__class__
+    ancestors = get_ancestor_paths(model_class, node.path)
+    if not ancestors:
+        return
+    rating = Value(node.rating)
+    model_class.objects.filter(post_id=node.post_id, path__in=ancestors).update(
+        descendant_count=F('descendant_count') + 1,
+        max_subtree_rating=Greatest(Coalesce(F('max_subtree_rating'), rating), rating),
+        last_activity=Value(node.created_at),
+        revision=Value(node.revision),
+    )
+
+
+def register_votes(model_class, deltas):
+    """
+    Обновляет `max_subtree_rating` предков комментариев, рейтинг которых изменился.
+    Рост рейтинга учитывается инкрементально, а при снижении пересчитываются только предки,
+    у которых максимум совпадал с прежним рейтингом комментария.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - deltas (dict): Словарь {pk комментария: изменение рейтинга}, уже примененный к базе данных.
+    """
+    raised = {}
+    lowered = defaultdict(set)
+    rows = model_class.objects.filter(pk__in=[pk for pk, delta in deltas.items() if delta], depth__gt=1)
+    for pk, post_id, path, rating in rows.values_list('pk', 'post_id', 'path', 'rating'):
+        delta = deltas[pk]
+        for ancestor in get_ancestor_paths(model_class, path):
+            key = (post_id, ancestor)
+            if delta > 0:
+                raised[key] = max(raised.get(key, rating), rating)
+            else:
+                lowered[key].add(rating - delta)
+
+    revision = revision_clock.next()
+    raised = list(raised.items())
+    for start in range(0, len(raised), UPDATE_BATCH_SIZE):
+        batch = raised[start:start + UPDATE_BATCH_SIZE]
+        model_class.objects.filter(
+            reduce(operator.or_, (Q(post_id=post_id, path=path) for (post_id, path), _ in batch)),
+        ).update(revision=revision, max_subtree_rating=Case(
+            *(
+                When(post_id=post_id, path=path, then=Greatest(Coalesce(F('max_subtree_rating'), Value(value)), Value(value)))
+                for (post_id, path), value in batch
+            ),
+        ))
+
+    lowered = list(lowered.items())
+    for start in range(0, len(lowered), UPDATE_BATCH_SIZE):
+        batch = lowered[start:start + UPDATE_BATCH_SIZE]
+        model_class.objects.filter(
+            reduce(operator.or_, (
+                Q(post_id=post_id, path=path, max_subtree_rating__in=ratings) for (post_id, path), ratings in batch
+            )),
+        ).update(revision=revision, **get_refreshed_values(model_class, ('max_subtree_rating',)))
+
+
+def rebuild_aggregates(model_class, post_id):
+    """Пересчитывает агрегаты всего дерева поста в памяти и записывает изменившиеся значения."""
+    nodes = list(model_class.objects.filter(post_id=post_id).only('path', 'rating', 'created_at', 'revision', *AGGREGATE_FIELDS))
+    aggregates = compute_aggregates(((node.path, node.rating, node.created_at) for node in nodes), model_class.steplen)
+    revision = revision_clock.next()
+    changed = []
+    for node in nodes:
+        values = aggregates[node.path]
+        if values != (node.descendant_count, node.max_subtree_rating, node.last_activity):
+            node.descendant_count, node.max_subtree_rating, node.last_activity = values
+            node.revision = revision
+            changed.append(node)
+    model_class.objects.bulk_update(changed, [*AGGREGATE_FIELDS, 'revision'], batch_size=UPDATE_BATCH_SIZE)
@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
+from asgiref.sync import sync_to_async
+
+from .conf import get_setting
+
+
+@cache
+def load_executor(max_workers):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='comments-tree')
+
+
+def get_executor():
+    """Возвращает пул потоков для сборки и сериализации деревьев размером `COMMENTS_TREE['ASYNC_WORKERS']`."""
+    return load_executor(get_setting('ASYNC_WORKERS'))
+
+
+async def run_in_pool(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию в ограниченном пуле потоков, не блокируя цикл событий.
+    Предназначена для работы процессора (сборка дерева, сортировка, сериализация, рендеринг JSON)
+    над уже загруженными узлами: потоки пула не обращаются к базе данных, поэтому их число
+    не влияет на количество соединений. Контекст (метрики запроса) передается в поток.
+    """
+    return await sync_to_async(func, thread_sensitive=False, executor=get_executor())(*args, **kwargs)
+
+
+async def aload_nodes(queryset):
+    """Загружает узлы через асинхронный ORM Django."""
+    return [node async for node in queryset]
+
+
+async def aiter_in_thread(iterator):
+    """
+    Отдает элементы синхронного итератора в асинхронный код, вычисляя каждый элемент в потоке запроса.
+    Используется для потоковой выдачи: серверный курсор базы данных остается в одном потоке.
+    """
+    iterator = iter(iterator)
+    done = object()
+    while (item := await sync_to_async(next)(iterator, done)) is not done:
+        yield item
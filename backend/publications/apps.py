@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CommentsTreeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'publications'
+
+    def ready(self):
+        from . import checks  # noqa: F401
+        from .sharding import connect_post_deletion
+
+        connect_post_deletion()
@@ -0,0 +1,239 @@
+import time
+
+from django.core.cache import caches
+
+from .conf import get_setting
+from .storage import get_tree_storage
+
+
+class TreeCache:
+    """
+    Кэш сериализованных деревьев комментариев на базе кэш-фреймворка Django.
+
+    Для каждого поста хранятся счетчики версий:
+    - post: меняется при любом изменении комментариев поста;
+    - structure: меняется, когда сдвигаются пути комментариев первого уровня;
+    - branch: отдельный счетчик для каждой ветки первого уровня.
+
+    Дерево поста собирается из отдельно закэшированных веток, поэтому голос в одной ветке
+    требует повторной сериализации только этой ветки. Версия читается до загрузки данных,
+    поэтому результат, записанный после конкурентного изменения, никогда не будет прочитан.
+    Если `COMMENTS_TREE['TREE_CACHE']` выключен, сброс веток не обращается к кэшу, а счетчики не меняются
+    (ETag деревьев строятся по ревизиям комментариев, см. `publications.sync.get_post_revision`),
+    поэтому перед повторным включением кэш `TREE_CACHE_ALIAS` нужно очистить.
+    Счетчики хранятся в кэше `COMMENTS_TREE['TREE_CACHE_ALIAS']`, который должен быть общим для всех процессов
+    (см. проверку `publications.checks`).
+
+    ## Methods:
+    - invalidate_post: Сбрасывает все закэшированные ветки поста.
+    - invalidate_branch: Сбрасывает ветку первого уровня, содержащую узел с указанным путем.
+    - invalidate_comments: Сбрасывает ветки комментариев по их идентификаторам.
+    - get_post_tree: Возвращает дерево поста, сериализуя только отсутствующие в кэше ветки.
+    - get_tree_variant: Возвращает вариант дерева поста: отсортированный или со свернутыми ветками.
+    - get_subtree: Возвращает ветку, начиная с указанного узла.
+    - get_permalink: Возвращает цепочку предков узла вместе с его веткой.
+    - aget_cached_tree: Асинхронно возвращает дерево поста или его вариант, если они есть в кэше.
+    - aget_cached_subtree: Асинхронно возвращает ветку, начиная с узла, если она есть в кэше.
+    """
+
+    @property
+    def enabled(self):
+        return get_setting('TREE_CACHE')
+
+    @property
+    def cache(self):
+        return caches[get_setting('TREE_CACHE_ALIAS')]
+
+    def make_key(self, model_class, post_id, *parts):
+        label = model_class._meta.concrete_model._meta.label_lower
+        return ':'.join(map(str, ('comments_tree', label, post_id, *parts)))
+
+    def get_versions(self, keys):
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                self.cache.add(key, time.time_ns(), None)
+                # Если кэш не хранит значения, каждая версия должна быть новой.
+                versions[key] = self.cache.get(key) or time.time_ns()
+        return versions
+
+    def get_version(self, key):
+        return self.get_versions([key])[key]
+
+    async def aget_version(self, key):
+        version = await self.cache.aget(key)
+        if version is None:
+            await self.cache.aadd(key, time.time_ns(), None)
+            version = await self.cache.aget(key) or time.time_ns()
+        return version
+
+    @staticmethod
+    def get_variant_name(sort=None, min_rating=None, max_depth=None):
+        """Возвращает имя варианта дерева для `get_tree_variant` или None для дерева в порядке путей."""
+        if sort is None and min_rating is None and max_depth is None:
+            return None
+        return f'{sort}:{min_rating}:{max_depth}'
+
+    def bump(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, time.time_ns(), None)
+
+    def touch_post(self, model_class, post_id):
+        if self.enabled:
+            self.bump(self.make_key(model_class, post_id, 'post'))
+
+    def invalidate_post(self, model_class, post_id):
+        if not self.enabled:
+            return
+        self.touch_post(model_class, post_id)
+        self.bump(self.make_key(model_class, post_id, 'structure'))
+
+    def invalidate_branch(self, model_class, post_id, path):
+        if not self.enabled:
+            return
+        structure = self.get_version(self.make_key(model_class, post_id, 'structure'))
+        self.touch_post(model_class, post_id)
+        self.bump(self.make_key(model_class, post_id, 'branch', structure, path[:model_class.steplen]))
+
+    def invalidate_comments(self, model_class, pks):
+        if not self.enabled:
+            return
+        for post_id, path in set(model_class.objects.filter(pk__in=pks).values_list('post_id', 'path')):
+            self.invalidate_branch(model_class, post_id, path)
+
+    def get_post_tree(self, post, render_branches):
+        """
+        Возвращает сериализованное дерево комментариев поста.
+
+        ## Args:
+        - post (AbstractPost): Пост.
+        - render_branches (callable): Функция (paths) -> {path: данные ветки}, сериализующая ветки
+        первого уровня с указанными путями; None означает все ветки поста.
+
+        ## Returns:
+        - list: Сериализованные ветки первого уровня.
+        """
+        model_class = post.comments.model
+        timeout = get_setting('TREE_CACHE_TIMEOUT')
+        post_key = self.make_key(model_class, post.pk, 'tree', self.get_version(self.make_key(model_class, post.pk, 'post')))
+        data = self.cache.get(post_key)
+        if data is not None:
+            return data
+
+        structure = self.get_version(self.make_key(model_class, post.pk, 'structure'))
+        order = get_tree_storage(model_class).sibling_order
+        roots = list(post.comments.filter(depth=1).order_by(*order).values_list('path', flat=True))
+        version_keys = {path: self.make_key(model_class, post.pk, 'branch', structure, path) for path in roots}
+        versions = self.get_versions(list(version_keys.values()))
+        branch_keys = {
+            path: self.make_key(model_class, post.pk, 'rendered', structure, path, versions[key])
+            for path, key in version_keys.items()
+        }
+        branches = self.cache.get_many(list(branch_keys.values()))
+        missing = [path for path in roots if branch_keys[path] not in branches]
+        if missing:
+            rendered = render_branches(missing if len(missing) < len(roots) else None)
+            self.cache.set_many({branch_keys[path]: rendered[path] for path in missing}, timeout)
+            branches.update({branch_keys[path]: rendered[path] for path in missing})
+
+        data = [branches[branch_keys[path]] for path in roots]
+        self.cache.set(post_key, data, timeout)
+        return data
+
+    def get_tree_variant(self, post, variant, render):
+        """
+        Возвращает сериализованный вариант дерева комментариев поста, например упорядоченный по сортировке
+        или со свернутыми ветками. Такой вариант зависит от всех комментариев поста, поэтому кэшируется целиком
+        до любого их изменения.
+
+        ## Args:
+        - post (AbstractPost): Пост.
+        - variant (str): Имя варианта, включающее все параметры отображения.
+        - render (callable): Функция без аргументов, сериализующая дерево.
+
+        ## Returns:
+        - list: Сериализованные ветки первого уровня.
+        """
+        model_class = post.comments.model
+        version = self.get_version(self.make_key(model_class, post.pk, 'post'))
+        key = self.make_key(model_class, post.pk, 'variant', variant, version)
+        data = self.cache.get(key)
+        if data is None:
+            data = render()
+            self.cache.set(key, data, get_setting('TREE_CACHE_TIMEOUT'))
+        return data
+
+    def get_subtree(self, node, render, sort=None):
+        """
+        Возвращает сериализованную ветку, начиная с узла.
+
+        ## Args:
+        - node (AbstractComment): Узел дерева.
+        - render (callable): Функция без аргументов, сериализующая ветку.
+        - sort (str | None): Имя сортировки, если ветка упорядочена не по порядку путей.
+
+        ## Returns:
+        - dict: Сериализованный узел с потомками.
+        """
+        return self.get_branch_data(node, render, 'node', node.pk, *filter(None, [sort]))
+
+    def get_permalink(self, node, render, max_depth=None):
+        """
+        Возвращает сериализованную цепочку предков узла с его веткой. Все узлы лежат в одной ветке первого уровня,
+        поэтому результат сбрасывается вместе с ней.
+
+        ## Args:
+        - node (AbstractComment): Узел дерева.
+        - render (callable): Функция без аргументов, сериализующая цепочку.
+        - max_depth (int | None): Количество уровней ответов под узлом.
+        """
+        return self.get_branch_data(node, render, 'permalink', node.pk, max_depth)
+
+    def get_branch_data(self, node, render, kind, *parts):
+        model_class = node.__class__
+        structure = self.get_version(self.make_key(model_class, node.post_id, 'structure'))
+        root_path = node.path[:model_class.steplen]
+        version = self.get_version(self.make_key(model_class, node.post_id, 'branch', structure, root_path))
+        key = self.make_key(model_class, node.post_id, kind, structure, root_path, version, *parts)
+        data = self.cache.get(key)
+        if data is None:
+            data = render()
+            self.cache.set(key, data, get_setting('TREE_CACHE_TIMEOUT'))
+        return data
+
+    async def aget_cached_tree(self, post, variant=None):
+        """
+        Асинхронно читает дерево поста, закэшированное `get_post_tree` или `get_tree_variant`,
+        через асинхронный API кэша Django, не обращаясь к базе данных и не занимая поток.
+
+        ## Args:
+        - post (AbstractPost): Пост.
+        - variant (str | None): Имя варианта из `get_variant_name`.
+
+        ## Returns:
+        - list | None: Сериализованные ветки первого уровня или None, если дерева нет в кэше.
+        """
+        model_class = post.comments.model
+        version = await self.aget_version(self.make_key(model_class, post.pk, 'post'))
+        parts = ('tree', version) if variant is None else ('variant', variant, version)
+        return await self.cache.aget(self.make_key(model_class, post.pk, *parts))
+
+    async def aget_cached_subtree(self, node, sort=None):
+        """
+        Асинхронно читает ветку, закэшированную `get_subtree`, не обращаясь к базе данных.
+
+        ## Returns:
+        - dict | None: Сериализованный узел с потомками или None, если ветки нет в кэше.
+        """
+        model_class = node.__class__
+        structure = await self.aget_version(self.make_key(model_class, node.post_id, 'structure'))
+        root_path = node.path[:model_class.steplen]
+        version = await self.aget_version(self.make_key(model_class, node.post_id, 'branch', structure, root_path))
+        return await self.cache.aget(self.make_key(
+            model_class, node.post_id, 'node', structure, root_path, version, node.pk, *filter(None, [sort]),
+        ))
+
+
+tree_cache = TreeCache()
@@ -0,0 +1,26 @@
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from .conf import get_setting
+
+
+@checks.register(checks.Tags.caches)
+def check_tree_cache_alias(app_configs, **kwargs):
+    """
+    Проверяет, что кэш `COMMENTS_TREE['TREE_CACHE_ALIAS']` общий для всех процессов, если в нем хранятся
+    версии деревьев (`TREE_CACHE`) или размещение постов по шардам (`SHARDS`). Кэш в памяти процесса
+    (`LocMemCache`) не видит изменений, сделанных другими воркерами, и отдает устаревшие деревья.
+    """
+    if not get_setting('TREE_CACHE') and not get_setting('SHARDS'):
+        return []
+    alias = get_setting('TREE_CACHE_ALIAS')
+    if not isinstance(caches[alias], LocMemCache):
+        return []
+    return [checks.Warning(
+        f"Кэш '{alias}' хранится в памяти процесса, а деревья комментариев и размещение постов "
+        'должны быть общими для всех воркеров.',
+        hint="Укажите в COMMENTS_TREE['TREE_CACHE_ALIAS'] общий кэш (Redis, Memcached, база данных) "
+             'или запускайте один процесс.',
+        id='publications.W001',
+    )]
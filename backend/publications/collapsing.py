@@ -0,0 +1,123 @@
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Left
+
+from .metrics import instrumented, record_nodes
+from .pagination import get_cursor_after
+from .scoring import sort_tree
+
+# Количество родителей в одном запросе уровня, чтобы не превысить лимит параметров SQLite.
+PARENTS_BATCH_SIZE = 500
+
+
+@instrumented('tree')
+def load_collapsed_tree(queryset, min_rating=None, max_depth=None):
+    """
+    Загружает дерево поста по уровням, пропуская свернутые ветки: комментарии с рейтингом ниже `min_rating`
+    не загружаются вместе со всеми потомками, а уровни глубже `max_depth` не запрашиваются.
+    Каждый уровень загружается запросом по ключу (post, depth, path) только для детей развернутых узлов,
+    поэтому строки свернутых веток не читаются из базы данных.
+
+    ## Args:
+    - queryset (QuerySet): Комментарии одного поста.
+    - min_rating (int | None): Минимальный рейтинг видимого комментария.
+    - max_depth (int | None): Количество загружаемых уровней.
+
+    ## Returns:
+    - tuple: Комментарии первого уровня с заполненным `_cached_children` и пара (количество, всего комментариев)
+    для скрытых комментариев первого уровня вместе с их ветками.
+    """
+    model_class = queryset.model
+    visible = queryset if min_rating is None else queryset.filter(rating__gte=min_rating)
+    top = list(visible.filter(depth=1).with_authors().order_by('path'))
+    record_nodes(top)
+    hidden_roots = (0, 0)
+    if min_rating is not None:
+        hidden = queryset.filter(depth=1, rating__lt=min_rating).aggregate(
+            count=Count('pk'), total=Sum(F('descendant_count') + 1),
+        )
+        hidden_roots = (hidden['count'], hidden['total'] or 0)
+
+    level = top
+    depth = 1
+    while level:
+        for node in level:
+            node._cached_children = []
+        parents = [node for node in level if node.numchild]
+        if not parents or (max_depth is not None and depth >= max_depth):
+            break
+        level = []
+        for start in range(0, len(parents), PARENTS_BATCH_SIZE):
+            batch = parents[start:start + PARENTS_BATCH_SIZE]
+            level.extend(
+                visible.filter(
+                    depth=depth + 1,
+                    path__range=(batch[0].path, batch[-1].path + model_class.alphabet[-1] * model_class.steplen),
+                ).annotate(
+                    parent_path=Left('path', len(batch[0].path)),
+                ).filter(
+                    parent_path__in=[parent.path for parent in batch],
+                ).with_authors().order_by('path')
+            )
+        record_nodes(level)
+        by_path = {parent.path: parent for parent in parents}
+        for node in level:
+            by_path[node.parent_path]._cached_children.append(node)
+        depth += 1
+    return top, hidden_roots
+
+
+def make_stub(reason, count, total, cursor):
+    """
+    Возвращает заглушку свернутых комментариев, которая замыкает список детей.
+
+    ## Args:
+    - reason (str): `rating` — скрыты комментарии с низким рейтингом, `depth` — скрыты ответы глубже отсечки.
+    - count (int): Количество скрытых комментариев этого уровня.
+    - total (int): Количество скрытых комментариев вместе с их ветками.
+    - cursor (str | None): Курсор страницы детей родителя, с которой начинаются скрытые комментарии.
+    """
+    return {'collapsed': reason, 'count': count, 'total': total, 'cursor': cursor}
+
+
+def add_collapsed_stubs(nodes, data, max_depth=None):
+    """
+    Добавляет в сериализованные узлы заглушки вместо скрытых детей. Количество скрытых комментариев
+    вычисляется по `numchild` и `descendant_count`, поэтому скрытые ветки не загружаются.
+    """
+    for node, item in zip(nodes, data):
+        children = node._cached_children
+        hidden = node.numchild - len(children)
+        if hidden:
+            reason = 'depth' if max_depth is not None and node.depth >= max_depth else 'rating'
+            shown = sum(child.descendant_count + 1 for child in children)
+            cursor = get_cursor_after(children, node.path)
+            item['children'].append(make_stub(reason, hidden, node.descendant_count - shown, cursor))
+        add_collapsed_stubs(children, item['children'], max_depth)
+
+
+def get_collapsed_tree(node_serializer, queryset, min_rating=None, max_depth=None, scorer=None):
+    """
+    Сериализует дерево поста, в котором ветки с низким рейтингом и ответы глубже `max_depth`
+    заменены заглушками `make_stub`. Курсор заглушки передается в запрос страницы детей родителя
+    (или страницы дерева для комментариев первого уровня): страницы упорядочены по рейтингу (`PAGE_ORDER`),
+    а курсор содержит ключ последнего видимого брата, поэтому страница начинается точно со скрытых комментариев,
+    даже если пути еще не переупорядочены после голосов.
+
+    ## Args:
+    - node_serializer (CompiledNodeSerializer): Сериализатор узлов.
+    - queryset (QuerySet): Комментарии одного поста.
+    - min_rating (int | None): Минимальный рейтинг видимого комментария.
+    - max_depth (int | None): Количество видимых уровней.
+    - scorer (Scorer | None): Оценщик для сортировки видимых комментариев.
+
+    ## Returns:
+    - list: Сериализованные комментарии первого уровня, за которыми может идти заглушка.
+    """
+    top, (hidden, total) = load_collapsed_tree(queryset, min_rating, max_depth)
+    if scorer is not None:
+        top = sort_tree(top, scorer)
+    data = node_serializer.serialize(top)
+    add_collapsed_stubs(top, data, max_depth)
+    if hidden:
+        data.append(make_stub('rating', hidden, total, get_cursor_after(top, '') if top else None))
+    return data
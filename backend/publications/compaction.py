@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.db.models import CharField, Exists, OuterRef, Q, Value
+from django.db.models.functions import Concat
+from django.utils import timezone
+
+from .conf import get_setting
+
+
+def get_dead_subtrees(model_class, before):
+    """
+    Возвращает удаленные раньше `before` комментарии, во всей ветке которых нет ни живых комментариев,
+    ни удаленных позже `before`: заглушка потомка хранится весь срок `TOMBSTONE_RETENTION` независимо от возраста предка.
+    Потомки ищутся диапазоном пути по уникальному индексу (post, path).
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - before (datetime): Учитываются только комментарии, удаленные раньше этого времени.
+    """
+    max_length = model_class._meta.get_field('path').max_length
+    kept_descendants = model_class.objects.filter(
+        Q(deleted_at__isnull=True) | Q(deleted_at__gte=before),
+        post_id=OuterRef('post_id'),
+        path__gt=OuterRef('path'),
+        path__lte=Concat(OuterRef('path'), Value(model_class.alphabet[-1] * max_length), output_field=CharField()),
+    )
+    return model_class.objects.filter(deleted_at__lt=before).filter(~Exists(kept_descendants))
+
+
+def compact_tombstones(model_class, older_than=None, batch_size=None):
+    """
+    Физически удаляет полностью удаленные ветки пачками. Каждая пачка удаляется через `CommentQuerySet.delete`,
+    поэтому `numchild` родителей, агрегаты предков, журнал удалений и кэш деревьев обновляются как при обычном удалении.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - older_than (float | None): Сколько секунд удаленный комментарий остается заглушкой;
+    по умолчанию `COMMENTS_TREE['TOMBSTONE_RETENTION']`.
+    - batch_size (int | None): Количество веток в пачке; по умолчанию `COMMENTS_TREE['COMPACT_BATCH_SIZE']`.
+
+    ## Returns:
+    - int: Количество удаленных строк.
+    """
+    if older_than is None:
+        older_than = get_setting('TOMBSTONE_RETENTION')
+    batch_size = batch_size or get_setting('COMPACT_BATCH_SIZE')
+    before = timezone.now() - timedelta(seconds=older_than)
+    removed = 0
+    while True:
+        pks = list(get_dead_subtrees(model_class, before).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return removed
+        removed += model_class.objects.filter(pk__in=pks).delete()[0]
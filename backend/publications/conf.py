@@ -0,0 +1,49 @@
+from django.conf import settings
+
+DEFAULTS = {
+    'VOTE_BUFFER': False,
+    'VOTE_FLUSH_INTERVAL': 1.0,
+    'VOTE_MAX_PENDING': 1000,
+    'RERANK_INTERVAL': None,
+    'RERANK_BATCH_SIZE': 500,
+    'RERANK_MAX_PENDING': 1000,
+    'TREE_CACHE': False,
+    'TREE_CACHE_ALIAS': 'default',
+    'TREE_CACHE_TIMEOUT': 300,
+    'STREAM_CHUNK_SIZE': 65536,
+    'STREAM_BATCH_SIZE': 2000,
+    'METRICS': False,
+    'IMPORT_BATCH_SIZE': 1000,
+    'SCORERS': {},
+    'COLLAPSE_MIN_RATING': -5,
+    'COLLAPSE_DEPTH': 8,
+    'SYNC_LAG': 5,
+    'SYNC_RETENTION': 86400,
+    'LIVE_BROKER': 'publications.live.LocalBroker',
+    'LIVE_SOCKET_DIR': None,
+    'LIVE_COALESCE_INTERVAL': 0.1,
+    'LIVE_HEARTBEAT': 15,
+    'LIVE_MAX_PENDING': 1000,
+    'ASYNC_WORKERS': 4,
+    'TOMBSTONE_RETENTION': 86400,
+    'COMPACT_BATCH_SIZE': 500,
+    'PERMALINK_DEPTH': 5,
+    'SHARDS': None,
+    'SEARCH_BACKEND': 'publications.search.SQLiteSearchBackend',
+    'SEARCH_LIMIT': 20,
+    'FEED_TOP_COMMENTS': 3,
+}
+
+
+def get_setting(name):
+    """
+    Возвращает настройку системы комментариев из словаря `COMMENTS_TREE` в settings.py.
+    Если настройка не задана, используется значение по умолчанию из `DEFAULTS`.
+
+    ## Args:
+    - name (str): Имя настройки.
+
+    ## Returns:
+    - Any: Значение настройки.
+    """
+    return getattr(settings, 'COMMENTS_TREE', {}).get(name, DEFAULTS[name])
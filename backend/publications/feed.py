@@ -0,0 +1,72 @@
+from collections import defaultdict
+
+from django.db import router
+from django.db.models import F, Max, Sum, Window
+from django.db.models.functions import RowNumber
+from rest_framework.fields import DateTimeField
+
+from .metrics import instrumented
+from .serializers import get_compiled_node_serializer
+from .sharding import get_post_shards
+
+
+def get_feed_roots(model_class, post_ids, top_comments, using=None):
+    """
+    Возвращает одним запросом лучшие комментарии первого уровня каждого поста вместе с числом комментариев
+    и последней активностью поста. Оконные функции считаются по всем корням постов до отбора лучших,
+    поэтому итоги поста берутся из агрегатов веток (`descendant_count`, `last_activity`) без чтения ответов.
+    Удаленные корни нумеруются после живых и затем отбрасываются.
+
+    ## Returns:
+    - QuerySet: Корни с аннотациями `feed_rank`, `feed_comment_count` и `feed_last_activity`,
+    не больше `top_comments` (но хотя бы один) на пост.
+    """
+    partition = {'partition_by': F('post_id')}
+    return (
+        model_class.objects.using(using)
+        .filter(post_id__in=post_ids, depth=1)
+        .annotate(
+            feed_rank=Window(
+                RowNumber(), order_by=(F('deleted_at').asc(nulls_first=True), F('rating').desc(), F('path').asc()), **partition,
+            ),
+            feed_comment_count=Window(Sum(F('descendant_count') + 1), **partition),
+            feed_last_activity=Window(Max('last_activity'), **partition),
+        )
+        .filter(feed_rank__lte=max(top_comments, 1))
+        .with_authors()
+        .order_by('post_id', 'feed_rank')
+    )
+
+
+@instrumented('tree')
+def load_comment_summaries(model_class, post_ids, top_comments):
+    """
+    Загружает для страницы постов число комментариев, время последней активности и лучшие комментарии
+    первого уровня по рейтингу. Выполняется один запрос на каждый шард, где лежат посты страницы,
+    независимо от количества постов.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_ids (iterable): Идентификаторы постов.
+    - top_comments (int): Количество лучших комментариев первого уровня у каждого поста.
+
+    ## Returns:
+    - dict: {post_id: {'comment_count', 'last_activity', 'top_comments'}}; лучшие комментарии
+    и время активности сериализуются как в DRF. У постов без комментариев счетчик равен 0, а активность — None.
+    """
+    post_ids = list(post_ids)
+    by_shard = defaultdict(list)
+    for post_id, alias in get_post_shards(model_class, post_ids).items():
+        by_shard[alias or router.db_for_read(model_class)].append(post_id)
+
+    node_serializer = get_compiled_node_serializer(model_class, ('children',))
+    datetime_field = DateTimeField()
+    summaries = {post_id: {'comment_count': 0, 'last_activity': None, 'top_comments': []} for post_id in post_ids}
+    for alias, shard_post_ids in by_shard.items():
+        for root in get_feed_roots(model_class, shard_post_ids, top_comments, alias):
+            summary = summaries[root.post_id]
+            summary['comment_count'] = root.feed_comment_count
+            summary['last_activity'] = datetime_field.to_representation(root.feed_last_activity)
+            if root.feed_rank <= top_comments and root.deleted_at is None:
+                summary['top_comments'].append(node_serializer.to_representation(root))
+    return summaries
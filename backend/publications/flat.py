@@ -0,0 +1,55 @@
+from .metrics import instrumented
+
+# Колонки плоского формата дерева в порядке вывода.
+FLAT_COLUMNS = ('id', 'parent', 'user', 'rating', 'created_at', 'text')
+# Поля строк, из которых строятся колонки.
+FLAT_ROW_FIELDS = ('pk', 'path', 'user_id', 'rating', 'created_at', 'text', 'deleted_at')
+
+
+def build_flat_tree(model_class, rows):
+    """
+    Строит колонки плоского дерева из строк, упорядоченных по `path`, не создавая объектов и словарей для узлов:
+    родитель узла находится по префиксу пути среди уже прочитанных строк.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - rows (iterable): Кортежи значений `FLAT_ROW_FIELDS`, упорядоченные по `path`.
+
+    ## Returns:
+    - dict: Параллельные списки колонок `FLAT_COLUMNS`. `parent` — индекс родителя в этих же списках
+    или -1 для узлов верхнего уровня, `created_at` — миллисекунды Unix-времени.
+    У удаленных комментариев поля `tombstone_fields` модели равны None.
+    """
+    rows = list(rows)
+    if not rows:
+        return {name: [] for name in FLAT_COLUMNS}
+    ids, paths, users, ratings, created_at, texts, deleted_at = zip(*rows)
+    index = {path: position for position, path in enumerate(paths)}
+    steplen = model_class.steplen
+    columns = {
+        'id': list(ids),
+        'parent': [index.get(path[:-steplen], -1) for path in paths],
+        'user': list(users),
+        'rating': list(ratings),
+        'created_at': [round(value.timestamp() * 1000) for value in created_at],
+        'text': list(texts),
+    }
+    for position, value in enumerate(deleted_at):
+        if value is not None:
+            for name in set(model_class.tombstone_fields) & set(columns):
+                columns[name][position] = None
+    return columns
+
+
+@instrumented('tree')
+def load_flat_tree(queryset):
+    """
+    Загружает комментарии одним запросом кортежами значений и строит плоское дерево `build_flat_tree`.
+
+    ## Args:
+    - queryset (QuerySet): Комментарии поста или ветки.
+
+    ## Returns:
+    - dict: Колонки плоского дерева в порядке путей.
+    """
+    return build_flat_tree(queryset.model, queryset.order_by('path').values_list(*FLAT_ROW_FIELDS))
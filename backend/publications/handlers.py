@@ -0,0 +1,114 @@
+from django.db import connection
+from django.db.models import F
+from django.utils.translation import gettext_lazy as _
+from treebeard.exceptions import InvalidPosition, NodeAlreadySaved, PathOverflow
+from treebeard.mp_tree import (MP_AddChildHandler, MP_AddRootHandler,
+                               MP_AddSiblingHandler, MP_MoveHandler,
+                               get_result_class)
+
+from .storage import get_tree_storage
+from .sync import revision_clock
+
+
+class PostScopedSqlMixin:
+    """
+    Ограничивает SQL, который treebeard генерирует при вставке и переносе узлов, строками одного поста.
+    Пути комментариев уникальны только в пределах поста, поэтому каждое UPDATE дополняется условием по `post_id`,
+    а измененным строкам проставляется новая ревизия для синхронизации клиентов.
+    """
+
+    @property
+    def post_id(self):
+        return self.node.post_id
+
+    def scope_sql(self, sql_vals):
+        sql, vals = sql_vals
+        column = self.node_cls._meta.get_field('post').column
+        revision_column = connection.ops.quote_name(self.node_cls._meta.get_field('revision').column)
+        sql = sql.replace(' SET ', f' SET {revision_column}=%s, ', 1)
+        return f'{sql} AND {connection.ops.quote_name(column)}=%s', [revision_clock.next(), *vals, self.post_id]
+
+    def get_sql_update_numchild(self, path, incdec='inc'):
+        return self.scope_sql(super().get_sql_update_numchild(path, incdec))
+
+    def get_sql_newpath_in_branches(self, oldpath, newpath):
+        return self.scope_sql(super().get_sql_newpath_in_branches(oldpath, newpath))
+
+    def get_mysql_update_depth_in_branch(self, path):
+        return self.scope_sql(super().get_mysql_update_depth_in_branch(path))
+
+
+def get_new_instance(node_cls, kwargs):
+    if len(kwargs) == 1 and 'instance' in kwargs:
+        newobj = kwargs['instance']
+        if not newobj._state.adding:
+            raise NodeAlreadySaved('Attempted to add a tree node that is already in the database')
+        return newobj
+    return node_cls(**kwargs)
+
+
+class PostAddRootHandler(MP_AddRootHandler):
+    """
+    Добавляет комментарий первого уровня, сдвигая при сортировке только корни того же поста.
+    Если стратегия хранения не упорядочивает пути (`sorted_paths`), комментарий добавляется в конец.
+    """
+
+    def process(self):
+        newobj = get_new_instance(self.cls, self.kwargs)
+        last_root = self.cls.get_post_root_nodes(newobj.post_id).last()
+
+        if last_root and last_root.node_order_by and get_tree_storage(self.cls).sorted_paths:
+            return last_root.add_sibling('sorted-sibling', instance=newobj)
+
+        if last_root:
+            newpath = last_root._inc_path()
+        else:
+            newpath = self.cls._get_path(None, 1, 1)
+
+        newobj.depth = 1
+        newobj.path = newpath
+        newobj.save()
+        return newobj
+
+
+class PostAddChildHandler(MP_AddChildHandler):
+    """Добавляет дочерний комментарий, обновляя `numchild` только у родителя из того же поста."""
+
+    def process(self):
+        sorted_paths = get_tree_storage(self.node_cls).sorted_paths
+        if self.node_cls.node_order_by and sorted_paths and not self.node.is_leaf():
+            self.node.numchild += 1
+            newobj = get_new_instance(self.node_cls, self.kwargs)
+            newobj._cached_parent_obj = self.node
+            return self.node.get_last_child().add_sibling('sorted-sibling', instance=newobj)
+
+        newobj = get_new_instance(self.node_cls, self.kwargs)
+        newobj.depth = self.node.depth + 1
+        if self.node.is_leaf():
+            newobj.path = self.node_cls._get_path(self.node.path, newobj.depth, 1)
+            max_length = self.node_cls._meta.get_field('path').max_length
+            if len(newobj.path) > max_length:
+                raise PathOverflow(_('The new node is too deep in the tree, try increasing the path.max_length property and UPDATE your database'))
+        else:
+            newobj.path = self.node.get_last_child()._inc_path()
+
+        get_result_class(self.node_cls).objects.filter(
+            post_id=self.node.post_id, path=self.node.path
+        ).update(numchild=F('numchild') + 1, revision=revision_clock.next())
+        self.node.numchild += 1
+
+        newobj._cached_parent_obj = self.node
+        newobj.save()
+        return newobj
+
+
+class PostAddSiblingHandler(PostScopedSqlMixin, MP_AddSiblingHandler):
+    pass
+
+
+class PostMoveHandler(PostScopedSqlMixin, MP_MoveHandler):
+
+    def process(self):
+        if self.target.post_id != self.node.post_id:
+            raise InvalidPosition(_('Комментарий нельзя перенести в другой пост.'))
+        return super().process()
@@ -0,0 +1,186 @@
+from django.db import router, transaction
+from django.utils import timezone
+from treebeard.exceptions import PathOverflow
+
+from .aggregates import compute_aggregates
+from .cache import tree_cache
+from .conf import get_setting
+from .ranking import rerank_children
+from .sharding import allocate_ids, is_sharded
+from .storage import get_tree_storage
+from .sync import revision_clock
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+def build_import_tree(items):
+    """
+    Группирует плоский список комментариев по родителям и упорядочивает братьев по убыванию рейтинга.
+    Комментарии с одинаковым рейтингом сохраняют порядок из списка.
+
+    ## Args:
+    - items (list): Словари с ключами `id` (ссылка на комментарий внутри пакета) и `parent`
+    (ссылка на родителя или None), остальные ключи — поля модели.
+
+    ## Returns:
+    - list: Пары (item, children) верхнего уровня, где children — такой же список пар.
+
+    ## Raises:
+    - InvalidImport: Если ссылки повторяются, указывают на отсутствующий комментарий или образуют цикл.
+    """
+    children = {}
+    refs = set()
+    for item in items:
+        if item['id'] in refs:
+            raise InvalidImport(f"Повторяющийся id: {item['id']}")
+        refs.add(item['id'])
+        children.setdefault(item.get('parent'), []).append(item)
+    unknown = set(children) - refs - {None}
+    if unknown:
+        raise InvalidImport(f'Неизвестные родители: {sorted(map(str, unknown))}')
+
+    roots = []
+    stack = [(None, roots)]
+    reachable = 0
+    while stack:
+        parent, nodes = stack.pop()
+        for item in sorted(children.get(parent, ()), key=lambda item: -(item.get('rating') or 0)):
+            nodes.append((item, []))
+            stack.append((item['id'], nodes[-1][1]))
+            reachable += 1
+    if reachable != len(items):
+        raise InvalidImport('Ссылки на родителей образуют цикл.')
+    return roots
+
+
+def iter_import_tree(nodes):
+    """Обходит дерево из `build_import_tree` в ширину, не используя рекурсию."""
+    level = nodes
+    while level:
+        next_level = []
+        for item, children in level:
+            yield item, children
+            next_level.extend(children)
+        level = next_level
+
+
+def build_instance(model_class, values):
+    """
+    Создает экземпляр модели; значения внешних ключей можно передать идентификатором,
+    остальные значения приводятся к типу поля (например, дата из строки ISO 8601).
+    """
+    kwargs = {}
+    for name, value in values.items():
+        field = model_class._meta.get_field(name)
+        if field.many_to_one and not hasattr(value, '_meta'):
+            kwargs[field.attname] = value
+        elif field.many_to_one:
+            kwargs[name] = value
+        else:
+            kwargs[name] = field.to_python(value)
+    return model_class(**kwargs)
+
+
+def check_import_level(model_class, parent_path, children, start):
+    """
+    Проверяет, что дети одного родителя помещаются в дерево.
+
+    ## Raises:
+    - InvalidImport: Если глубина детей превышает длину пути.
+    - PathOverflow: Если у родителя больше детей, чем позволяет длина шага пути.
+    """
+    depth = len(parent_path) // model_class.steplen + 1
+    max_depth = model_class._meta.get_field('path').max_length // model_class.steplen
+    if children and depth > max_depth:
+        raise InvalidImport(f"Глубина дерева превышает {max_depth}: {children[0][0]['id']}")
+    if children and start + len(children) - 1 > len(model_class.alphabet) ** model_class.steplen - 1:
+        raise PathOverflow(f"Path Overflow from: '{parent_path}'")
+
+
+def build_import_instances(model_class, post, roots, first_step, now):
+    """
+    Создает экземпляры комментариев дерева из `build_import_tree` с вычисленными `path`, `depth`, `numchild`,
+    `inverted_rating` и счетчиками голосов. Комментарии первого уровня нумеруются с шага `first_step`,
+    комментарии без `created_at` получают время импорта `now`.
+
+    ## Returns:
+    - tuple: Созданные комментарии по ссылкам `id` и список комментариев в порядке обхода в ширину.
+    """
+    paths = {}
+    created = {}
+    instances = []
+    for item, children in iter_import_tree([(None, roots)]):
+        parent_path = paths.get(item['id'], '') if item else ''
+        depth = len(parent_path) // model_class.steplen + 1
+        start = first_step if item is None else 1
+        check_import_level(model_class, parent_path, children, start)
+        for step, (child, grandchildren) in enumerate(children, start):
+            values = {name: value for name, value in child.items() if name not in ('id', 'parent')}
+            values.setdefault('created_at', now)
+            instance = build_instance(model_class, values)
+            instance.post = post
+            instance.path = model_class._get_path(parent_path, depth, step)
+            instance.depth = depth
+            instance.numchild = len(grandchildren)
+            instance.inverted_rating = -instance.rating
+            if not (instance.upvotes or instance.downvotes):
+                instance.upvotes, instance.downvotes = max(instance.rating, 0), max(-instance.rating, 0)
+            paths[child['id']] = instance.path
+            created[child['id']] = instance
+            instances.append(instance)
+    return created, instances
+
+
+def fill_import_aggregates(model_class, instances):
+    """Заполняет агрегаты веток и ревизию импортируемых комментариев, а на шардах — глобальные идентификаторы."""
+    revision = revision_clock.next()
+    aggregates = compute_aggregates(
+        ((instance.path, instance.rating, instance.created_at) for instance in instances), model_class.steplen,
+    )
+    for instance in instances:
+        instance.descendant_count, instance.max_subtree_rating, instance.last_activity = aggregates[instance.path]
+        instance.revision = revision
+    if is_sharded(model_class):
+        for instance, pk in zip(instances, allocate_ids(len(instances))):
+            instance.pk = pk
+
+
+def import_comments(model_class, post, items, batch_size=None):
+    """
+    Импортирует в пост пакет комментариев, вычисляя `path`, `depth`, `numchild`, `inverted_rating`,
+    счетчики голосов и агрегаты веток в памяти. Комментарии записываются через `bulk_create` частями в одной транзакции,
+    поэтому импорт не зависит от обработчиков treebeard, перечитывающих родителя на каждую вставку.
+    Комментарии первого уровня добавляются после уже существующих и затем упорядочиваются по рейтингу,
+    если стратегия хранения упорядочивает пути; затем стратегия дополняет импорт (например, заполняет `parent`).
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post (AbstractPost): Пост, в который импортируются комментарии.
+    - items (list): Плоский список комментариев в формате `build_import_tree`.
+    - batch_size (int | None): Размер пачки `bulk_create`; по умолчанию `COMMENTS_TREE['IMPORT_BATCH_SIZE']`.
+
+    ## Returns:
+    - dict: Созданные комментарии по ссылкам `id` из пакета. Если в посте уже были комментарии,
+    пути комментариев первого уровня могут измениться при упорядочивании по рейтингу.
+
+    ## Raises:
+    - InvalidImport: Если пакет некорректен.
+    - PathOverflow: Если у одного родителя больше детей, чем позволяет длина шага пути.
+    """
+    batch_size = batch_size or get_setting('IMPORT_BATCH_SIZE')
+    roots = build_import_tree(items)
+
+    with transaction.atomic(using=router.db_for_write(model_class)):
+        last_root = model_class.get_post_root_nodes(post.pk).values_list('path', flat=True).last()
+        first_step = model_class._str2int(last_root) + 1 if last_root else 1
+        created, instances = build_import_instances(model_class, post, roots, first_step, timezone.now())
+        fill_import_aggregates(model_class, instances)
+        model_class.objects.bulk_create(instances, batch_size=batch_size)
+        storage = get_tree_storage(model_class)
+        if last_root and storage.sorted_paths:
+            rerank_children(model_class, post.pk)
+        storage.after_import(model_class, post.pk)
+    tree_cache.invalidate_post(model_class, post.pk)
+    return created
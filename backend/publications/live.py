@@ -0,0 +1,213 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import uuid
+from collections import defaultdict
+from functools import cache, partial
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .conf import get_setting
+
+
+class Subscription:
+    """
+    Подписка клиента на события поста. События принимаются в цикле событий подписчика
+    и объединяются: голоса за один комментарий суммируются, поэтому при всплеске голосов
+    клиент получает одно событие на комментарий за интервал `COMMENTS_TREE['LIVE_COALESCE_INTERVAL']`.
+    Если накопилось больше `COMMENTS_TREE['LIVE_MAX_PENDING']` событий, они заменяются одним событием `reset`,
+    после которого клиент запрашивает изменения через синхронизацию.
+
+    ## Methods:
+    - push: Добавляет событие; вызывается в цикле событий подписчика.
+    - get: Ожидает события и возвращает накопленную пачку или пустой список по таймауту.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = {}
+        self.overflow = False
+        self.ready = asyncio.Event()
+
+    def push(self, event):
+        key = (event['type'], event['id'])
+        current = self.pending.get(key)
+        if current is not None and event['type'] == 'vote':
+            for name in ('delta', 'upvotes', 'downvotes'):
+                current[name] += event[name]
+        elif current is None and len(self.pending) >= get_setting('LIVE_MAX_PENDING'):
+            self.overflow = True
+        else:
+            self.pending[key] = dict(event)
+        self.ready.set()
+
+    async def get(self, timeout=None):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        await asyncio.sleep(get_setting('LIVE_COALESCE_INTERVAL'))
+        self.ready.clear()
+        events, self.pending = list(self.pending.values()), {}
+        if self.overflow:
+            self.overflow = False
+            return [{'type': 'reset', 'id': None}]
+        return events
+
+
+class LocalBroker:
+    """
+    Раздача событий подписчикам внутри процесса. Публиковать можно из любого потока:
+    событие передается в цикл событий каждого подписчика через `call_soon_threadsafe`.
+
+    ## Methods:
+    - subscribe: Создает подписку на канал в текущем цикле событий.
+    - unsubscribe: Удаляет подписку.
+    - publish: Публикует событие в канал.
+    - deliver: Передает событие подписчикам этого процесса.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channel):
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self._lock:
+            self._subscriptions[channel].discard(subscription)
+            if not self._subscriptions[channel]:
+                del self._subscriptions[channel]
+
+    def publish(self, channel, event):
+        self.deliver(channel, event)
+
+    def deliver(self, channel, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, event)
+            except RuntimeError:
+                self.unsubscribe(channel, subscription)
+
+
+class SocketBroker(LocalBroker):
+    """
+    Раздача событий между процессами одной машины без внешнего брокера. Каждый процесс открывает
+    датаграммный Unix-сокет в каталоге `COMMENTS_TREE['LIVE_SOCKET_DIR']` и принимает события в фоновом потоке;
+    публикация отправляет событие во все сокеты каталога, включая собственный. Сокеты завершившихся процессов удаляются.
+    """
+
+    def __init__(self, directory=None):
+        super().__init__()
+        self.directory = directory or get_setting('LIVE_SOCKET_DIR') or os.path.join(tempfile.gettempdir(), 'comments-live')
+        self._socket = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._socket is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.sock')
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self.path)
+            threading.Thread(target=self._receive, daemon=True).start()
+
+    def subscribe(self, channel):
+        self.start()
+        return super().subscribe(channel)
+
+    def publish(self, channel, event):
+        self.start()
+        data = json.dumps({'channel': channel, 'event': event}, cls=DjangoJSONEncoder).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                self._socket.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            os.unlink(self.path)
+            self._socket = None
+
+    def _receive(self):
+        sock = self._socket
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            self.deliver(message['channel'], message['event'])
+
+
+@cache
+def load_broker(dotted_path):
+    return import_string(dotted_path)()
+
+
+def get_broker():
+    """Возвращает брокер событий процесса, заданный в `COMMENTS_TREE['LIVE_BROKER']`."""
+    return load_broker(get_setting('LIVE_BROKER'))
+
+
+def get_channel(model_class, post_id):
+    return f'{model_class._meta.concrete_model._meta.label_lower}:{post_id}'
+
+
+def publish_event(model_class, post_id, event):
+    """Публикует событие поста после фиксации текущей транзакции."""
+    transaction.on_commit(partial(get_broker().publish, get_channel(model_class, post_id), event))
+
+
+def format_sse(event):
+    """Форматирует событие в формате Server-Sent Events."""
+    return f"event: {event['type']}\ndata: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def iter_post_events(model_class, post_id, hello=None):
+    """
+    Генерирует поток Server-Sent Events поста: новые комментарии (`comment`), суммарные изменения рейтинга (`vote`)
+    и `reset`, если событий было слишком много. Пока событий нет, раз в `COMMENTS_TREE['LIVE_HEARTBEAT']` секунд
+    отправляется комментарий, чтобы прокси не закрывали соединение.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_id (int): Идентификатор поста.
+    - hello (dict | None): Данные первого события `hello`, например курсор синхронизации для переподключения.
+    """
+    broker = get_broker()
+    channel = get_channel(model_class, post_id)
+    subscription = broker.subscribe(channel)
+    try:
+        yield format_sse({'type': 'hello', 'id': None, **(hello or {})})
+        while True:
+            events = await subscription.get(get_setting('LIVE_HEARTBEAT'))
+            if not events:
+                yield ': ping\n\n'
+            for event in events:
+                yield format_sse(event)
+    finally:
+        broker.unsubscribe(channel, subscription)
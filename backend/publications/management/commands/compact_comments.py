@@ -0,0 +1,19 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Физически удаляет ветки комментариев, в которых все комментарии удалены.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Модель комментариев в формате app_label.ModelName.')
+        parser.add_argument('--older-than', type=float, help='Сколько секунд удаленный комментарий остается заглушкой.')
+        parser.add_argument('--batch-size', type=int, help='Количество веток, удаляемых за один запрос.')
+
+    def handle(self, *args, **options):
+        try:
+            model_class = apps.get_model(options['model'])
+        except (LookupError, ValueError) as error:
+            raise CommandError(error)
+        removed = model_class.compact_tombstones(options['older_than'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Удалено комментариев: {removed}'))
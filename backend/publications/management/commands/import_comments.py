@@ -0,0 +1,42 @@
+import json
+import sys
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from publications.importing import InvalidImport
+
+
+class Command(BaseCommand):
+    help = (
+        'Импортирует комментарии в пост из JSON-файла со списком объектов '
+        '{"id": ..., "parent": ..., "user": ..., "text": ..., "rating": ..., "created_at": ...}.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Модель комментариев в формате app_label.ModelName.')
+        parser.add_argument('post', type=int, help='Идентификатор поста.')
+        parser.add_argument('file', help='JSON-файл с комментариями; "-" означает стандартный ввод.')
+        parser.add_argument('--batch-size', type=int, help='Размер пачки bulk_create.')
+
+    def handle(self, *args, **options):
+        try:
+            model_class = apps.get_model(options['model'])
+        except (LookupError, ValueError) as error:
+            raise CommandError(error)
+        post_model = model_class._meta.get_field('post').related_model
+        try:
+            post = post_model.objects.get(pk=options['post'])
+        except post_model.DoesNotExist:
+            raise CommandError(f"Пост {options['post']} не найден.")
+
+        if options['file'] == '-':
+            items = json.load(sys.stdin)
+        else:
+            with open(options['file'], encoding='utf-8') as file:
+                items = json.load(file)
+        try:
+            created = model_class.bulk_import(post, items, options['batch_size'])
+        except InvalidImport as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f'Импортировано комментариев: {len(created)}'))
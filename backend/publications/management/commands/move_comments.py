@@ -0,0 +1,26 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from publications.sharding import get_post_shard, move_post_comments
+
+
+class Command(BaseCommand):
+    help = 'Переносит дерево комментариев поста на другой шард (COMMENTS_TREE["SHARDS"]).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Модель комментариев в формате app_label.ModelName.')
+        parser.add_argument('post', type=int, help='Идентификатор поста.')
+        parser.add_argument('database', help='Псевдоним базы данных шарда, на который переносится дерево.')
+        parser.add_argument('--batch-size', type=int, help='Размер пачки при копировании комментариев.')
+
+    def handle(self, *args, **options):
+        try:
+            model_class = apps.get_model(options['model'])
+        except (LookupError, ValueError) as error:
+            raise CommandError(error)
+        source = get_post_shard(model_class, options['post'])
+        try:
+            moved = move_post_comments(model_class, options['post'], options['database'], options['batch_size'])
+        except ValueError as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(f"Перенесено комментариев: {moved} ({source} -> {options['database']})"))
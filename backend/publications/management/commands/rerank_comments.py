@@ -0,0 +1,31 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from publications.ranking import rerank_post
+from publications.sharding import get_shards, is_sharded, post_shard_context
+
+
+class Command(BaseCommand):
+    help = 'Упорядочивает ветки комментариев по рейтингу.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Модель комментариев в формате app_label.ModelName.')
+        parser.add_argument('--post', type=int, action='append', dest='posts', help='Идентификатор поста, можно указать несколько раз.')
+
+    def handle(self, *args, **options):
+        try:
+            model_class = apps.get_model(options['model'])
+        except (LookupError, ValueError) as error:
+            raise CommandError(error)
+        posts = options['posts']
+        if not posts:
+            shards = get_shards() if is_sharded(model_class) else (None,)
+            posts = sorted({
+                post_id for shard in shards
+                for post_id in model_class.objects.using(shard).order_by().values_list('post_id', flat=True).distinct()
+            })
+        moved = 0
+        for post_id in posts:
+            with post_shard_context(model_class, post_id):
+                moved += rerank_post(model_class, post_id)
+        self.stdout.write(self.style.SUCCESS(f'Перемещено веток: {moved}'))
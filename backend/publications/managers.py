@@ -0,0 +1,104 @@
+import operator
+from collections import Counter, defaultdict
+from functools import reduce
+
+from asgiref.sync import sync_to_async
+from django.db import router
+from django.db.models import F, Q
+from treebeard.mp_tree import MP_NodeManager, MP_NodeQuerySet, get_result_class
+
+from .aggregates import get_ancestor_paths, refresh_aggregates
+from .cache import tree_cache
+from .sharding import get_post_shard, use_shard
+from .sync import log_deletions, revision_clock
+
+
+class CommentQuerySet(MP_NodeQuerySet):
+    """
+    QuerySet комментариев, в котором дерево каждого поста хранится в собственном пространстве путей.
+
+    ## Methods:
+    - delete: Удаляет узлы вместе с потомками и уменьшает `numchild` родителей, не затрагивая другие посты.
+    Агрегаты веток предков пересчитываются, удаленные ветки записываются в журнал удалений
+    для синхронизации клиентов и сбрасываются в кэше деревьев. Все запросы выполняются на базе данных QuerySet.
+    - with_authors: Загружает авторов тем же запросом, если они хранятся в той же базе данных, что и комментарии.
+    """
+
+    def with_authors(self):
+        user_model = self.model._meta.get_field('user').related_model
+        if self.db != router.db_for_read(user_model):
+            return self
+        return self.select_related('user')
+
+    def delete(self, *args, **kwargs):
+        with use_shard(self.db):
+            return self._delete(*args, **kwargs)
+
+    def _delete(self, *args, **kwargs):
+        removed = self.get_removed_branches()
+        model = get_result_class(self.model)
+        parents = Counter()
+        toremove = []
+        for (post_id, path), node in removed.items():
+            parentpath = node._get_parent_path_from_path(path)
+            if parentpath:
+                parents[(post_id, parentpath)] += 1
+            toremove.append(Q(post_id=post_id, path=path) if node.is_leaf() else Q(post_id=post_id, path__startswith=path))
+
+        for (post_id, parentpath), count in parents.items():
+            model.objects.filter(post_id=post_id, path=parentpath).update(
+                numchild=F('numchild') - count, revision=revision_clock.next(),
+            )
+
+        qset = model.objects.filter(reduce(operator.or_, toremove)) if toremove else model.objects.none()
+        result = super(MP_NodeQuerySet, qset).delete(*args, **kwargs)
+        self.after_delete(model, removed)
+        return result
+
+    def get_removed_branches(self):
+        """Возвращает верхние узлы удаляемых веток {(post_id, path): узел}: потомки удаляются вместе с ними."""
+        removed = {}
+        for node in self.order_by('post_id', 'depth', 'path'):
+            ancestors = {(node.post_id, node._get_basepath(node.path, depth)) for depth in range(1, node.depth)}
+            if ancestors.isdisjoint(removed):
+                removed[(node.post_id, node.path)] = node
+        return removed
+
+    @staticmethod
+    def after_delete(model, removed):
+        """Записывает удаленные ветки в журнал удалений, пересчитывает агрегаты предков и сбрасывает кэш деревьев."""
+        if removed:
+            log_deletions(model, removed.values())
+        ancestors = defaultdict(set)
+        for post_id, path in removed:
+            ancestors[post_id].update(get_ancestor_paths(model, path))
+        for post_id, paths in ancestors.items():
+            refresh_aggregates(model, post_id, list(paths))
+        for post_id, path in removed:
+            tree_cache.invalidate_branch(model, post_id, path)
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class CommentManager(MP_NodeManager):
+    """
+    Менеджер комментариев, упорядочивающий узлы по посту и пути.
+
+    ## Methods:
+    - for_post: Возвращает комментарии поста с базы данных его шарда (см. `publications.sharding`).
+    - afor_post: Асинхронная версия `for_post`: размещение поста читается в потоке.
+    - with_authors: См. `CommentQuerySet.with_authors`.
+    """
+
+    def get_queryset(self):
+        return CommentQuerySet(self.model, using=self._db, hints=self._hints).order_by('post_id', 'path')
+
+    def for_post(self, post_id):
+        return self.get_queryset().using(get_post_shard(self.model, post_id)).filter(post_id=post_id)
+
+    async def afor_post(self, post_id):
+        return self.get_queryset().using(await sync_to_async(get_post_shard)(self.model, post_id)).filter(post_id=post_id)
+
+    def with_authors(self):
+        return self.get_queryset().with_authors()
@@ -0,0 +1,145 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+current_metrics = ContextVar('comments_tree_metrics', default=None)
+
+DURATION_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+NODE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class RequestMetrics:
+    """
+    Метрики одного запроса: время по этапам в миллисекундах, количество запросов к БД,
+    количество загруженных узлов дерева и их максимальная глубина.
+
+    ## Methods:
+    - add: Прибавляет длительность к этапу.
+    - add_query: Учитывает выполненный SQL-запрос.
+    - add_nodes: Учитывает загруженные узлы дерева.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.queries = 0
+        self.nodes = 0
+        self.max_depth = 0
+        self.active = set()
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds * 1000
+
+    def add_query(self, seconds):
+        self.queries += 1
+        self.add('sql', seconds)
+
+    def add_nodes(self, nodes):
+        for node in nodes:
+            self.nodes += 1
+            if node.depth > self.max_depth:
+                self.max_depth = node.depth
+
+
+def instrumented(name):
+    """
+    Декоратор, учитывающий время выполнения функции в этапе `name` метрик текущего запроса.
+    Если метрики не собираются, добавляет к вызову только чтение ContextVar.
+    Вложенные вызовы того же этапа учитываются один раз.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = current_metrics.get()
+            if metrics is None or name in metrics.active:
+                return func(*args, **kwargs)
+            metrics.active.add(name)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.add(name, time.perf_counter() - start)
+                metrics.active.discard(name)
+        return wrapper
+    return decorator
+
+
+def record_nodes(nodes):
+    """Учитывает загруженные узлы дерева, если для текущего запроса собираются метрики."""
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add_nodes(nodes)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин.
+
+    ## Methods:
+    - observe: Учитывает значение.
+    - snapshot: Возвращает накопленные значения корзин в формате Prometheus (`le`), сумму и количество.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets, total = {}, 0
+        for bound, count in zip((*map(str, self.bounds), '+Inf'), self.counts):
+            total += count
+            buckets[bound] = total
+        return {'buckets': buckets, 'sum': round(self.sum, 3), 'count': self.count}
+
+
+class MetricsRegistry:
+    """
+    Потокобезопасное хранилище гистограмм метрик запросов в памяти процесса, сгруппированных по имени view.
+
+    ## Methods:
+    - observe: Добавляет метрики запроса.
+    - snapshot: Возвращает гистограммы всех view.
+    - reset: Удаляет накопленные данные.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def observe(self, view_name, metrics):
+        values = {f'{name}_ms': (value, DURATION_BUCKETS) for name, value in metrics.timings.items()}
+        values.update({
+            'queries': (metrics.queries, COUNT_BUCKETS),
+            'nodes': (metrics.nodes, NODE_BUCKETS),
+            'max_depth': (metrics.max_depth, DEPTH_BUCKETS),
+        })
+        with self._lock:
+            histograms = self._views.setdefault(view_name, {})
+            for name, (value, bounds) in values.items():
+                if name not in histograms:
+                    histograms[name] = Histogram(bounds)
+                histograms[name].observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                view_name: {name: histogram.snapshot() for name, histogram in sorted(histograms.items())}
+                for view_name, histograms in sorted(self._views.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+
+
+metrics_registry = MetricsRegistry()
@@ -0,0 +1,114 @@
+import time
+from contextlib import ExitStack
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+
+from .conf import get_setting
+from .metrics import RequestMetrics, current_metrics, metrics_registry
+
+SERVER_TIMING_ORDER = ('sql', 'tree', 'serialize', 'render', 'total')
+
+
+def format_server_timing(metrics):
+    """
+    Формирует значение заголовка Server-Timing из метрик запроса.
+
+    ## Returns:
+    - str: Например `sql;dur=1.2;desc="3 queries", tree;dur=4.5;desc="31 nodes, depth 3", total;dur=9.1`.
+    """
+    descriptions = {
+        'sql': f'{metrics.queries} queries',
+        'tree': f'{metrics.nodes} nodes, depth {metrics.max_depth}',
+    }
+    entries = []
+    for name in SERVER_TIMING_ORDER:
+        if name in metrics.timings:
+            entry = f'{name};dur={metrics.timings[name]:.3f}'
+            if name in descriptions:
+                entry += f';desc="{descriptions[name]}"'
+            entries.append(entry)
+    return ', '.join(entries)
+
+
+class TreeMetricsMiddleware:
+    """
+    Собирает метрики запросов: количество и время SQL-запросов, время загрузки дерева, сериализации
+    и рендеринга, количество узлов и максимальную глубину. Метрики отдаются в заголовке `Server-Timing`
+    и накапливаются в `metrics_registry`.
+
+    Работает, только если включена настройка `COMMENTS_TREE['METRICS']`; иначе запрос
+    передается дальше без изменений. Поддерживает асинхронные представления: запросы асинхронного ORM
+    учитываются в потоке запроса, где они выполняются.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not get_setting('METRICS'):
+            return self.get_response(request)
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with self.wrap_connections(metrics):
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, response, metrics, start)
+
+    async def __acall__(self, request):
+        if not get_setting('METRICS'):
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            stack = await sync_to_async(self.wrap_connections)(metrics)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(stack.close)()
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, response, metrics, start)
+
+    def wrap_connections(self, metrics):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(partial(self.execute, metrics)))
+        return stack
+
+    def finish(self, request, response, metrics, start):
+        metrics.add('total', time.perf_counter() - start)
+        if request.resolver_match is not None:
+            metrics_registry.observe(request.resolver_match.view_name, metrics)
+        response.headers['Server-Timing'] = format_server_timing(metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        metrics = current_metrics.get()
+        if metrics is not None:
+            start = time.perf_counter()
+
+            def record_render(response):
+                metrics.add('render', time.perf_counter() - start)
+
+            response.add_post_render_callback(record_render)
+        return response
+
+    @staticmethod
+    def execute(metrics, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            metrics.add_query(time.perf_counter() - start)
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.14 on 2026-10-18 20:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('post_id', models.BigIntegerField()),
+                ('comment_id', models.BigIntegerField()),
+                ('path', models.CharField(max_length=255)),
+                ('revision', models.BigIntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'post_id', 'revision'], name='publications_deletion_idx'), models.Index(fields=['revision'], name='publications_deletion_rev_idx')],
+            },
+        ),
+    ]
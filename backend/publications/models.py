@@ -1,12 +1,43 @@
+from functools import partial
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from treebeard.mp_tree import MP_Node
+from treebeard.mp_tree import MP_Node, get_result_class
 
-from .serializers import create_comment_node_serializer, create_post_comment_serializer
+from .handlers import (PostAddChildHandler, PostAddRootHandler,
+                       PostAddSiblingHandler, PostMoveHandler)
+from .aio import aload_nodes, run_in_pool
+from .aggregates import rebuild_aggregates, register_insert, register_votes
+from .cache import tree_cache
+from .collapsing import get_collapsed_tree
+from .compaction import compact_tombstones
+from .conf import get_setting
+from .feed import load_comment_summaries
+from .flat import load_flat_tree
+from .importing import import_comments
+from .live import publish_event
+from .managers import CommentManager
+from .pagination import get_tree_page
+from .permalink import get_permalink_tree
+from .ranking import ranking_queue
+from .scoring import get_scorer, sort_tree
+from .search import search_comments
+from .serializers import create_post_comment_serializer, get_compiled_node_serializer
+from .sharding import allocate_ids, get_shards, is_sharded, on_post_shard, use_shard
+from .streaming import iter_post_json, iter_tree_json
+from .storage import get_tree_storage
+from .sync import get_changes, revision_clock
+from .votes import apply_votes, vote_buffer
 
 User = get_user_model()
 
+# Методы, работающие с деревом одного поста, выполняются на шарде этого поста (см. `publications.sharding`).
+post_tree = on_post_shard(lambda post, *args, **kwargs: (post.comments.model, post.pk))
+comment_tree = on_post_shard(lambda node, *args, **kwargs: (node.__class__, node.post_id))
+
 
 class AbstractPost(models.Model):
     """
@@ -14,7 +45,32 @@ class AbstractPost(models.Model):
 
     ## Methods:
     - get_post_with_comments: Возвращает сериализованные данные поста, включая всё дерево комментариев.
+    Параметры дерева передаются в `get_comments_tree`.
+    - get_comment_summaries: Возвращает для ленты постов число комментариев, последнюю активность и лучшие
+    комментарии первого уровня, загруженные одним запросом на шард для всей страницы (см. `publications.feed`).
     - get_comments_tree: Создает и возвращает сериализованные данные дерева комментариев, начиная с комментариев первого уровня.
+    Всё дерево загружается одним запросом и собирается в памяти. Если включен `COMMENTS_TREE['TREE_CACHE']`,
+    ветки первого уровня кэшируются отдельно и сериализуются заново только после изменения.
+    Параметр `sort` упорядочивает братьев по оценкам из `publications.scoring` (top, new, hot, controversial, wilson),
+    вычисленным для всех загруженных узлов сразу. Параметры `min_rating` и `max_depth` сворачивают ветки
+    с рейтингом ниже порога и ответы глубже отсечки в заглушки с количеством скрытых комментариев и курсором;
+    строки свернутых веток не загружаются.
+    - aget_post_with_comments, aget_comments_tree: Асинхронные версии для ASGI. Комментарии загружаются
+    асинхронным ORM, а сборка, сортировка и сериализация дерева выполняются в пуле потоков `publications.aio`.
+    Дерево, уже лежащее в кэше, читается асинхронным API кэша; при промахе кэша и для свернутых веток
+    дерево строится синхронной версией в потоке запроса.
+    - render_tree_nodes: Собирает, сортирует и сериализует загруженные узлы поста.
+    - get_flat_comments_tree: Возвращает дерево поста в плоском формате: параллельные списки колонок в порядке путей
+    с индексами родителей (см. `publications.flat`). Строки читаются кортежами, без объектов и словарей для узлов.
+    - render_sorted_tree: Сериализует дерево поста, упорядоченное оценщиком.
+    - render_collapsed_tree: Сериализует дерево поста со свернутыми ветками (см. `publications.collapsing`).
+    - render_comment_branches: Сериализует ветки первого уровня с указанными путями.
+    - stream_comments_tree: Генерирует JSON дерева комментариев частями, читая строки серверным итератором.
+    - stream_post_with_comments: Генерирует JSON поста с деревом комментариев частями.
+    - get_comments_tree_page: Возвращает страницу дерева с ограничением глубины и числа детей
+    и курсорами для продолжения.
+    - get_comment_changes: Возвращает комментарии, созданные, измененные или удаленные после курсора синхронизации,
+    с путями для обновления дерева на клиенте (см. `publications.sync`).
 
     ## Attributes:
     - created_at (`DateTimeField`): Дата и время создания поста.
@@ -37,56 +93,349 @@ class AbstractPost(models.Model):
         ordering = ('-created_at',)
         abstract = True
 
-    def get_post_with_comments(self):
+    def get_post_with_comments(self, **options):
+        serializer_class = create_post_comment_serializer(self.__class__)
+        return serializer_class(self, context={'tree_options': options}).data
+
+    async def aget_post_with_comments(self, **options):
+        comments = await self.aget_comments_tree(**options)
+        serializer_class = create_post_comment_serializer(self.__class__)
+        return serializer_class(self, context={'comments': comments}).data
+
+    @classmethod
+    def get_comment_summaries(cls, post_ids, top_comments=None):
+        top_comments = get_setting('FEED_TOP_COMMENTS') if top_comments is None else top_comments
+        return load_comment_summaries(cls._meta.get_field('comments').related_model, post_ids, top_comments)
+
+    @post_tree
+    def get_comments_tree(self, sort=None, min_rating=None, max_depth=None):
+        if sort is not None or min_rating is not None or max_depth is not None:
+            scorer = get_scorer(sort) if sort is not None else None
+            if min_rating is None and max_depth is None:
+                render = partial(self.render_sorted_tree, scorer)
+            else:
+                render = partial(self.render_collapsed_tree, min_rating, max_depth, scorer)
+            if tree_cache.enabled:
+                return tree_cache.get_tree_variant(self, tree_cache.get_variant_name(sort, min_rating, max_depth), render)
+            return render()
+        if tree_cache.enabled:
+            return tree_cache.get_post_tree(self, self.render_comment_branches)
+        comments = get_tree_storage(self.comments.model).load_post_tree(self)
+        return get_compiled_node_serializer(self.comments.model).serialize(comments)
+
+    @post_tree
+    async def aget_comments_tree(self, sort=None, min_rating=None, max_depth=None):
+        if tree_cache.enabled:
+            data = await tree_cache.aget_cached_tree(self, tree_cache.get_variant_name(sort, min_rating, max_depth))
+            if data is not None:
+                return data
+        # Промах кэша и свернутые деревья собираются синхронной версией в потоке запроса,
+        # в котором асинхронный ORM Django выполняет и остальные запросы.
+        if tree_cache.enabled or min_rating is not None or max_depth is not None:
+            return await sync_to_async(self.get_comments_tree)(sort, min_rating, max_depth)
+        scorer = get_scorer(sort) if sort is not None else None
+        nodes = await aload_nodes(get_tree_storage(self.comments.model).get_post_queryset(self))
+        return await run_in_pool(self.render_tree_nodes, nodes, scorer)
+
+    @post_tree
+    def get_flat_comments_tree(self):
+        if tree_cache.enabled:
+            return tree_cache.get_tree_variant(self, 'flat', self.render_flat_tree)
+        return self.render_flat_tree()
+
+    def render_flat_tree(self):
+        return load_flat_tree(self.comments.all())
+
+    def render_tree_nodes(self, nodes, scorer=None):
+        comments = get_tree_storage(self.comments.model).assemble(nodes)
+        if scorer is not None:
+            comments = sort_tree(comments, scorer)
+        return get_compiled_node_serializer(self.comments.model).serialize(comments)
+
+    def render_sorted_tree(self, scorer):
+        comments = sort_tree(get_tree_storage(self.comments.model).load_post_tree(self), scorer)
+        return get_compiled_node_serializer(self.comments.model).serialize(comments)
+
+    def render_collapsed_tree(self, min_rating=None, max_depth=None, scorer=None):
+        node_serializer = get_compiled_node_serializer(self.comments.model)
+        return get_collapsed_tree(node_serializer, self.comments.all(), min_rating, max_depth, scorer)
+
+    def stream_comments_tree(self):
+        nodes = self.comments.with_authors().order_by('path').iterator(get_setting('STREAM_BATCH_SIZE'))
+        return iter_tree_json(nodes, get_compiled_node_serializer(self.comments.model))
+
+    def stream_post_with_comments(self):
         serializer_class = create_post_comment_serializer(self.__class__)
-        return serializer_class(self).data
+        return iter_post_json(self, serializer_class, self.stream_comments_tree())
+
+    @post_tree
+    def get_comment_changes(self, cursor=None, limit=1000):
+        node_serializer = get_compiled_node_serializer(self.comments.model, exclude=('children',))
+        return get_changes(node_serializer, self.comments.all(), self.pk, cursor, limit)
+
+    @post_tree
+    def get_comments_tree_page(self, cursor=None, **params):
+        node_serializer = get_compiled_node_serializer(self.comments.model)
+        return get_tree_page(node_serializer, self.comments.all(), '', cursor, **params)
+
+    def render_comment_branches(self, paths=None):
+        comments = get_tree_storage(self.comments.model).load_branches(self, paths)
+        data = get_compiled_node_serializer(self.comments.model).serialize(comments)
+        return {comment.path: branch for comment, branch in zip(comments, data)}
 
-    def get_comments_tree(self):
-        comments = self.comments.filter(depth=1)
-        serializer_class = create_comment_node_serializer(self.comments.model)
-        return serializer_class(comments, many=True).data
+
+class CommentDeletion(models.Model):
+    """
+    Журнал удаленных веток комментариев для синхронизации клиентов (см. `publications.sync`).
+    Записи старше `COMMENTS_TREE['SYNC_RETENTION']` удаляются; клиент с более старым курсором загружает дерево заново.
+
+    ## Attributes:
+    - model (`CharField`): Метка модели комментария, например `usage.comment`.
+    - post_id (`BigIntegerField`): Идентификатор поста.
+    - comment_id (`BigIntegerField`): Идентификатор удаленного комментария.
+    - path (`CharField`): Путь удаленного комментария.
+    - revision (`BigIntegerField`): Ревизия удаления.
+    """
+    model = models.CharField(max_length=100)
+    post_id = models.BigIntegerField()
+    comment_id = models.BigIntegerField()
+    path = models.CharField(max_length=255)
+    revision = models.BigIntegerField()
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('model', 'post_id', 'revision'), name='publications_deletion_idx'),
+            models.Index(fields=('revision',), name='publications_deletion_rev_idx'),
+        )
+
+
+class PostShard(models.Model):
+    """
+    Размещение деревьев комментариев по шардам (см. `publications.sharding`). Хранится в базе данных по умолчанию.
+
+    ## Attributes:
+    - model (`CharField`): Метка модели комментария, например `usage.comment`.
+    - post_id (`BigIntegerField`): Идентификатор поста.
+    - database (`CharField`): Псевдоним базы данных шарда.
+    """
+    model = models.CharField(max_length=100)
+    post_id = models.BigIntegerField()
+    database = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(fields=('model', 'post_id'), name='publications_postshard_uniq'),
+        )
+
+
+class CommentSequence(models.Model):
+    """
+    Общая последовательность идентификаторов шардируемых комментариев. Строки удаляются сразу после выдачи
+    идентификаторов, таблица хранит только счетчик.
+    """
 
 
 class AbstractComment(MP_Node):
     """
     Абстрактный класс модели комментария, предоставляющий базовую структуру для комментариев.
     Этот класс используется как базовый для создания конкретных моделей комментариев.
+    Каждый пост хранит собственное дерево: пути уникальны только в пределах поста,
+    поэтому вставка, перенос и удаление узлов затрагивают только строки этого поста.
 
     ## Methods:
-    - save: Изменяет атрибут inverted_rating для используемого для сортировки.
+    - save: Изменяет атрибут inverted_rating для используемого для сортировки и сбрасывает кэш ветки.
+    Если у нового комментария нет голосов, они выводятся из начального рейтинга.
+    Новый комментарий записывается сразу с `last_activity`, равным времени создания, и учитывается
+    в агрегатах ветки (`descendant_count`, `max_subtree_rating`, `last_activity`) всех его предков одним запросом и публикуется подписчикам поста (см. `publications.live`).
+    - publish_created: Публикует событие `comment` с сериализованным комментарием, его путем и родителем.
+    - tombstone: Удаляет комментарий, оставляя его заглушкой: одним запросом заполняет `deleted_at`,
+    не затрагивая потомков и `numchild` родителя. В ответах с деревом поля `tombstone_fields` заглушки равны None.
+    - compact_tombstones: Физически удаляет ветки, в которых все комментарии удалены дольше
+    `COMMENTS_TREE['TOMBSTONE_RETENTION']` секунд (см. `publications.compaction`).
     - get_comments_deeper_from_node: Возвращает сериализованные данные комментариев,
-    начиная с текущего узла дерева комментариев c порядком сортировки по рейтингу от высокого к низкому.
+    начиная с текущего узла дерева комментариев c порядком сортировки по рейтингу от высокого к низкому
+    или по сортировке `sort`. Все потомки узла загружаются одним запросом, результат кэшируется до изменения ветки.
+    - aget_comments_deeper_from_node: Асинхронная версия для ASGI, сериализующая ветку в пуле потоков `publications.aio`.
+    Ветка, уже лежащая в кэше, читается асинхронным API кэша.
+    - render_subtree_nodes: Подвешивает загруженных потомков к узлу и сериализует ветку.
+    - get_flat_subtree: Возвращает ветку, начиная с узла, в плоском формате `publications.flat`.
+    - get_permalink_tree: Возвращает страницу комментария по постоянной ссылке: цепочку предков от комментария
+    первого уровня и ветку комментария не глубже `max_depth` уровней, загруженные одним запросом
+    (см. `publications.permalink`). Результат кэшируется до изменения ветки первого уровня.
+    - get_children_page: Возвращает страницу ответов на комментарий с ограничением глубины и числа детей.
     - add_point: Увеличивает рейтинг комментария на один.
     - cut_point: Уменьшает рейтинг комментария на один.
     - point_operation: Статический метод для обработки операций изменения рейтинга. Принимает экземпляр комментария и операнд ('+' или '-').
+    Рейтинг изменяется атомарно на стороне базы данных, а при `COMMENTS_TREE['VOTE_BUFFER']` голоса
+    накапливаются в буфере процесса и записываются пачкой. Если пути упорядочены по рейтингу,
+    комментарий отмечается в `ranking_queue`, которая позже переупорядочивает его братьев по новому рейтингу.
+    Лучший рейтинг веток предков обновляется вместе с голосом, а подписчикам поста публикуется событие `vote`.
+    - get_sorted_pos_queryset: Учитывает рейтинг нового узла при вставке среди отсортированных братьев.
+    - bulk_import: Импортирует в пост плоский список комментариев с ссылками на родителей,
+    вычисляя пути в памяти и записывая их через `bulk_create` (см. `publications.importing`).
+    - search: Полнотекстовый поиск по тексту комментариев с фрагментами совпадений, цепочками предков и постами
+    найденных комментариев (см. `publications.search`). Индекс создается операцией миграции `CreateSearchIndex`.
+    - get_post_root_nodes: Возвращает комментарии первого уровня указанного поста.
+    - add_root, add_child, add_sibling, move, get_tree и навигация по дереву: Методы treebeard,
+    ограниченные деревом поста.
 
     ## Attributes:
+    - path (`CharField`): Материализованный путь узла, уникальный в пределах поста.
     - created_at (`DateTimeField`): Дата и время создания комментария.
     - user (`ForeignKey`): Ссылка на пользователя, являющегося автором комментария.
     - post (`ForeignKey`): Ссылка на пост, к которому относится комментарий.
     - text (`TextField`): Текст комментария.
     - rating (`IntegerField`): Рейтинг комментария.
     - inverted_rating (`IntegerField`): Инвертированный рейтинг комментария для сортировки.
+    - upvotes (`PositiveIntegerField`): Количество голосов «за».
+    - downvotes (`PositiveIntegerField`): Количество голосов «против».
+    - descendant_count (`PositiveIntegerField`): Количество всех потомков комментария.
+    - max_subtree_rating (`IntegerField`): Максимальный рейтинг среди потомков или None, если ответов нет.
+    - last_activity (`DateTimeField`): Время создания самого нового комментария в ветке, включая сам комментарий.
+    - revision (`BigIntegerField`): Ревизия последнего изменения строки из `revision_clock`. Обновляется тем же
+    запросом, что и любое изменение комментария: вставка, голос, агрегаты, перенос и переупорядочивание путей.
+    - deleted_at (`DateTimeField`): Время удаления комментария или None, если комментарий не удален.
     - node_order_by (`tuple`): Порядок сортировки узлов в дереве комментариев.
+    - tombstone_fields (`tuple`): Поля, которые не выводятся у удаленного комментария.
+    - shard_by_post (`bool`): Распределять деревья постов по базам данных `COMMENTS_TREE['SHARDS']`
+    (см. `publications.sharding`). Методы дерева выполняются на шарде поста, а идентификаторы выдаются
+    общей последовательностью `CommentSequence`.
+    - tree_storage (`str`): Путь к стратегии хранения дерева (см. `publications.storage`): `PathStorage`
+    с путями, упорядоченными по рейтингу, или `AdjacencyStorage` со списком смежности и рекурсивным CTE.
+
+    ## Meta:
+    - constraints: Уникальность пути в пределах поста.
+    - indexes: Составной индекс (post, depth, path) для выборки веток поста, (post, revision)
+    для выборки изменений поста и частичный индекс удаленных комментариев для очистки.
     """
-    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    path = models.CharField(max_length=255)
+    created_at = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments', verbose_name=_('автор комментария'))
     post = models.ForeignKey(AbstractPost, on_delete=models.CASCADE, related_name='comments', verbose_name=_('комментарии к посту'))
     text = models.TextField(_('текст комментария'))
     rating = models.IntegerField(_('рейтинг комментария'), default=0)
     inverted_rating = models.IntegerField(_('рейтинг комментария'), default=0, editable=False)
+    upvotes = models.PositiveIntegerField(_('голосов «за»'), default=0, editable=False)
+    downvotes = models.PositiveIntegerField(_('голосов «против»'), default=0, editable=False)
+    descendant_count = models.PositiveIntegerField(_('количество ответов в ветке'), default=0, editable=False)
+    max_subtree_rating = models.IntegerField(_('лучший рейтинг в ветке'), null=True, blank=True, editable=False)
+    last_activity = models.DateTimeField(_('последняя активность в ветке'), null=True, blank=True, editable=False)
+    revision = models.BigIntegerField(_('ревизия'), default=0, editable=False)
+    deleted_at = models.DateTimeField(_('дата удаления'), null=True, blank=True, editable=False)
     node_order_by = ('inverted_rating',)
+    tombstone_fields = ('user', 'text')
+    tree_storage = 'publications.storage.PathStorage'
+    shard_by_post = False
+
+    objects = CommentManager()
 
     class Meta:
         abstract = True
+        constraints = (
+            models.UniqueConstraint(fields=('post', 'path'), name='%(app_label)s_%(class)s_post_path_uniq'),
+        )
+        indexes = (
+            models.Index(fields=('post', 'depth', 'path'), name='%(app_label)s_%(class)s_pdp_idx'),
+            models.Index(fields=('post', 'revision'), name='%(app_label)s_%(class)s_prev_idx'),
+            models.Index(
+                fields=('deleted_at',), condition=models.Q(deleted_at__isnull=False),
+                name='%(app_label)s_%(class)s_tomb_idx',
+            ),
+        )
 
+    @comment_tree
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding and self.pk is None and is_sharded(self.__class__):
+            self.pk = allocate_ids(1)[0]
+            kwargs.setdefault('force_insert', True)
         self.inverted_rating = -self.rating
+        self.revision = revision_clock.next()
+        if adding and not (self.upvotes or self.downvotes):
+            self.upvotes, self.downvotes = max(self.rating, 0), max(-self.rating, 0)
+        if adding:
+            self.last_activity = self.created_at
+            get_tree_storage(self.__class__).prepare_insert(self)
         super().save(*args, **kwargs)
+        if adding:
+            register_insert(self)
+            self.publish_created()
+        tree_cache.invalidate_branch(self.__class__, self.post_id, self.path)
+
+    def publish_created(self):
+        parent = self.get_parent() if self.depth > 1 else None
+        data = get_compiled_node_serializer(self.__class__, exclude=('children',)).to_representation(self)
+        data.update(path=self.path, parent=parent.pk if parent else None)
+        publish_event(self.__class__, self.post_id, {'type': 'comment', 'id': self.pk, 'comment': data})
+
+    @property
+    def is_tombstone(self):
+        return self.deleted_at is not None
+
+    @comment_tree
+    def tombstone(self):
+        if self.is_tombstone:
+            return
+        self.deleted_at = timezone.now()
+        self.revision = revision_clock.next()
+        get_result_class(self.__class__).objects.filter(pk=self.pk).update(deleted_at=self.deleted_at, revision=self.revision)
+        tree_cache.invalidate_branch(self.__class__, self.post_id, self.path)
+        publish_event(self.__class__, self.post_id, {'type': 'delete', 'id': self.pk})
+
+    @comment_tree
+    def get_comments_deeper_from_node(self, sort=None):
+        scorer = get_scorer(sort) if sort is not None else None
+        if tree_cache.enabled:
+            return tree_cache.get_subtree(self, partial(self.render_subtree, scorer), sort)
+        return self.render_subtree(scorer)
 
-    def get_comments_deeper_from_node(self):
-        serializer_class = create_comment_node_serializer(self.__class__)
-        return serializer_class(self).data
+    @comment_tree
+    async def aget_comments_deeper_from_node(self, sort=None):
+        if tree_cache.enabled:
+            data = await tree_cache.aget_cached_subtree(self, sort)
+            if data is None:
+                data = await sync_to_async(self.get_comments_deeper_from_node)(sort)
+            return data
+        scorer = get_scorer(sort) if sort is not None else None
+        storage = get_tree_storage(self.__class__)
+        descendants = [] if self.is_leaf() else await aload_nodes(storage.get_descendants_queryset(self))
+        return await run_in_pool(self.render_subtree_nodes, descendants, scorer)
+
+    @comment_tree
+    def get_flat_subtree(self):
+        if tree_cache.enabled:
+            return tree_cache.get_branch_data(self, self.render_flat_subtree, 'flat', self.pk)
+        return self.render_flat_subtree()
+
+    def render_flat_subtree(self):
+        return load_flat_tree(self.__class__.objects.filter(post_id=self.post_id, path__startswith=self.path))
+
+    def render_subtree_nodes(self, descendants, scorer=None):
+        get_tree_storage(self.__class__).assemble(descendants, root=self)
+        if scorer is not None:
+            sort_tree([self], scorer)
+        return get_compiled_node_serializer(self.__class__).to_representation(self)
+
+    @comment_tree
+    def get_permalink_tree(self, max_depth=None):
+        if tree_cache.enabled:
+            return tree_cache.get_permalink(self, partial(self.render_permalink_tree, max_depth), max_depth)
+        return self.render_permalink_tree(max_depth)
+
+    def render_permalink_tree(self, max_depth=None):
+        return get_permalink_tree(get_compiled_node_serializer(self.__class__), self, max_depth)
+
+    @comment_tree
+    def get_children_page(self, cursor=None, **params):
+        node_serializer = get_compiled_node_serializer(self.__class__)
+        queryset = self.__class__.objects.filter(post_id=self.post_id)
+        return get_tree_page(node_serializer, queryset, self.path, cursor, **params)
+
+    def render_subtree(self, scorer=None):
+        node = get_tree_storage(self.__class__).load_subtree(self)
+        if scorer is not None:
+            sort_tree([node], scorer)
+        return get_compiled_node_serializer(self.__class__).to_representation(node)
 
     def add_point(self):
         self.point_operation(self, '+')
@@ -95,10 +444,132 @@ class AbstractComment(MP_Node):
         self.point_operation(self, '-')
 
     @staticmethod
+    @comment_tree
     def point_operation(instance, operand: str):
         operations = {
-            '+': lambda x: x + 1,
-            '-': lambda x: x - 1,
+            '+': 1,
+            '-': -1,
         }
-        instance.rating = operations[operand](instance.rating)
-        instance.save()
+        delta = operations[operand]
+        if get_setting('VOTE_BUFFER'):
+            vote_buffer.add(instance.__class__, instance.pk, delta)
+        else:
+            apply_votes(instance.__class__, {instance.pk: (1, 0) if delta > 0 else (0, 1)})
+            if instance.depth > 1:
+                register_votes(instance.__class__, {instance.pk: delta})
+            tree_cache.invalidate_branch(instance.__class__, instance.post_id, instance.path)
+        instance.rating += delta
+        instance.inverted_rating = -instance.rating
+        if delta > 0:
+            instance.upvotes += 1
+        else:
+            instance.downvotes += 1
+        if get_tree_storage(instance.__class__).sorted_paths:
+            ranking_queue.mark(instance)
+        publish_event(instance.__class__, instance.post_id, {
+            'type': 'vote', 'id': instance.pk, 'delta': delta, 'upvotes': int(delta > 0), 'downvotes': int(delta < 0),
+        })
+
+    def get_sorted_pos_queryset(self, siblings, newobj):
+        newobj.inverted_rating = -newobj.rating
+        return super().get_sorted_pos_queryset(siblings, newobj)
+
+    @classmethod
+    @on_post_shard(lambda cls, **kwargs: (cls, kwargs['instance'].post_id if 'instance' in kwargs else kwargs['post'].pk))
+    def add_root(cls, **kwargs):
+        node = PostAddRootHandler(cls, **kwargs).process()
+        tree_cache.invalidate_post(cls, node.post_id)
+        return node
+
+    @classmethod
+    @on_post_shard(lambda cls, post, *args, **kwargs: (cls, post.pk))
+    def bulk_import(cls, post, items, batch_size=None):
+        return import_comments(get_result_class(cls), post, items, batch_size)
+
+    @classmethod
+    def compact_tombstones(cls, older_than=None, batch_size=None):
+        model_class = get_result_class(cls)
+        if not is_sharded(model_class):
+            return compact_tombstones(model_class, older_than, batch_size)
+        removed = 0
+        for alias in get_shards():
+            with use_shard(alias):
+                removed += compact_tombstones(model_class, older_than, batch_size)
+        return removed
+
+    @classmethod
+    def search(cls, query, post_id=None, limit=None):
+        return search_comments(get_result_class(cls), query, post_id, limit or get_setting('SEARCH_LIMIT'))
+
+    @classmethod
+    def get_root_nodes(cls):
+        return get_result_class(cls).objects.filter(depth=1).order_by('post_id', 'path')
+
+    @classmethod
+    def get_post_root_nodes(cls, post_id):
+        return get_result_class(cls).objects.filter(post_id=post_id, depth=1).order_by('path')
+
+    @classmethod
+    def get_tree(cls, parent=None):
+        cls = get_result_class(cls)
+        if parent is None:
+            return cls.objects.order_by('post_id', 'path')
+        if parent.is_leaf():
+            return cls.objects.db_manager(parent._state.db).filter(pk=parent.pk)
+        return cls.objects.db_manager(parent._state.db).filter(
+            post_id=parent.post_id, path__startswith=parent.path, depth__gte=parent.depth
+        ).order_by('path')
+
+    def get_siblings(self):
+        return super().get_siblings().filter(post_id=self.post_id).using(self._state.db)
+
+    def get_children(self):
+        return super().get_children().filter(post_id=self.post_id).using(self._state.db)
+
+    def get_root(self):
+        model_class = get_result_class(self.__class__)
+        return model_class.objects.db_manager(self._state.db).get(post_id=self.post_id, path=self.path[0:self.steplen])
+
+    def get_ancestors(self):
+        return super().get_ancestors().filter(post_id=self.post_id).using(self._state.db)
+
+    def get_parent(self, update=False):
+        parentpath = self._get_parent_path_from_path(self.path)
+        if not parentpath:
+            return None
+        if not update and hasattr(self, '_cached_parent_obj'):
+            return self._cached_parent_obj
+        model_class = get_result_class(self.__class__)
+        self._cached_parent_obj = model_class.objects.db_manager(self._state.db).get(post_id=self.post_id, path=parentpath)
+        return self._cached_parent_obj
+
+    def is_sibling_of(self, node):
+        return self.post_id == node.post_id and super().is_sibling_of(node)
+
+    def is_child_of(self, node):
+        return self.post_id == node.post_id and super().is_child_of(node)
+
+    def is_descendant_of(self, node):
+        return self.post_id == node.post_id and super().is_descendant_of(node)
+
+    @comment_tree
+    def add_child(self, **kwargs):
+        return PostAddChildHandler(self, **kwargs).process()
+
+    @comment_tree
+    def add_sibling(self, pos=None, **kwargs):
+        node = PostAddSiblingHandler(self, pos, **kwargs).process()
+        if self.is_root():
+            tree_cache.invalidate_post(self.__class__, self.post_id)
+        return node
+
+    @comment_tree
+    def delete(self, *args, **kwargs):
+        return super().delete(*args, **kwargs)
+
+    @comment_tree
+    def move(self, target, pos=None):
+        PostMoveHandler(self, target, pos).process()
+        get_tree_storage(self.__class__).after_move(self)
+        rebuild_aggregates(get_result_class(self.__class__), self.post_id)
+        tree_cache.invalidate_post(self.__class__, self.post_id)
@@ -0,0 +1,160 @@
+import base64
+import binascii
+
+from django.db.models import F, Q, Window
+from django.db.models.functions import Left, RowNumber
+
+from .metrics import instrumented, record_nodes
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# Порядок братьев на страницах дерева: по рейтингу, а при равном рейтинге по пути. Курсор хранит этот же ключ,
+# поэтому страницы не зависят от того, успела ли `ranking_queue` переупорядочить пути после голосов.
+PAGE_ORDER = ('inverted_rating', 'path')
+
+
+def get_page_key(node):
+    """Возвращает ключ сортировки узла на странице (`PAGE_ORDER`)."""
+    return node.inverted_rating, node.path
+
+
+def encode_cursor(path, inverted_rating=None):
+    """
+    Кодирует ключ сортировки последнего выданного узла в непрозрачный курсор.
+    Курсор без рейтинга указывает на начало уровня: выдаются узлы с путем больше `path`,
+    например все дети узла с этим путем.
+    """
+    key = path if inverted_rating is None else f'{inverted_rating}:{path}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def get_cursor_after(nodes, parent_path):
+    """
+    Возвращает курсор, с которого продолжается уровень после узлов `nodes` в порядке `PAGE_ORDER`,
+    независимо от порядка, в котором узлы выданы; без узлов — курсор начала детей узла `parent_path`.
+    """
+    if not nodes:
+        return encode_cursor(parent_path)
+    last = max(nodes, key=get_page_key)
+    return encode_cursor(last.path, last.inverted_rating)
+
+
+def decode_cursor(model_class, cursor):
+    """
+    Декодирует курсор и проверяет, что он содержит корректный путь дерева.
+
+    ## Returns:
+    - tuple: Ключ сортировки (inverted_rating, path) последнего выданного узла; inverted_rating равен None
+    у курсора начала уровня.
+
+    ## Raises:
+    - InvalidCursor: Если курсор поврежден.
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        inverted_rating, _, path = key.rpartition(':')
+        inverted_rating = int(inverted_rating) if inverted_rating else None
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise InvalidCursor(str(error))
+    if not path or len(path) % model_class.steplen or set(path) - set(model_class.alphabet):
+        raise InvalidCursor(path)
+    return inverted_rating, path
+
+
+@instrumented('tree')
+def load_tree_page(queryset, parent_path='', after=None, limit=20, max_depth=None, max_children=None):
+    """
+    Загружает страницу дерева: не более `limit` узлов одного уровня после курсора
+    и их потомков не глубже `max_depth` уровней, не более `max_children` детей на узел.
+    Братья упорядочены по `PAGE_ORDER`.
+    Каждый уровень загружается одним запросом по ключу `path`, дети ограничиваются оконной функцией,
+    поэтому число запросов и строк зависит только от параметров страницы, а не от размера ветки.
+
+    ## Args:
+    - queryset (QuerySet): Комментарии одного поста.
+    - parent_path (str): Путь родителя страницы; пустая строка означает комментарии первого уровня.
+    - after (tuple | None): Ключ сортировки последнего узла предыдущей страницы из `decode_cursor`.
+    - limit (int): Количество узлов верхнего уровня.
+    - max_depth (int | None): Количество загружаемых уровней, включая верхний.
+    - max_children (int | None): Максимальное количество детей у каждого узла.
+
+    ## Returns:
+    - tuple: Узлы верхнего уровня с заполненным `_cached_children` и признак наличия следующей страницы.
+    """
+    model_class = queryset.model
+    depth = len(parent_path) // model_class.steplen + 1
+    top = queryset.filter(depth=depth)
+    if parent_path:
+        top = top.filter(path__range=model_class._get_children_path_interval(parent_path))
+    if after:
+        inverted_rating, path = after
+        if inverted_rating is None:
+            top = top.filter(path__gt=path)
+        else:
+            top = top.filter(Q(inverted_rating__gt=inverted_rating) | Q(inverted_rating=inverted_rating, path__gt=path))
+    top = list(top.with_authors().order_by(*PAGE_ORDER)[:limit + 1])
+    has_more = len(top) > limit
+    top = top[:limit]
+    record_nodes(top)
+
+    level = top
+    for _ in range(1, max_depth or 1):
+        for node in level:
+            node._cached_children = []
+        parents = [node for node in level if node.numchild]
+        if not parents:
+            break
+        # Родители упорядочены по `PAGE_ORDER`, а диапазон детей строится по путям, поэтому границы — крайние пути.
+        paths = sorted(parent.path for parent in parents)
+        level = queryset.filter(
+            depth=depth + 1,
+            path__range=(paths[0], paths[-1] + model_class.alphabet[-1] * model_class.steplen),
+        ).annotate(
+            parent_path=Left('path', len(paths[0])),
+        ).filter(
+            parent_path__in=paths,
+        )
+        if max_children:
+            level = level.annotate(
+                position=Window(RowNumber(), partition_by=F('parent_path'), order_by=[F(name).asc() for name in PAGE_ORDER]),
+            ).filter(position__lte=max_children)
+        level = list(level.with_authors().order_by(*PAGE_ORDER))
+        record_nodes(level)
+        by_path = {parent.path: parent for parent in parents}
+        for node in level:
+            by_path[node.parent_path]._cached_children.append(node)
+        depth += 1
+    for node in level:
+        node._cached_children = []
+    return top, has_more
+
+
+def add_children_cursors(nodes, data):
+    """
+    Добавляет `children_cursor` в сериализованные узлы, дети которых выданы не полностью.
+    Курсор передается в запрос ветки узла, чтобы получить следующие ответы.
+    """
+    for node, item in zip(nodes, data):
+        children = node._cached_children
+        item['children_cursor'] = get_cursor_after(children, node.path) if len(children) < node.numchild else None
+        add_children_cursors(children, item['children'])
+
+
+def get_tree_page(node_serializer, queryset, parent_path='', cursor=None, **params):
+    """
+    Сериализует страницу дерева, загруженную `load_tree_page`, сериализатором `get_compiled_node_serializer`.
+
+    ## Returns:
+    - dict: `results` — сериализованные узлы верхнего уровня, `next` — курсор следующей страницы или None.
+    """
+    after = decode_cursor(queryset.model, cursor) if cursor else None
+    top, has_more = load_tree_page(queryset, parent_path, after, **params)
+    data = node_serializer.serialize(top)
+    add_children_cursors(top, data)
+    return {
+        'results': data,
+        'next': get_cursor_after(top[-1:], parent_path) if has_more else None,
+    }
@@ -0,0 +1,75 @@
+from django.db.models import Q
+
+from .aggregates import get_ancestor_paths
+from .collapsing import make_stub
+from .metrics import instrumented
+from .pagination import get_cursor_after
+from .tree import assemble_tree
+
+
+@instrumented('tree')
+def load_permalink_tree(node, max_depth=None):
+    """
+    Загружает одним запросом цепочку предков узла и его ветку. Предки выбираются по префиксам `path`,
+    ветка — диапазоном путей по уникальному индексу (post, path), поэтому братья предков не читаются.
+
+    ## Args:
+    - node (AbstractComment): Комментарий, на который ведет ссылка.
+    - max_depth (int | None): Количество загружаемых уровней ответов под узлом.
+
+    ## Returns:
+    - AbstractComment: Комментарий первого уровня, у каждого предка в `_cached_children` только следующий узел цепочки.
+    """
+    model_class = node.__class__
+    max_length = model_class._meta.get_field('path').max_length
+    # post_id повторяется в каждой части условия, чтобы обе части читались по индексу (post, path).
+    branch = Q(post_id=node.post_id, path__range=(node.path, node.path + model_class.alphabet[-1] * max_length))
+    if max_depth is not None:
+        branch &= Q(depth__lte=node.depth + max_depth)
+    ancestors = get_ancestor_paths(model_class, node.path)
+    if ancestors:
+        branch |= Q(post_id=node.post_id, path__in=ancestors)
+    nodes = model_class.objects.filter(branch).with_authors().order_by('path')
+    return assemble_tree(nodes)[0]
+
+
+def add_permalink_stubs(node, item, target):
+    """
+    Замыкает списки детей заглушками `make_stub`: `siblings` — у предков скрыты остальные ответы,
+    `depth` — ответы под узлом глубже отсечки. Курсор заглушки `depth` передается в запрос страницы детей узла.
+    """
+    while node is not None:
+        children = node._cached_children
+        hidden = node.numchild - len(children)
+        if hidden:
+            shown = sum(child.descendant_count + 1 for child in children)
+            if node.depth < target.depth:
+                stub = make_stub('siblings', hidden, node.descendant_count - shown, None)
+            else:
+                stub = make_stub('depth', hidden, node.descendant_count - shown, get_cursor_after(children, node.path))
+            item['children'].append(stub)
+        if node.depth >= target.depth:
+            for child, child_item in zip(children, item['children']):
+                add_permalink_stubs(child, child_item, target)
+            return
+        node, item = (children[0], item['children'][0]) if children else (None, None)
+
+
+def get_permalink_tree(node_serializer, node, max_depth=None):
+    """
+    Сериализует страницу комментария по постоянной ссылке: вложенную цепочку от комментария первого уровня
+    до комментария и его ветку не глубже `max_depth` уровней. Все узлы принадлежат одной ветке первого уровня,
+    поэтому результат можно кэшировать до изменения этой ветки.
+
+    ## Args:
+    - node_serializer (CompiledNodeSerializer): Сериализатор узлов.
+    - node (AbstractComment): Комментарий, на который ведет ссылка.
+    - max_depth (int | None): Количество уровней ответов под комментарием.
+
+    ## Returns:
+    - dict: Сериализованный комментарий первого уровня, в детях которого лежит следующий узел цепочки.
+    """
+    root = load_permalink_tree(node, max_depth)
+    data = node_serializer.to_representation(root)
+    add_permalink_stubs(root, data, node)
+    return data
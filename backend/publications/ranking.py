@@ -0,0 +1,229 @@
+import operator
+import threading
+from functools import reduce
+from itertools import groupby
+
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Concat, Substr
+from treebeard.exceptions import PathOverflow
+
+from .cache import tree_cache
+from .conf import get_setting
+from .sharding import current_shard, use_shard
+from .sync import revision_clock
+from .votes import vote_buffer
+
+# SQLite ограничивает глубину выражения, поэтому UPDATE с CASE по тысячам веток выполняется частями.
+REWRITE_BATCH_SIZE = 250
+
+
+def get_rank_moves(siblings):
+    """
+    Вычисляет, какие ветки нужно переместить, чтобы братья шли по убыванию рейтинга.
+    Братья с одинаковым рейтингом сохраняют текущий порядок, а занятые шаги пути переиспользуются.
+
+    ## Args:
+    - siblings (list): Пары (path, inverted_rating) одного родителя, упорядоченные по `path`.
+
+    ## Returns:
+    - list: Пары (старый путь, новый путь) только для перемещаемых веток.
+    """
+    ranked = sorted(siblings, key=operator.itemgetter(1))
+    return [
+        (path, new_path)
+        for (path, _), (new_path, _) in zip(ranked, siblings)
+        if path != new_path
+    ]
+
+
+def rewrite_branches(model_class, post_id, moves):
+    """
+    Запросами UPDATE по `REWRITE_BATCH_SIZE` веток переписывает префиксы путей у веток одного уровня
+    вместе со всеми потомками.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_id (int): Идентификатор поста, в дереве которого выполняется перемещение.
+    - moves (list): Пары (старый путь, новый путь) одинаковой длины.
+    """
+    tail = Substr('path', len(moves[0][0]) + 1)
+    revision = revision_clock.next()
+    for start in range(0, len(moves), REWRITE_BATCH_SIZE):
+        batch = moves[start:start + REWRITE_BATCH_SIZE]
+        model_class.objects.filter(
+            reduce(operator.or_, (Q(path__startswith=old) for old, _ in batch)),
+            post_id=post_id,
+        ).update(revision=revision, path=Case(
+            *(When(path__startswith=old, then=Concat(Value(new), tail)) for old, new in batch),
+            output_field=models.CharField(),
+        ))
+
+
+def apply_rank_moves(model_class, post_id, moves, last_path):
+    """
+    Перемещает ветки братьев в два шага: сначала за последнего брата, затем на итоговые места,
+    чтобы пути не пересекались с уникальным ограничением (post, path).
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_id (int): Идентификатор поста.
+    - moves (list): Пары (старый путь, новый путь), полученные из `get_rank_moves`.
+    - last_path (str): Путь последнего из братьев.
+    """
+    depth = len(last_path) // model_class.steplen
+    last_pos = model_class._str2int(last_path[-model_class.steplen:])
+    temp_paths = [model_class._get_path(last_path, depth, last_pos + pos) for pos in range(1, len(moves) + 1)]
+    if len(temp_paths[-1]) != len(last_path):
+        raise PathOverflow(f"Path Overflow from: '{last_path}'")
+    rewrite_branches(model_class, post_id, [(old, temp) for (old, _), temp in zip(moves, temp_paths)])
+    rewrite_branches(model_class, post_id, [(temp, new) for (_, new), temp in zip(moves, temp_paths)])
+    if depth == 1:
+        tree_cache.invalidate_post(model_class, post_id)
+    else:
+        tree_cache.invalidate_branch(model_class, post_id, last_path)
+
+
+def rerank_children(model_class, post_id, parent_path=''):
+    """
+    Упорядочивает детей одного родителя (или комментарии первого уровня поста) по рейтингу.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_id (int): Идентификатор поста.
+    - parent_path (str): Путь родителя; пустая строка означает комментарии первого уровня.
+
+    ## Returns:
+    - int: Количество перемещенных веток.
+    """
+    siblings = model_class.objects.filter(post_id=post_id, depth=len(parent_path) // model_class.steplen + 1)
+    if parent_path:
+        siblings = siblings.filter(path__range=model_class._get_children_path_interval(parent_path))
+    siblings = list(siblings.order_by('path').values_list('path', 'inverted_rating'))
+    moves = get_rank_moves(siblings)
+    if moves:
+        with transaction.atomic(using=router.db_for_write(model_class)):
+            apply_rank_moves(model_class, post_id, moves, siblings[-1][0])
+    return len(moves)
+
+
+def rerank_post(model_class, post_id):
+    """
+    Упорядочивает по рейтингу все ветки поста, загружая пути и рейтинги одним запросом.
+    Уровни обрабатываются снизу вверх, поэтому перемещение ветки не делает устаревшими пути ещё не обработанных уровней.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_id (int): Идентификатор поста.
+
+    ## Returns:
+    - int: Количество перемещенных веток.
+    """
+    rows = model_class.objects.filter(post_id=post_id).values_list('path', 'inverted_rating')
+    groups = {}
+    for path, inverted_rating in rows:
+        groups.setdefault(model_class._get_parent_path_from_path(path), []).append((path, inverted_rating))
+    moved = 0
+    with transaction.atomic(using=router.db_for_write(model_class)):
+        for parent_path in sorted(groups, key=len, reverse=True):
+            siblings = sorted(groups[parent_path])
+            moves = get_rank_moves(siblings)
+            if moves:
+                apply_rank_moves(model_class, post_id, moves, siblings[-1][0])
+                moved += len(moves)
+    return moved
+
+
+class RankingQueue:
+    """
+    Очередь комментариев, рейтинг которых изменился. Переупорядочивает только братьев этих комментариев
+    пачками: при достижении `COMMENTS_TREE['RERANK_MAX_PENDING']` отмеченных комментариев, по запросу (`process`,
+    команда `rerank_comments`) или в фоне, если задан `COMMENTS_TREE['RERANK_INTERVAL']`. Чтения дерева
+    не переупорядочивают ветки, поэтому безопасные запросы ничего не пишут в базу данных.
+    Очередь хранится в памяти процесса, поэтому при нескольких воркерах отметки другого процесса
+    обрабатываются его таймером или по лимиту.
+
+    ## Methods:
+    - mark: Отмечает, что у родителя комментария изменился порядок детей.
+    - process: Переупорядочивает братьев отмеченных комментариев.
+
+    ## Attributes:
+    - pending (`int`): Количество отмеченных комментариев.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._timer = None
+
+    @property
+    def pending(self):
+        return sum(len(pks) for posts in self._dirty.values() for pks in posts.values())
+
+    def mark(self, instance):
+        interval = get_setting('RERANK_INTERVAL')
+        with self._lock:
+            posts = self._dirty.setdefault((instance.__class__, current_shard.get()), {})
+            posts.setdefault(instance.post_id, set()).add(instance.pk)
+            overflow = self.pending >= get_setting('RERANK_MAX_PENDING')
+            if not overflow and interval is not None and self._timer is None:
+                self._timer = threading.Timer(interval, self._process_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if overflow:
+            self.process()
+
+    def process(self, batch_size=None):
+        """
+        Переупорядочивает братьев отмеченных комментариев. Текущие пути отмеченных узлов
+        загружаются одним запросом, поэтому перемещения, выполненные после отметки, учитываются.
+
+        ## Args:
+        - batch_size (int | None): Максимальное количество комментариев за один вызов.
+
+        ## Returns:
+        - int: Количество перемещенных веток.
+        """
+        vote_buffer.flush()
+        batch = []
+        with self._lock:
+            for key, posts in self._dirty.items():
+                for pks in posts.values():
+                    while pks and (batch_size is None or len(batch) < batch_size):
+                        batch.append((key, pks.pop()))
+            self._dirty = {
+                key: {post_id: pks for post_id, pks in posts.items() if pks}
+                for key, posts in self._dirty.items()
+                if any(posts.values())
+            }
+            if self._timer is not None and not self._dirty:
+                self._timer.cancel()
+                self._timer = None
+        return self._rerank(batch)
+
+    def _rerank(self, batch):
+        moved = 0
+        for (model_class, shard), items in groupby(batch, key=operator.itemgetter(0)):
+            with use_shard(shard):
+                rows = model_class.objects.filter(pk__in=[pk for _, pk in items]).values_list('post_id', 'path')
+                parents = {(post_id, model_class._get_parent_path_from_path(path)) for post_id, path in rows}
+                for post_id, parent_path in sorted(parents, key=lambda parent: len(parent[1]), reverse=True):
+                    moved += rerank_children(model_class, post_id, parent_path)
+        return moved
+
+    def _process_from_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.process(get_setting('RERANK_BATCH_SIZE'))
+        finally:
+            connections.close_all()
+        if self._dirty:
+            with self._lock:
+                if self._timer is None:
+                    self._timer = threading.Timer(get_setting('RERANK_INTERVAL'), self._process_from_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+
+ranking_queue = RankingQueue()
@@ -0,0 +1,60 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class TreeJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer, кодирующий ответы через orjson, если он установлен.
+    Результат совпадает с JSONRenderer с настройками по умолчанию; без orjson,
+    а также при запросе отступов (`indent`) используется стандартная реализация DRF.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or orjson is None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type or '', renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        ret = orjson.dumps(data, default=JSONEncoder().default)
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FlatTreeJSONRenderer(TreeJSONRenderer):
+    """
+    Рендерер плоского формата дерева (`publications.flat`) в компактном JSON. Выбирается по заголовку
+    `Accept: application/vnd.comments-tree.flat+json`; представление, увидев у выбранного рендерера `flat_tree`,
+    отдает колонки плоского дерева вместо вложенных узлов.
+    """
+    media_type = 'application/vnd.comments-tree.flat+json'
+    format = 'flat'
+    flat_tree = True
+
+
+class FlatTreeMessagePackRenderer(BaseRenderer):
+    """
+    Рендерер плоского формата дерева в MessagePack (`Accept: application/vnd.comments-tree.flat+msgpack`).
+    Требует пакет msgpack; без него рендерер не входит в `FLAT_TREE_RENDERERS`.
+    """
+    media_type = 'application/vnd.comments-tree.flat+msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    flat_tree = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True, default=JSONEncoder().default)
+
+
+# Рендереры плоского формата, доступные в текущем окружении.
+FLAT_TREE_RENDERERS = (FlatTreeJSONRenderer,) + ((FlatTreeMessagePackRenderer,) if msgpack is not None else ())
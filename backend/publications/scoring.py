@@ -0,0 +1,190 @@
+import math
+from datetime import datetime
+from functools import cache
+
+from django.utils.module_loading import import_string
+
+from .conf import get_setting
+from .metrics import instrumented
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_SCORERS = {
+    'top': 'publications.scoring.TopScorer',
+    'new': 'publications.scoring.NewScorer',
+    'hot': 'publications.scoring.HotScorer',
+    'controversial': 'publications.scoring.ControversialScorer',
+    'wilson': 'publications.scoring.WilsonScorer',
+}
+
+
+class UnknownSort(ValueError):
+    pass
+
+
+class Scorer:
+    """
+    Базовый класс оценки комментариев для сортировки братьев в дереве: чем выше оценка, тем выше комментарий.
+    Оценки вычисляются сразу для всех узлов: если установлен NumPy, по столбцам-массивам,
+    иначе построчно. Оценка зависит только от полей комментария, поэтому отсортированное дерево
+    можно кэшировать до изменения комментариев поста.
+
+    ## Methods:
+    - score_arrays: Вычисляет оценки по массивам NumPy со значениями полей `fields`.
+    - score_row: Вычисляет оценку одного комментария по значениям полей `fields`.
+    - compute: Возвращает оценки узлов в том же порядке.
+
+    ## Attributes:
+    - fields (`tuple`): Поля комментария, от которых зависит оценка. Даты передаются как timestamp.
+    """
+    fields = ('rating',)
+
+    def score_arrays(self, *columns):
+        raise NotImplementedError
+
+    def score_row(self, *values):
+        raise NotImplementedError
+
+    def compute(self, nodes):
+        columns = [[self.get_value(node, field) for node in nodes] for field in self.fields]
+        if np is None:
+            return [self.score_row(*values) for values in zip(*columns)]
+        arrays = [np.asarray(column, dtype=np.float64) for column in columns]
+        return np.broadcast_to(self.score_arrays(*arrays), len(nodes)).tolist()
+
+    @staticmethod
+    def get_value(node, field):
+        value = getattr(node, field)
+        return value.timestamp() if isinstance(value, datetime) else value
+
+
+class TopScorer(Scorer):
+    """Сортировка по рейтингу. В отличие от порядка путей учитывает голоса, ещё не обработанные `ranking_queue`."""
+
+    def score_arrays(self, rating):
+        return rating
+
+    def score_row(self, rating):
+        return rating
+
+
+class NewScorer(Scorer):
+    """Сначала новые комментарии."""
+    fields = ('created_at',)
+
+    def score_arrays(self, created_at):
+        return created_at
+
+    def score_row(self, created_at):
+        return created_at
+
+
+class HotScorer(Scorer):
+    """
+    Рейтинг с затуханием по времени: каждые `decay` секунд новизны весят столько же,
+    сколько рост рейтинга в 10 раз. Время отсчитывается от фиксированной `epoch`,
+    поэтому порядок комментариев не меняется со временем без новых голосов.
+    """
+    fields = ('rating', 'created_at')
+    epoch = 1134028003
+    decay = 45000
+
+    def score_arrays(self, rating, created_at):
+        return np.sign(rating) * np.log10(np.maximum(np.abs(rating), 1)) + (created_at - self.epoch) / self.decay
+
+    def score_row(self, rating, created_at):
+        order = math.log10(max(abs(rating), 1))
+        return math.copysign(order, rating) + (created_at - self.epoch) / self.decay
+
+
+class ControversialScorer(Scorer):
+    """Выше комментарии с большим числом голосов, разделившихся поровну; без голосов против оценка нулевая."""
+    fields = ('upvotes', 'downvotes')
+
+    def score_arrays(self, upvotes, downvotes):
+        balance = np.minimum(upvotes, downvotes) / np.maximum(np.maximum(upvotes, downvotes), 1)
+        return np.where((upvotes > 0) & (downvotes > 0), (upvotes + downvotes) ** balance, 0.0)
+
+    def score_row(self, upvotes, downvotes):
+        if upvotes <= 0 or downvotes <= 0:
+            return 0.0
+        return float((upvotes + downvotes) ** (min(upvotes, downvotes) / max(upvotes, downvotes)))
+
+
+class WilsonScorer(Scorer):
+    """
+    Нижняя граница доверительного интервала Уилсона для доли голосов «за»:
+    комментарий с 9 из 10 голосов «за» выше комментария с единственным голосом «за».
+    """
+    fields = ('upvotes', 'downvotes')
+    z = 1.96
+
+    def score_arrays(self, upvotes, downvotes):
+        total = np.maximum(upvotes + downvotes, 1)
+        share = upvotes / total
+        z2 = self.z ** 2
+        bound = (share + z2 / (2 * total) - self.z * np.sqrt((share * (1 - share) + z2 / (4 * total)) / total)) / (1 + z2 / total)
+        return np.where(upvotes + downvotes > 0, bound, 0.0)
+
+    def score_row(self, upvotes, downvotes):
+        total = upvotes + downvotes
+        if total <= 0:
+            return 0.0
+        share = upvotes / total
+        z2 = self.z ** 2
+        return (share + z2 / (2 * total) - self.z * math.sqrt((share * (1 - share) + z2 / (4 * total)) / total)) / (1 + z2 / total)
+
+
+@cache
+def load_scorer(dotted_path):
+    return import_string(dotted_path)()
+
+
+def get_scorers():
+    """Возвращает доступные сортировки {имя: путь к классу}: встроенные и заданные в `COMMENTS_TREE['SCORERS']`."""
+    return {**DEFAULT_SCORERS, **get_setting('SCORERS')}
+
+
+def get_scorer(name):
+    """
+    Возвращает экземпляр оценщика по имени сортировки.
+    Собственные оценщики подключаются через `COMMENTS_TREE['SCORERS']` в виде {имя: путь к классу}.
+
+    ## Raises:
+    - UnknownSort: Если сортировка с таким именем не зарегистрирована.
+    """
+    scorers = get_scorers()
+    if name not in scorers:
+        raise UnknownSort(name)
+    return load_scorer(scorers[name])
+
+
+@instrumented('tree')
+def sort_tree(top, scorer):
+    """
+    Упорядочивает собранное в памяти дерево по оценкам. Оценки всех узлов вычисляются одним вызовом
+    `scorer.compute`, а братья сортируются по убыванию оценки; при равной оценке сохраняется порядок путей.
+
+    ## Args:
+    - top (list): Узлы верхнего уровня с заполненным `_cached_children`.
+    - scorer (Scorer): Оценщик, например из `get_scorer`.
+
+    ## Returns:
+    - list: Узлы верхнего уровня в новом порядке.
+    """
+    nodes = []
+    level = top
+    while level:
+        nodes.extend(level)
+        level = [child for node in level for child in node._cached_children]
+    scores = dict(zip(map(id, nodes), scorer.compute(nodes)))
+
+    def key(node):
+        return -scores[id(node)]
+
+    for node in nodes:
+        node._cached_children.sort(key=key)
+    return sorted(top, key=key)
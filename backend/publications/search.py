@@ -0,0 +1,283 @@
+import re
+from functools import cache
+
+from django.db import connections, router
+from django.db.migrations.operations.base import Operation
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+from .aggregates import get_ancestor_paths
+from .conf import get_setting
+from .serializers import create_post_summary_serializer, get_compiled_node_serializer
+from .sharding import get_post_shard, get_shards, is_sharded
+
+# Границы совпадений, которые бэкенды ставят в фрагменте до экранирования HTML (см. `format_snippet`).
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+
+def format_snippet(snippet):
+    """Экранирует фрагмент текста комментария и заменяет границы совпадений тегами `<mark>`."""
+    return escape(snippet or '').replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def get_query_terms(query):
+    """Возвращает слова поискового запроса; операторы и кавычки пользователя не интерпретируются."""
+    return re.findall(r'\w+', query)
+
+
+class SearchBackend:
+    """
+    Базовый класс бэкенда полнотекстового поиска по `AbstractComment.text`.
+    Индекс создается миграцией (`CreateSearchIndex`) на каждой базе данных, где хранятся комментарии,
+    и поддерживается самой базой данных при вставке, изменении и удалении строк, в том числе через
+    `bulk_create`, `update` и удаление веток treebeard.
+
+    ## Methods:
+    - create_index: Создает индекс модели и заполняет его существующими комментариями.
+    - drop_index: Удаляет индекс модели.
+    - search: Возвращает найденные комментарии без удаленных, от более релевантных к менее релевантным.
+    """
+
+    snippet_words = 16
+
+    def create_index(self, schema_editor, model_class):
+        raise NotImplementedError
+
+    def drop_index(self, schema_editor, model_class):
+        raise NotImplementedError
+
+    def search(self, model_class, query, post_id=None, limit=20, using=None):
+        """
+        ## Args:
+        - model_class (class): Модель комментария.
+        - query (str): Поисковый запрос.
+        - post_id (int | None): Искать только в комментариях поста.
+        - limit (int): Количество результатов.
+        - using (str | None): База данных.
+
+        ## Returns:
+        - list: Кортежи (pk, post_id, path, rank, snippet); чем больше rank, тем релевантнее комментарий,
+        совпадения в snippet обрамлены `MATCH_START` и `MATCH_END`.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def get_columns(model_class, connection):
+        quote = connection.ops.quote_name
+        meta = model_class._meta
+        return {
+            'table': quote(meta.db_table),
+            'pk': quote(meta.pk.column),
+            'post': quote(meta.get_field('post').column),
+            'path': quote(meta.get_field('path').column),
+            'text': quote(meta.get_field('text').column),
+            'deleted_at': quote(meta.get_field('deleted_at').column),
+        }
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    Поиск через FTS5 SQLite. Индекс хранится во внешней FTS5-таблице `<таблица>_search`, ссылающейся
+    на строки комментариев по `rowid`, и обновляется триггерами. Релевантность — BM25.
+    """
+
+    tokenizer = 'unicode61 remove_diacritics 2'
+
+    def get_names(self, model_class, connection):
+        quote = connection.ops.quote_name
+        name = f'{model_class._meta.db_table}_search'
+        return {
+            'index': quote(name),
+            'insert': quote(f'{name}_ai'),
+            'delete': quote(f'{name}_ad'),
+            'update': quote(f'{name}_au'),
+        }
+
+    def create_index(self, schema_editor, model_class):
+        connection = schema_editor.connection
+        names = {**self.get_columns(model_class, connection), **self.get_names(model_class, connection)}
+        remove = "INSERT INTO {index}({index}, rowid, {text}) VALUES ('delete', old.{pk}, old.{text});"
+        add = 'INSERT INTO {index}(rowid, {text}) VALUES (new.{pk}, new.{text});'
+        for sql in (
+            "CREATE VIRTUAL TABLE {index} USING fts5({text}, content={table}, content_rowid={pk}, tokenize='%s')" % self.tokenizer,
+            'CREATE TRIGGER {insert} AFTER INSERT ON {table} BEGIN %s END' % add,
+            'CREATE TRIGGER {delete} AFTER DELETE ON {table} BEGIN %s END' % remove,
+            'CREATE TRIGGER {update} AFTER UPDATE OF {text} ON {table} BEGIN %s %s END' % (remove, add),
+            "INSERT INTO {index}({index}) VALUES ('rebuild')",
+        ):
+            schema_editor.execute(sql.format(**names))
+
+    def drop_index(self, schema_editor, model_class):
+        names = self.get_names(model_class, schema_editor.connection)
+        for trigger in ('insert', 'delete', 'update'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {names[trigger]}')
+        schema_editor.execute(f"DROP TABLE IF EXISTS {names['index']}")
+
+    def search(self, model_class, query, post_id=None, limit=20, using=None):
+        terms = get_query_terms(query)
+        if not terms:
+            return []
+        connection = connections[using or router.db_for_read(model_class)]
+        names = {**self.get_columns(model_class, connection), **self.get_names(model_class, connection)}
+        match = ' '.join('"%s"' % term for term in terms)
+        sql = (
+            'SELECT c.{pk}, c.{post}, c.{path}, -s.rank, snippet({index}, 0, %s, %s, %s, %s) '
+            'FROM {index} s JOIN {table} c ON c.{pk} = s.rowid '
+            'WHERE {index} MATCH %s AND c.{deleted_at} IS NULL'
+        ).format(**names)
+        params = [MATCH_START, MATCH_END, '…', self.snippet_words, match]
+        if post_id is not None:
+            sql += ' AND c.{post} = %s'.format(**names)
+            params.append(post_id)
+        with connection.cursor() as cursor:
+            cursor.execute(sql + ' ORDER BY s.rank LIMIT %s', [*params, limit])
+            return cursor.fetchall()
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """
+    Поиск через `tsvector` PostgreSQL по GIN-индексу выражения `to_tsvector(config, text)`,
+    который база данных обновляет сама. Релевантность — `ts_rank`, фрагменты — `ts_headline`.
+    """
+
+    config = 'simple'
+
+    def get_index_name(self, model_class, connection):
+        return connection.ops.quote_name(f'{model_class._meta.db_table}_search')
+
+    def get_vector(self, columns):
+        return f"to_tsvector('{self.config}', {columns['text']})"
+
+    def create_index(self, schema_editor, model_class):
+        columns = self.get_columns(model_class, schema_editor.connection)
+        index = self.get_index_name(model_class, schema_editor.connection)
+        schema_editor.execute(f"CREATE INDEX {index} ON {columns['table']} USING gin ({self.get_vector(columns)})")
+
+    def drop_index(self, schema_editor, model_class):
+        schema_editor.execute(f'DROP INDEX IF EXISTS {self.get_index_name(model_class, schema_editor.connection)}')
+
+    def search(self, model_class, query, post_id=None, limit=20, using=None):
+        terms = get_query_terms(query)
+        if not terms:
+            return []
+        connection = connections[using or router.db_for_read(model_class)]
+        columns = self.get_columns(model_class, connection)
+        vector = self.get_vector(columns)
+        options = f'StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords={self.snippet_words}, MinWords={self.snippet_words // 2}'
+        sql = (
+            f"SELECT {columns['pk']}, {columns['post']}, {columns['path']}, ts_rank({vector}, q), "
+            f"ts_headline('{self.config}', {columns['text']}, q, %s) "
+            f"FROM {columns['table']}, plainto_tsquery('{self.config}', %s) q "
+            f"WHERE {vector} @@ q AND {columns['deleted_at']} IS NULL"
+        )
+        params = [options, ' '.join(terms)]
+        if post_id is not None:
+            sql += f" AND {columns['post']} = %s"
+            params.append(post_id)
+        with connection.cursor() as cursor:
+            cursor.execute(sql + ' ORDER BY 4 DESC LIMIT %s', [*params, limit])
+            return cursor.fetchall()
+
+
+@cache
+def load_search_backend(dotted_path):
+    return import_string(dotted_path)()
+
+
+def get_search_backend():
+    """Возвращает бэкенд поиска, заданный в `COMMENTS_TREE['SEARCH_BACKEND']`."""
+    return load_search_backend(get_setting('SEARCH_BACKEND'))
+
+
+class CreateSearchIndex(Operation):
+    """
+    Операция миграции, создающая индекс полнотекстового поиска по комментариям модели бэкендом
+    `COMMENTS_TREE['SEARCH_BACKEND']` на каждой базе данных, куда маршрутизатор разрешает миграции модели.
+    """
+
+    reversible = True
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def deconstruct(self):
+        return self.__class__.__qualname__, [self.model_name], {}
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model_class = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model_class):
+            get_search_backend().create_index(schema_editor, model_class)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model_class = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model_class):
+            get_search_backend().drop_index(schema_editor, model_class)
+
+    def describe(self):
+        return f'Create search index on {self.model_name}'
+
+    @property
+    def migration_name_fragment(self):
+        return f'{self.model_name.lower()}_search'
+
+
+def search_comments(model_class, query, post_id=None, limit=20):
+    """
+    Ищет комментарии по тексту и возвращает каждое совпадение вместе с цепочкой предков и постом.
+    Число запросов не зависит от количества результатов: поиск и загрузка найденных комментариев с предками
+    на каждом шарде, где выполняется поиск, и один запрос постов. Без `post_id` поиск выполняется
+    на всех шардах, а результаты объединяются по релевантности, которая на разных шардах считается по своей статистике.
+
+    ## Args:
+    - model_class (class): Модель комментария, для которой создан индекс `CreateSearchIndex`.
+    - query (str): Поисковый запрос; комментарий должен содержать все слова запроса.
+    - post_id (int | None): Искать только в комментариях поста.
+    - limit (int): Количество результатов.
+
+    ## Returns:
+    - list: Словари с ключами `rank`, `snippet` (экранированный HTML с `<mark>`), `comment`,
+    `ancestors` (от комментария первого уровня к родителю) и `post`.
+    """
+    backend = get_search_backend()
+    if post_id is not None:
+        databases = [get_post_shard(model_class, post_id) or router.db_for_read(model_class)]
+    else:
+        databases = list(get_shards()) if is_sharded(model_class) else [router.db_for_read(model_class)]
+    found = [(alias, row) for alias in databases for row in backend.search(model_class, query, post_id, limit, alias)]
+    found = sorted(found, key=lambda item: -item[1][3])[:limit]
+
+    nodes = {}
+    for alias in databases:
+        rows = [row for database, row in found if database == alias]
+        if not rows:
+            continue
+        condition = Q(pk__in=[row[0] for row in rows])
+        for _, row_post_id, path, *_ in rows:
+            ancestors = get_ancestor_paths(model_class, path)
+            if ancestors:
+                condition |= Q(post_id=row_post_id, path__in=ancestors)
+        for node in model_class.objects.using(alias).filter(condition).with_authors():
+            nodes[node.post_id, node.path] = node
+
+    post_model = model_class._meta.get_field('post').related_model
+    posts = post_model.objects.in_bulk({row[1] for _, row in found})
+    node_serializer = get_compiled_node_serializer(model_class, ('children',))
+    post_serializer = create_post_summary_serializer(post_model)
+    hits = []
+    for _, (pk, post_id, path, rank, snippet) in found:
+        ancestors = [nodes.get((post_id, ancestor)) for ancestor in get_ancestor_paths(model_class, path)]
+        # Комментарий или его предок мог быть удален между поиском и загрузкой.
+        if (post_id, path) not in nodes or None in ancestors:
+            continue
+        hits.append({
+            'rank': rank,
+            'snippet': format_snippet(snippet),
+            'comment': node_serializer.to_representation(nodes[post_id, path]),
+            'ancestors': node_serializer.serialize(ancestors),
+            'post': post_serializer(posts[post_id]).data,
+        })
+    return hits
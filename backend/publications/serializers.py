@@ -1,10 +1,18 @@
+from functools import cache
+from operator import attrgetter
+
 from rest_framework import serializers
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from .metrics import instrumented
 
 
+@cache
 def create_comment_node_serializer(model_class):
     """
     Создает и возвращает класс сериализатора для моделей комментариев, наследуемых от AbstractComment.
     Эта фабричная функция динамически создает сериализатор для указанного класса модели комментария.
+    Класс создается один раз для каждой модели.
 
     ## Args:
     - model_class (class): Класс модели комментария, наследуемый от AbstractComment, для которого необходимо создать сериализатор.
@@ -22,20 +30,31 @@ def create_comment_node_serializer(model_class):
 
         class Meta:
             model = model_class
-            exclude = ('path', 'numchild', 'inverted_rating')
+            exclude = ('path', 'numchild', 'inverted_rating', 'revision')
 
         def get_children(self, obj):
             if obj.numchild == 0:
                 return []
-            return DynamicCommentNodeSerializer(obj.get_children(), many=True).data
+            children = getattr(obj, '_cached_children', None)
+            if children is None:
+                children = obj.get_children()
+            return DynamicCommentNodeSerializer(children, many=True).data
+
+        def to_representation(self, instance):
+            data = super().to_representation(instance)
+            if instance.is_tombstone:
+                data.update(dict.fromkeys(set(model_class.tombstone_fields) & set(data)))
+            return data
 
     return DynamicCommentNodeSerializer
 
 
+@cache
 def create_post_comment_serializer(model_class):
     """
     Создает и возвращает класс сериализатора для моделей, наследуемых от AbstractPost.
     Эта фабричная функция динамически создает сериализатор для указанного класса модели.
+    Класс создается один раз для каждой модели.
 
     ## Args:
     - model_class (class): Класс модели, наследуемой от AbstractPost, для которой необходимо создать сериализатор.
@@ -56,8 +75,107 @@ def create_post_comment_serializer(model_class):
             fields = '__all__'
 
         def get_comments(self, obj):
-            comments = obj.comments.filter(depth=1)
-            comment_serializer_class = create_comment_node_serializer(obj.comments.model)
-            return comment_serializer_class(comments, many=True).data
+            if 'comments' in self.context:
+                return self.context['comments']
+            return obj.get_comments_tree(**self.context.get('tree_options', {}))
 
     return DynamicPostCommentSerializer
+
+
+@cache
+def create_post_summary_serializer(model_class):
+    """
+    Создает и возвращает класс сериализатора краткого описания поста без текста и комментариев,
+    например для результатов поиска. Класс создается один раз для каждой модели.
+
+    ## Args:
+    - model_class (class): Класс модели, наследуемой от AbstractPost.
+
+    ## Returns:
+    - class: Класс сериализатора с полями `id`, `title`, `author` и `created_at`.
+    """
+    class DynamicPostSummarySerializer(serializers.ModelSerializer):
+        class Meta:
+            model = model_class
+            fields = ('id', 'title', 'author', 'created_at')
+
+    return DynamicPostSummarySerializer
+
+
+class CompiledNodeSerializer:
+    """
+    Быстрый сериализатор узлов дерева без накладных расходов ModelSerializer на каждый узел.
+    Поля и их порядок берутся из сериализатора `create_comment_node_serializer`, а для каждого поля
+    заранее вычисляется функция доступа, поэтому результат совпадает с DRF. У удаленных комментариев
+    поля `tombstone_fields` модели заменяются на None.
+
+    ## Methods:
+    - to_representation: Возвращает словарь узла вместе с потомками.
+    - serialize: Возвращает список словарей для последовательности узлов.
+
+    ## Example:
+        serializer = get_compiled_node_serializer(MyCommentModel)
+        data = serializer.serialize(get_tree_storage(MyCommentModel).load_post_tree(post))
+    """
+
+    def __init__(self, serializer_class, exclude=()):
+        self.accessors = [
+            (name, self.compile_field(field))
+            for name, field in serializer_class().fields.items()
+            if not field.write_only and name not in exclude
+        ]
+        fields = serializer_class.Meta.model.tombstone_fields
+        self.tombstone = {name: None for name, _ in self.accessors if name in fields}
+
+    def compile_field(self, field):
+        if field.field_name == 'children':
+            return self.get_children
+        if isinstance(field, PrimaryKeyRelatedField) and field.use_pk_only_optimization() and field.source_attrs == [field.source]:
+            return attrgetter(f'{field.source}_id')
+        if type(field) in (serializers.IntegerField, serializers.CharField, serializers.BooleanField) and len(field.source_attrs) == 1:
+            return attrgetter(field.source)
+
+        def accessor(node):
+            attribute = field.get_attribute(node)
+            return None if attribute is None else field.to_representation(attribute)
+        return accessor
+
+    def get_children(self, node):
+        if node.numchild == 0:
+            return []
+        children = getattr(node, '_cached_children', None)
+        if children is None:
+            children = node.get_children()
+        return self._serialize(children)
+
+    def _to_representation(self, node):
+        data = {name: accessor(node) for name, accessor in self.accessors}
+        if node.deleted_at is not None:
+            data.update(self.tombstone)
+        return data
+
+    def _serialize(self, nodes):
+        return [self._to_representation(node) for node in nodes]
+
+    @instrumented('serialize')
+    def to_representation(self, node):
+        return self._to_representation(node)
+
+    @instrumented('serialize')
+    def serialize(self, nodes):
+        return self._serialize(nodes)
+
+
+@cache
+def get_compiled_node_serializer(model_class, exclude=()):
+    """
+    Возвращает закэшированный для модели быстрый сериализатор узлов дерева комментариев.
+
+    ## Args:
+    - model_class (class): Класс модели комментария, наследуемый от AbstractComment.
+    - exclude (tuple): Поля, которые не выводятся, например `('children',)` для плоского списка узлов.
+
+    ## Returns:
+    - CompiledNodeSerializer: Сериализатор, совместимый по формату с `create_comment_node_serializer`.
+    """
+    return CompiledNodeSerializer(create_comment_node_serializer(model_class), exclude)
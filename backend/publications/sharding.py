@@ -0,0 +1,309 @@
+import operator
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import reduce, wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q, QuerySet
+from django.db.models.signals import post_delete
+
+from .conf import get_setting
+from .sync import revision_clock
+
+# База данных шарда, на которую направляются запросы к шардируемым моделям без подсказки `instance`.
+current_shard = ContextVar('comments_shard', default=None)
+
+
+def get_shards():
+    """Возвращает псевдонимы баз данных шардов из `COMMENTS_TREE['SHARDS']` или пустой кортеж."""
+    return tuple(get_setting('SHARDS') or ())
+
+
+def is_sharded(model_class):
+    """Проверяет, распределяются ли комментарии модели по шардам."""
+    return getattr(model_class, 'shard_by_post', False) and bool(get_setting('SHARDS'))
+
+
+def uses_shards():
+    """
+    Проверяет, настроено ли в проекте шардирование: заданы `COMMENTS_TREE['SHARDS']` или подключен
+    `CommentShardRouter`. Только тогда внешние ключи шардируемых моделей создаются без ограничений в базе данных
+    (`db_constraint=not uses_shards()`), так как пост и автор могут храниться на другой базе.
+    """
+    return bool(get_shards()) or 'publications.sharding.CommentShardRouter' in settings.DATABASE_ROUTERS
+
+
+def get_shard_key(model_class, post_id):
+    return f'comments-shard:{model_class._meta.concrete_model._meta.label_lower}:{post_id}'
+
+
+def get_post_shard(model_class, post_id):
+    """
+    Возвращает базу данных, на которой хранится дерево комментариев поста. Размещение закрепляется
+    в `PostShard` при первом обращении (по умолчанию `post_id` по модулю числа шардов), поэтому
+    добавление шардов не переносит существующие деревья. Размещение кэшируется в кэше `TREE_CACHE_ALIAS`.
+
+    ## Returns:
+    - str | None: Псевдоним базы данных или None, если модель не шардируется.
+    """
+    if post_id is None or not is_sharded(model_class):
+        return None
+    from .models import PostShard
+
+    cache = caches[get_setting('TREE_CACHE_ALIAS')]
+    key = get_shard_key(model_class, post_id)
+    alias = cache.get(key)
+    if alias is None:
+        shards = get_shards()
+        alias = PostShard.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            model=model_class._meta.concrete_model._meta.label_lower, post_id=post_id,
+            defaults={'database': shards[post_id % len(shards)]},
+        )[0].database
+        cache.set(key, alias, None)
+    return alias
+
+
+def get_post_shards(model_class, post_ids):
+    """
+    Пакетная версия `get_post_shard`: размещения читаются из кэша одним запросом, а недостающие
+    закрепляются и читаются из `PostShard` двумя запросами независимо от количества постов.
+
+    ## Returns:
+    - dict: {post_id: псевдоним базы данных или None, если модель не шардируется}.
+    """
+    post_ids = set(post_ids)
+    if not is_sharded(model_class):
+        return dict.fromkeys(post_ids)
+    from .models import PostShard
+
+    cache = caches[get_setting('TREE_CACHE_ALIAS')]
+    keys = {post_id: get_shard_key(model_class, post_id) for post_id in post_ids}
+    cached = cache.get_many(list(keys.values()))
+    shards = {post_id: cached[key] for post_id, key in keys.items() if key in cached}
+    missing = post_ids - set(shards)
+    if missing:
+        label = model_class._meta.concrete_model._meta.label_lower
+        databases = get_shards()
+        manager = PostShard.objects.using(DEFAULT_DB_ALIAS)
+        manager.bulk_create(
+            [PostShard(model=label, post_id=post_id, database=databases[post_id % len(databases)]) for post_id in missing],
+            ignore_conflicts=True,
+        )
+        shards.update(manager.filter(model=label, post_id__in=missing).values_list('post_id', 'database'))
+        cache.set_many({keys[post_id]: shards[post_id] for post_id in missing}, None)
+    return shards
+
+
+def set_post_shard(model_class, post_id, alias):
+    """Закрепляет дерево комментариев поста за базой данных `alias`."""
+    from .models import PostShard
+
+    PostShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        model=model_class._meta.concrete_model._meta.label_lower, post_id=post_id, defaults={'database': alias},
+    )
+    caches[get_setting('TREE_CACHE_ALIAS')].set(get_shard_key(model_class, post_id), alias, None)
+
+
+@contextmanager
+def use_shard(alias):
+    """Направляет запросы к шардируемым моделям без подсказки `instance` на базу данных `alias`."""
+    token = current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        current_shard.reset(token)
+
+
+def shard_context(alias):
+    if alias is None or alias == current_shard.get():
+        return nullcontext()
+    return use_shard(alias)
+
+
+def post_shard_context(model_class, post_id):
+    """Возвращает контекст `use_shard` для дерева поста или пустой контекст, если модель не шардируется."""
+    return shard_context(get_post_shard(model_class, post_id))
+
+
+def on_post_shard(get_target):
+    """
+    Декоратор методов, работающих с деревом одного поста: на время вызова запросы к шардируемой модели
+    направляются на шард поста, в том числе запросы treebeard и вспомогательных модулей без подсказок.
+
+    ## Args:
+    - get_target (callable): Функция от аргументов метода, возвращающая (модель комментария, post_id).
+    """
+    def decorator(method):
+        if iscoroutinefunction(method):
+            @wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                model_class, post_id = get_target(*args, **kwargs)
+                alias = await sync_to_async(get_post_shard)(model_class, post_id) if is_sharded(model_class) else None
+                with shard_context(alias):
+                    return await method(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            with post_shard_context(*get_target(*args, **kwargs)):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def allocate_ids(count):
+    """
+    Выделяет `count` идентификаторов комментариев из общей последовательности на базе данных по умолчанию,
+    чтобы идентификаторы не повторялись на разных шардах и дерево можно было перенести без их изменения.
+
+    ## Returns:
+    - list: Возрастающие идентификаторы.
+    """
+    from .models import CommentSequence
+
+    if not count:
+        return []
+    rows = CommentSequence.objects.using(DEFAULT_DB_ALIAS).bulk_create([CommentSequence() for _ in range(count)])
+    ids = [row.pk for row in rows]
+    CommentSequence.objects.using(DEFAULT_DB_ALIAS).filter(pk__lte=ids[-1]).delete()
+    return ids
+
+
+def move_post_comments(model_class, post_id, target, batch_size=None):
+    """
+    Переносит дерево комментариев поста на шард `target` с сохранением идентификаторов.
+    Строки копируются в одной транзакции целевой базы, затем размещение переключается, и изменения,
+    сделанные на старом шарде во время копирования (по ревизиям строк и журналу удалений), переносятся повторно.
+    После этого строки удаляются со старого шарда.
+
+    ## Args:
+    - model_class (class): Шардируемая модель комментария.
+    - post_id (int): Идентификатор поста.
+    - target (str): Псевдоним базы данных из `COMMENTS_TREE['SHARDS']`.
+    - batch_size (int | None): Размер пачки `bulk_create`; по умолчанию `COMMENTS_TREE['IMPORT_BATCH_SIZE']`.
+
+    ## Returns:
+    - int: Количество перенесенных комментариев.
+
+    ## Raises:
+    - ValueError: Если модель не шардируется или `target` не входит в список шардов.
+    """
+    from .cache import tree_cache
+    from .models import CommentDeletion
+
+    if not is_sharded(model_class):
+        raise ValueError(f'{model_class.__name__} не распределяется по шардам.')
+    if target not in get_shards():
+        raise ValueError(f'Неизвестный шард: {target}')
+    source = get_post_shard(model_class, post_id)
+    if source == target:
+        return 0
+    batch_size = batch_size or get_setting('IMPORT_BATCH_SIZE')
+    since = revision_clock.safe()
+
+    rows = list(QuerySet(model_class, using=source).filter(post_id=post_id))
+    with transaction.atomic(using=target):
+        QuerySet(model_class, using=target).filter(post_id=post_id).delete()
+        QuerySet(model_class, using=target).bulk_create(rows, batch_size=batch_size)
+    set_post_shard(model_class, post_id, target)
+
+    changed = list(QuerySet(model_class, using=source).filter(post_id=post_id, revision__gte=since))
+    deleted = list(CommentDeletion.objects.filter(
+        model=model_class._meta.concrete_model._meta.label_lower, post_id=post_id, revision__gte=since,
+    ).values_list('path', flat=True))
+    if changed or deleted:
+        replace = reduce(operator.or_, (Q(path__startswith=path) for path in deleted), Q(pk__in=[row.pk for row in changed]))
+        with transaction.atomic(using=target):
+            QuerySet(model_class, using=target).filter(replace, post_id=post_id).delete()
+            QuerySet(model_class, using=target).bulk_create(changed, batch_size=batch_size)
+    QuerySet(model_class, using=source).filter(post_id=post_id).delete()
+    tree_cache.invalidate_post(model_class, post_id)
+    return len(rows)
+
+
+def delete_post_comments(model_class, post_id):
+    """
+    Удаляет дерево комментариев поста с его шарда вместе с размещением в `PostShard`. Каскадное удаление
+    поста выполняется на базе данных поста и не видит комментарии, хранящиеся на других шардах.
+
+    ## Returns:
+    - int: Количество удаленных комментариев.
+    """
+    from .cache import tree_cache
+    from .models import PostShard
+
+    placement = PostShard.objects.using(DEFAULT_DB_ALIAS).filter(
+        model=model_class._meta.concrete_model._meta.label_lower, post_id=post_id,
+    )
+    alias = placement.values_list('database', flat=True).first()
+    removed = 0
+    if alias is not None:
+        removed = QuerySet(model_class, using=alias).filter(post_id=post_id).delete()[0]
+        placement.delete()
+    caches[get_setting('TREE_CACHE_ALIAS')].delete(get_shard_key(model_class, post_id))
+    tree_cache.invalidate_post(model_class, post_id)
+    return removed
+
+
+def delete_sharded_comments(sender, instance, **kwargs):
+    """Обработчик `post_delete` поста: удаляет деревья поста у шардируемых моделей комментариев."""
+    for model_class in apps.get_models():
+        if is_sharded(model_class) and model_class._meta.get_field('post').related_model is sender:
+            delete_post_comments(model_class, instance.pk)
+
+
+def connect_post_deletion():
+    """Подключает `delete_sharded_comments` к удалению постов каждой модели с `shard_by_post = True`."""
+    for model_class in apps.get_models():
+        if getattr(model_class, 'shard_by_post', False):
+            post_model = model_class._meta.get_field('post').related_model
+            post_delete.connect(
+                delete_sharded_comments, sender=post_model, dispatch_uid=f'comments-shard:{post_model._meta.label_lower}',
+            )
+
+
+class CommentShardRouter:
+    """
+    Маршрутизатор баз данных, размещающий дерево комментариев каждого поста на одном шарде.
+    Работает для моделей с `shard_by_post = True`, если задана настройка `COMMENTS_TREE['SHARDS']`.
+
+    Шард определяется по подсказке `instance`: комментарию (его `post_id`) или посту (например, `post.comments`).
+    Запросы без подсказки направляются на шард из контекста `use_shard`, который устанавливают методы моделей,
+    работающие с деревом поста. Остальные модели остаются на базе данных по умолчанию.
+    На базах данных, кроме базы по умолчанию, создаются только таблицы шардируемых моделей.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self.get_shard(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.get_shard(model, hints.get('instance'))
+
+    def get_shard(self, model, instance):
+        if not is_sharded(model):
+            return None
+        if isinstance(instance, model):
+            return get_post_shard(model, instance.post_id)
+        if isinstance(instance, model._meta.get_field('post').related_model):
+            return get_post_shard(model, instance.pk)
+        return current_shard.get()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if getattr(obj1, 'shard_by_post', False) or getattr(obj2, 'shard_by_post', False):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS:
+            return None
+        if model_name is None:
+            return False
+        try:
+            model_class = apps.get_model(app_label, model_name)
+        except LookupError:
+            return False
+        return getattr(model_class, 'shard_by_post', False)
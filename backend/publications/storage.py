@@ -0,0 +1,177 @@
+from functools import cache
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import connection
+from django.db.models import OuterRef, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Left
+from django.utils.module_loading import import_string
+
+from .metrics import instrumented, record_nodes
+from .tree import assemble_tree, get_branches_filter, get_descendants_queryset
+
+
+class PathStorage:
+    """
+    Стратегия хранения дерева комментариев по умолчанию: материализованные пути, упорядоченные по рейтингу
+    (treebeard `MP_Node`). Дерево и ветки читаются диапазоном пути уже в порядке выдачи, но вставка
+    среди отсортированных братьев и переупорядочивание по голосам переписывают пути соседних веток.
+
+    Модель выбирает стратегию атрибутом `tree_storage` (путь к классу); чтение и вставка в `AbstractComment`
+    и `AbstractPost` обращаются к ней, поэтому API моделей от стратегии не зависит. Пути есть при любой стратегии:
+    по ним работают агрегаты веток, синхронизация, кэш, страницы и постоянные ссылки.
+
+    ## Methods:
+    - check: Проверяет, что модель подходит для стратегии.
+    - get_post_queryset: Возвращает все комментарии поста для сборки дерева.
+    - get_descendants_queryset: Возвращает всех потомков узла.
+    - assemble: Собирает дерево из загруженных узлов, упорядочивая братьев для выдачи.
+    - load_post_tree: Загружает и собирает дерево поста.
+    - load_branches: Загружает и собирает ветки первого уровня с указанными путями.
+    - load_subtree: Загружает и подвешивает к узлу его ветку.
+    - prepare_insert: Вызывается перед сохранением нового комментария с уже вычисленным путем.
+    - after_move: Вызывается после переноса ветки.
+    - after_import: Вызывается после импорта пакета комментариев.
+
+    ## Attributes:
+    - sorted_paths (`bool`): Пути братьев упорядочены по рейтингу: вставка ищет место среди братьев,
+    а голоса отмечаются в `ranking_queue` для переупорядочивания.
+    - sibling_order (`tuple`): Порядок братьев в запросах, например комментариев первого уровня в кэше деревьев.
+    """
+    sorted_paths = True
+    sibling_order = ('path',)
+
+    def check(self, model_class):
+        pass
+
+    def get_post_queryset(self, post):
+        return post.comments.with_authors().order_by('path')
+
+    def get_descendants_queryset(self, node):
+        return get_descendants_queryset(node)
+
+    def assemble(self, nodes, root=None):
+        return assemble_tree(nodes, root)
+
+    def load_post_tree(self, post):
+        return self.assemble(self.get_post_queryset(post))
+
+    def load_branches(self, post, paths=None):
+        if paths is None:
+            return self.load_post_tree(post)
+        return self.assemble(self.get_post_queryset(post).filter(get_branches_filter(paths)))
+
+    def load_subtree(self, node):
+        if node.is_leaf():
+            node._cached_children = []
+            return node
+        self.assemble(self.get_descendants_queryset(node), root=node)
+        return node
+
+    def prepare_insert(self, node):
+        pass
+
+    def after_move(self, node):
+        pass
+
+    def after_import(self, model_class, post_id):
+        pass
+
+
+class AdjacencyStorage(PathStorage):
+    """
+    Список смежности: у комментария есть внешний ключ `parent`, а пути только дописываются в конец
+    и не переупорядочиваются. Вставка не сдвигает братьев, голос не переписывает пути; ветка читается
+    рекурсивным CTE по `parent_id`, а братья упорядочиваются по рейтингу в памяти.
+    Страницы дерева, потоковая выдача и заглушки свернутых веток следуют порядку добавления.
+
+    Модель должна объявить поле `parent = models.ForeignKey('self', null=True, blank=True, ...)`.
+    """
+    sorted_paths = False
+    sibling_order = ('inverted_rating', 'path')
+
+    def check(self, model_class):
+        try:
+            field = model_class._meta.get_field('parent')
+        except FieldDoesNotExist:
+            field = None
+        if field is None or not field.many_to_one or field.related_model is not model_class:
+            raise ImproperlyConfigured(f'{model_class.__name__}: AdjacencyStorage требует поле parent = ForeignKey("self").')
+
+    def get_post_queryset(self, post):
+        return post.comments.with_authors().order_by()
+
+    def get_descendants_queryset(self, node):
+        quote = connection.ops.quote_name
+        table, pk, parent = (
+            quote(node._meta.db_table), quote(node._meta.pk.column), quote(node._meta.get_field('parent').column),
+        )
+        subtree = RawSQL(
+            f'WITH RECURSIVE subtree(id) AS ('
+            f'SELECT {pk} FROM {table} WHERE {parent} = %s '
+            f'UNION ALL SELECT child.{pk} FROM {table} child JOIN subtree ON child.{parent} = subtree.id'
+            f') SELECT id FROM subtree',
+            (node.pk,),
+        )
+        return node.__class__.objects.filter(pk__in=subtree).with_authors().order_by()
+
+    @instrumented('tree')
+    def assemble(self, nodes, root=None):
+        top = []
+        by_pk = {}
+        if root is not None:
+            root._cached_children = top
+            by_pk[root.pk] = root
+        nodes = list(nodes)
+        for node in nodes:
+            node._cached_children = []
+            by_pk[node.pk] = node
+        for node in nodes:
+            parent = by_pk.get(node.parent_id)
+            (top if parent is None else parent._cached_children).append(node)
+        record_nodes(nodes)
+
+        def key(node):
+            return node.inverted_rating, node.path
+
+        for node in by_pk.values():
+            node._cached_children.sort(key=key)
+        top.sort(key=key)
+        return top
+
+    def prepare_insert(self, node):
+        if node.depth > 1 and node.parent_id is None:
+            node.parent_id = node.get_parent().pk
+
+    def after_move(self, node):
+        self.rebuild_parents(node.__class__, node.post_id)
+
+    def after_import(self, model_class, post_id):
+        self.rebuild_parents(model_class, post_id)
+
+    @staticmethod
+    def rebuild_parents(model_class, post_id):
+        """Заполняет `parent` комментариев поста по путям одним запросом UPDATE."""
+        parents = model_class.objects.filter(
+            post_id=OuterRef('post_id'),
+            path=Left(OuterRef('path'), (OuterRef('depth') - 1) * model_class.steplen),
+        ).values('pk')[:1]
+        model_class.objects.filter(post_id=post_id, depth__gt=1).update(parent=Subquery(parents))
+
+
+@cache
+def load_tree_storage(dotted_path):
+    return import_string(dotted_path)()
+
+
+@cache
+def get_tree_storage(model_class):
+    """
+    Возвращает стратегию хранения дерева модели, заданную атрибутом `tree_storage`.
+
+    ## Raises:
+    - ImproperlyConfigured: Если модель не подходит для стратегии.
+    """
+    storage = load_tree_storage(model_class.tree_storage)
+    storage.check(model_class)
+    return storage
@@ -0,0 +1,83 @@
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from .conf import get_setting
+
+
+def dumps(value):
+    """Кодирует значение так же, как JSONRenderer в DRF с настройками по умолчанию."""
+    ret = json.dumps(value, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+    return ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+
+
+def wrap_field(representation, names, field):
+    """
+    Делит сериализованный объект на начало и конец JSON вокруг поля `field`,
+    сохраняя порядок полей `names`, в котором оно стоит у сериализатора.
+
+    ## Returns:
+    - tuple: Строка до значения поля (включая `"field":`) и строка после него (включая `}`).
+    """
+    position = names.index(field)
+    head = [f'{dumps(name)}:{dumps(representation[name])}' for name in names[:position]]
+    tail = [f'{dumps(name)}:{dumps(representation[name])}' for name in names[position + 1:]]
+    return (
+        '{' + ''.join(f'{item},' for item in head) + f'{dumps(field)}:',
+        ''.join(f',{item}' for item in tail) + '}',
+    )
+
+
+def iter_tree_json(nodes, node_serializer):
+    """
+    Генерирует JSON-массив дерева комментариев из узлов, упорядоченных по `path`.
+    В памяти держится только цепочка открытых предков, поэтому потребление памяти
+    не зависит от количества комментариев.
+
+    ## Args:
+    - nodes (iterable): Узлы, упорядоченные по `path`, например `queryset.iterator()`.
+    - node_serializer (CompiledNodeSerializer): Сериализатор узла из `get_compiled_node_serializer`.
+
+    ## Yields:
+    - str: Части JSON размером около `COMMENTS_TREE['STREAM_CHUNK_SIZE']` символов.
+    """
+    chunk_size = get_setting('STREAM_CHUNK_SIZE')
+    names = [name for name, _ in node_serializer.accessors]
+    parts, size = ['['], 1
+    stack = []
+    need_comma = False
+    for node in nodes:
+        while stack and stack[-1][0] >= node.depth:
+            parts.append(stack.pop()[1])
+            need_comma = True
+        node._cached_children = ()
+        head, tail = wrap_field(node_serializer.to_representation(node), names, 'children')
+        opening = (',' if need_comma else '') + head + '['
+        parts.append(opening)
+        stack.append((node.depth, ']' + tail))
+        need_comma = False
+        size += len(opening) + len(tail)
+        if size >= chunk_size:
+            yield ''.join(parts)
+            parts, size = [], 0
+    parts.extend(closing for _, closing in reversed(stack))
+    parts.append(']')
+    yield ''.join(parts)
+
+
+def iter_post_json(post, serializer_class, comments):
+    """
+    Генерирует JSON поста, в котором поле `comments` передается потоком из `comments`.
+
+    ## Args:
+    - post (AbstractPost): Пост.
+    - serializer_class (class): Сериализатор из `create_post_comment_serializer`.
+    - comments (iterable): Части JSON-массива комментариев.
+    """
+    serializer = serializer_class(post)
+    names = list(serializer.fields)
+    serializer.fields.pop('comments')
+    head, tail = wrap_field(serializer.data, names, 'comments')
+    yield head
+    yield from comments
+    yield tail
@@ -0,0 +1,176 @@
+import base64
+import binascii
+import threading
+import time
+
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Left
+
+from .conf import get_setting
+from .pagination import InvalidCursor
+
+
+class RevisionClock:
+    """
+    Источник ревизий комментариев: время в наносекундах, строго возрастающее в пределах процесса.
+    Ревизия записывается в каждую изменяемую строку тем же запросом, что и само изменение,
+    поэтому изменения поста читаются диапазоном индекса (post, revision).
+
+    ## Methods:
+    - next: Возвращает новую ревизию.
+    - safe: Возвращает ревизию, все изменения до которой уже зафиксированы. Транзакции короче
+    `COMMENTS_TREE['SYNC_LAG']` секунд, получившие ревизию раньше, к этому моменту завершены.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = 0
+
+    def next(self):
+        with self._lock:
+            self._last = max(self._last + 1, time.time_ns())
+            return self._last
+
+    def safe(self):
+        return time.time_ns() - int(get_setting('SYNC_LAG') * 1e9)
+
+
+revision_clock = RevisionClock()
+
+
+def encode_sync_cursor(revision, pk=0):
+    """Кодирует позицию в журнале изменений (ревизия и pk последнего выданного комментария) в непрозрачный курсор."""
+    return base64.urlsafe_b64encode(f'{revision}:{pk}'.encode()).decode().rstrip('=')
+
+
+def decode_sync_cursor(cursor):
+    """
+    Декодирует курсор журнала изменений.
+
+    ## Raises:
+    - InvalidCursor: Если курсор поврежден.
+    """
+    try:
+        revision, pk = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        return int(revision), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise InvalidCursor(str(error))
+
+
+def get_sync_cursor():
+    """Возвращает курсор, с которого клиент, только что получивший дерево, запрашивает изменения."""
+    return encode_sync_cursor(revision_clock.safe())
+
+
+def get_post_revision(model_class, post_id):
+    """
+    Возвращает последнюю ревизию дерева поста: наибольшую из ревизий его комментариев и записей журнала удалений.
+    Любое изменение дерева записывает ревизию в базу данных, поэтому значение одинаково во всех процессах
+    и подходит для ETag. Читается двумя запросами по индексам (post, revision) комментариев и журнала удалений.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - post_id (int): Идентификатор поста.
+
+    ## Returns:
+    - int: Ревизия или 0, если в дереве поста ничего не менялось.
+    """
+    from .models import CommentDeletion
+
+    label = model_class._meta.concrete_model._meta.label_lower
+    revisions = (
+        model_class.objects.for_post(post_id).aggregate(value=Max('revision'))['value'],
+        CommentDeletion.objects.filter(model=label, post_id=post_id).aggregate(value=Max('revision'))['value'],
+    )
+    return max(filter(None, revisions), default=0)
+
+
+def log_deletions(model_class, nodes):
+    """
+    Записывает удаленные ветки в журнал удалений и удаляет из него записи старше `COMMENTS_TREE['SYNC_RETENTION']`.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - nodes (iterable): Верхние узлы удаленных веток; потомки удаляются клиентом вместе с ними.
+    """
+    from .models import CommentDeletion
+
+    label = model_class._meta.concrete_model._meta.label_lower
+    revision = revision_clock.next()
+    CommentDeletion.objects.bulk_create([
+        CommentDeletion(model=label, post_id=node.post_id, comment_id=node.pk, path=node.path, revision=revision)
+        for node in nodes
+    ])
+    expired = revision - int(get_setting('SYNC_RETENTION') * 1e9)
+    CommentDeletion.objects.filter(revision__lt=expired).delete()
+
+
+def get_changes(node_serializer, queryset, post_id, cursor=None, limit=1000):
+    """
+    Возвращает комментарии поста, созданные или измененные после курсора, и удаленные ветки.
+    Изменения читаются диапазоном индекса (post, revision) в порядке (revision, pk) не более `limit` штук;
+    без курсора возвращаются все комментарии поста, что позволяет получить начальное состояние.
+
+    Каждый комментарий содержит `path`, `parent` (id родителя или None) и `revision`: братья упорядочены по `path`,
+    а изменение применяется, только если его ревизия больше известной клиенту. Ревизия — наносекунды и превышает 2^53,
+    поэтому передается строкой, которую клиент сравнивает как целое число произвольной длины. Перенос и переупорядочивание
+    веток возвращают все узлы с изменившимся `path`.
+
+    ## Args:
+    - node_serializer (CompiledNodeSerializer): Сериализатор узлов без поля `children`.
+    - queryset (QuerySet): Комментарии одного поста.
+    - post_id (int): Идентификатор поста.
+    - cursor (str | None): Курсор из предыдущего ответа или заголовка `X-Comments-Cursor`.
+    - limit (int): Максимальное количество комментариев в ответе.
+
+    ## Returns:
+    - dict: `changed` — измененные комментарии, `deleted` — удаленные ветки (`id`, `path`), `cursor` — курсор
+    следующего запроса, `has_more` — остались ли изменения, `reset` — курсор устарел и клиенту нужно загрузить
+    дерево заново.
+
+    ## Raises:
+    - InvalidCursor: Если курсор поврежден.
+    """
+    from .models import CommentDeletion
+
+    model_class = queryset.model
+    revision, pk = decode_sync_cursor(cursor) if cursor else (-1, 0)
+    safe = revision_clock.safe()
+    if cursor and revision < time.time_ns() - int(get_setting('SYNC_RETENTION') * 1e9):
+        return {'changed': [], 'deleted': [], 'cursor': encode_sync_cursor(safe), 'has_more': False, 'reset': True}
+
+    parents = model_class.objects.filter(
+        post_id=OuterRef('post_id'),
+        path=Left(OuterRef('path'), (OuterRef('depth') - 1) * model_class.steplen),
+    ).values('pk')[:1]
+    nodes = list(
+        queryset.filter(revision__gte=revision).exclude(revision=revision, pk__lte=pk)
+        .annotate(parent_pk=Subquery(parents))
+        .with_authors()
+        .order_by('revision', 'pk')[:limit + 1]
+    )
+    has_more = len(nodes) > limit
+    nodes = nodes[:limit]
+
+    if has_more and nodes[-1].revision <= safe:
+        next_cursor = (nodes[-1].revision, nodes[-1].pk)
+    else:
+        next_cursor = max((revision, pk), (safe, 0))
+    deleted = CommentDeletion.objects.filter(
+        model=model_class._meta.concrete_model._meta.label_lower, post_id=post_id, revision__gt=revision,
+    )
+    if has_more:
+        deleted = deleted.filter(revision__lte=nodes[-1].revision)
+
+    changed = node_serializer.serialize(nodes)
+    for node, item in zip(nodes, changed):
+        item['path'] = node.path
+        item['parent'] = node.parent_pk
+        item['revision'] = str(node.revision)
+    return {
+        'changed': changed,
+        'deleted': [{'id': comment_id, 'path': path} for comment_id, path in deleted.order_by('revision', 'pk').values_list('comment_id', 'path')],
+        'cursor': encode_sync_cursor(*next_cursor),
+        'has_more': has_more,
+        'reset': False,
+    }
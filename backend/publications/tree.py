@@ -0,0 +1,52 @@
+import operator
+from functools import reduce
+
+from django.db.models import Q
+
+from .metrics import instrumented, record_nodes
+
+
+@instrumented('tree')
+def assemble_tree(nodes, root=None):
+    """
+    Собирает дерево комментариев в памяти из узлов, упорядоченных по `path`.
+    Каждый узел получает атрибут `_cached_children` со списком дочерних узлов,
+    поэтому сериализатор не обращается к базе данных за детьми.
+
+    ## Args:
+    - nodes (iterable): Узлы одной ветки или всего поста, упорядоченные по `path`.
+    - root (AbstractComment | None): Уже загруженный узел, к которому подвешиваются узлы уровня `root.depth + 1`.
+
+    ## Returns:
+    - list: Узлы верхнего уровня (детей `root`, если он передан) в порядке `path`.
+    """
+    top = []
+    by_path = {}
+    if root is not None:
+        root._cached_children = top
+        by_path[root.path] = root
+    for node in nodes:
+        node._cached_children = []
+        by_path[node.path] = node
+        parent = by_path.get(node.path[:-node.steplen])
+        if parent is None:
+            top.append(node)
+        else:
+            parent._cached_children.append(node)
+    record_nodes(node for node in by_path.values() if node is not root)
+    return top
+
+
+def get_branches_filter(paths):
+    """Возвращает условие выборки веток первого уровня с указанными путями."""
+    return reduce(operator.or_, (Q(path__startswith=path) for path in paths))
+
+
+def get_descendants_queryset(node):
+    """Возвращает потомков узла в порядке `path` вместе с авторами."""
+    return (
+        node.__class__.objects
+        .filter(post_id=node.post_id, path__startswith=node.path, depth__gt=node.depth)
+        .with_authors()
+        .order_by('path')
+    )
@@ -0,0 +1,116 @@
+import atexit
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+
+from django.db import connections, router, transaction
+from django.db.models import F
+
+from .aggregates import register_votes
+from .cache import tree_cache
+from .conf import get_setting
+from .sharding import current_shard, use_shard
+from .sync import revision_clock
+
+
+def apply_votes(model_class, votes):
+    """
+    Атомарно применяет голоса на стороне базы данных: изменяет рейтинг и счетчики голосов «за» и «против».
+    Комментарии с одинаковыми голосами обновляются одним запросом UPDATE.
+
+    ## Args:
+    - model_class (class): Модель комментария, наследуемая от AbstractComment.
+    - votes (dict): Словарь {pk комментария: (голосов «за», голосов «против»)}.
+
+    ## Returns:
+    - dict: Изменения рейтинга {pk комментария: изменение}.
+    """
+    groups = defaultdict(list)
+    for pk, tally in votes.items():
+        if any(tally):
+            groups[tally].append(pk)
+    with transaction.atomic(using=router.db_for_write(model_class)) if len(groups) > 1 else nullcontext():
+        for (upvotes, downvotes), pks in groups.items():
+            delta = upvotes - downvotes
+            model_class.objects.filter(pk__in=pks).update(
+                rating=F('rating') + delta,
+                inverted_rating=F('inverted_rating') - delta,
+                upvotes=F('upvotes') + upvotes,
+                downvotes=F('downvotes') + downvotes,
+                revision=revision_clock.next(),
+            )
+    return {pk: upvotes - downvotes for pk, (upvotes, downvotes) in votes.items()}
+
+
+def add_vote(votes, pk, delta, count=1):
+    """Добавляет `count` голосов со знаком `delta` в словарь {pk: (голосов «за», голосов «против»)}."""
+    upvotes, downvotes = votes.get(pk, (0, 0))
+    votes[pk] = (upvotes + count, downvotes) if delta > 0 else (upvotes, downvotes + count)
+
+
+class VoteBuffer:
+    """
+    Буфер голосов внутри процесса. Суммирует голоса «за» и «против» по комментариям
+    и записывает их пачкой по таймеру или при достижении лимита.
+
+    ## Methods:
+    - add: Добавляет голос в буфер.
+    - flush: Записывает накопленные голоса в базу данных.
+
+    ## Attributes:
+    - pending (`int`): Количество голосов, ожидающих записи.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._votes = defaultdict(dict)
+        self._timer = None
+        self.pending = 0
+
+    def add(self, model_class, pk, delta):
+        with self._lock:
+            add_vote(self._votes[(model_class, current_shard.get())], pk, delta)
+            self.pending += 1
+            overflow = self.pending >= get_setting('VOTE_MAX_PENDING')
+            if not overflow and self._timer is None:
+                self._timer = threading.Timer(get_setting('VOTE_FLUSH_INTERVAL'), self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if overflow:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            votes, self._votes = self._votes, defaultdict(dict)
+            self.pending = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        batches = list(votes.items())
+        for index, ((model_class, shard), tallies) in enumerate(batches):
+            with use_shard(shard):
+                try:
+                    deltas = apply_votes(model_class, tallies)
+                except Exception:
+                    self._restore(batches[index:])
+                    raise
+                register_votes(model_class, deltas)
+                tree_cache.invalidate_comments(model_class, list(deltas))
+
+    def _restore(self, batches):
+        with self._lock:
+            for key, tallies in batches:
+                for pk, (upvotes, downvotes) in tallies.items():
+                    add_vote(self._votes[key], pk, 1, upvotes)
+                    add_vote(self._votes[key], pk, -1, downvotes)
+                    self.pending += upvotes + downvotes
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            connections.close_all()
+
+
+vote_buffer = VoteBuffer()
+atexit.register(vote_buffer.flush)
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from collections import Counter
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from publications.ranking import ranking_queue
+from publications.storage import AdjacencyStorage
+
+from usage.models import Comment, Post
+
+User = get_user_model()
+
+MAX_DEPTH = Comment._meta.get_field('path').max_length // Comment.steplen
+SHAPES = ('wide', 'deep', 'skewed')
+# Модели поста и комментария для каждой стратегии хранения дерева (см. `publications.storage`).
+STORAGES = {
+    'path': (Post, Comment),
+}
+# Модели со списком смежности есть только в тестовых настройках (`backend.test_settings`).
+if apps.is_installed('usage.tests'):
+    from usage.tests.models import Thread, ThreadComment
+    STORAGES['adjacency'] = (Thread, ThreadComment)
+
+
+def build_level_paths(size, roots, fanout, parent=''):
+    """
+    Строит пути дерева в ширину: `roots` узлов под `parent`, затем по `fanout` детей у каждого узла,
+    пока не наберется `size` узлов или не будет достигнута максимальная глубина.
+
+    ## Returns:
+    - list: Пути узлов, упорядоченные по уровням.
+    """
+    depth = len(parent) // Comment.steplen + 1
+    level = [Comment._get_path(parent, depth, step) for step in range(1, min(roots, size) + 1)]
+    paths = list(level)
+    while level and fanout and len(paths) < size and depth < MAX_DEPTH:
+        depth += 1
+        next_level = []
+        for path in level:
+            count = min(fanout, size - len(paths) - len(next_level))
+            next_level.extend(Comment._get_path(path, depth, step) for step in range(1, count + 1))
+        paths.extend(next_level)
+        level = next_level
+    return paths
+
+
+def build_tree_paths(shape, size):
+    """
+    Строит пути синтетического дерева комментариев одного поста.
+
+    ## Args:
+    - shape (str): Форма дерева:
+        - wide: много комментариев первого уровня, по 10 ответов на каждый;
+        - deep: цепочки ответов максимальной глубины;
+        - skewed: одна ветка содержит 90% комментариев, остальные комментарии без ответов.
+    - size (int): Количество комментариев.
+
+    ## Returns:
+    - list: Пути узлов.
+    """
+    if shape == 'wide':
+        return build_level_paths(size, max(1, size // 100), 10)
+    if shape == 'deep':
+        return build_level_paths(size, max(1, -(-size // MAX_DEPTH)), 1)
+    if shape == 'skewed':
+        branch = build_level_paths(max(1, size * 9 // 10), 1, 10)
+        return branch + [Comment._get_path('', 1, step) for step in range(2, size - len(branch) + 2)]
+    raise ValueError(f'Неизвестная форма дерева: {shape}')
+
+
+def create_dataset(shape, comments, posts, batch_size=5000, storage='path'):
+    """
+    Создает `posts` постов, между которыми поровну распределено `comments` комментариев формы `shape`.
+    Комментарии вставляются пачками через `bulk_create`, все рейтинги нулевые.
+    Модели поста и комментария выбираются по стратегии хранения `storage` из `STORAGES`.
+
+    ## Returns:
+    - list: Созданные посты.
+    """
+    post_class, comment_class = STORAGES[storage]
+    user, _ = User.objects.get_or_create(username='benchmark')
+    created = []
+    for number in range(posts):
+        post = post_class.objects.create(title=f'benchmark {shape} {number}', text='benchmark', author=user)
+        paths = build_tree_paths(shape, comments // posts + (number < comments % posts))
+        numchild = Counter(comment_class._get_parent_path_from_path(path) for path in paths)
+        for start in range(0, len(paths), batch_size):
+            comment_class.objects.bulk_create(
+                comment_class(
+                    post=post, user=user, path=path, depth=len(path) // comment_class.steplen,
+                    numchild=numchild[path], text=f'comment {path}',
+                )
+                for path in paths[start:start + batch_size]
+            )
+        if storage == 'adjacency':
+            AdjacencyStorage.rebuild_parents(comment_class, post.pk)
+        created.append(post)
+    return created
+
+
+def measure(operation, prepare, repeats):
+    """
+    Выполняет операцию `repeats` раз и один раз под tracemalloc.
+
+    ## Args:
+    - operation (callable): Измеряемая операция.
+    - prepare (callable): Функция без аргументов, возвращающая аргументы операции; её время не учитывается.
+    - repeats (int): Количество замеров времени.
+
+    ## Returns:
+    - dict: Время в миллисекундах, максимальное число запросов и пиковая память в КиБ.
+    """
+    timings, queries = [], []
+    for _ in range(repeats):
+        args = prepare()
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            operation(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries.append(len(context))
+    args = prepare()
+    tracemalloc.start()
+    try:
+        operation(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'latency_ms': {
+            'min': round(min(timings), 3),
+            'median': round(statistics.median(timings), 3),
+            'mean': round(statistics.fmean(timings), 3),
+            'max': round(max(timings), 3),
+        },
+        'queries': max(queries),
+        'peak_memory_kib': round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(posts, repeats=5, seed=0):
+    """
+    Измеряет чтение и изменение дерева самого большого поста набора данных.
+    Сначала выполняются чтения, затем операции, изменяющие дерево, удаления — последними.
+    Эндпоинт ветки (`get_comments_deeper_node`) есть только у модели `Comment`; для остальных моделей
+    ветка измеряется только операцией `get_subtree`.
+
+    ## Returns:
+    - dict: Результаты по операциям.
+    """
+    rng = random.Random(seed)
+    post = max(posts, key=lambda post: post.comments.count())
+    post_class, comment_class = post.__class__, post.comments.model
+    user = post.author
+    client = Client()
+    pks = list(post.comments.values_list('pk', flat=True))
+    root_pk = post.comments.filter(depth=1).order_by('-numchild', 'path').values_list('pk', flat=True)[0]
+    branch_pks = list(comment_class.objects.filter(post__in=posts, depth=2).values_list('pk', flat=True))
+
+    def get_post():
+        return (post_class.objects.get(pk=post.pk),)
+
+    def get_node(pk):
+        return lambda: (comment_class.objects.get(pk=pk),)
+
+    def get_random_node(candidates):
+        return lambda: (comment_class.objects.get(pk=rng.choice(candidates)),)
+
+    def vote_random_node():
+        comment_class.objects.get(pk=rng.choice(pks)).add_point()
+        return ()
+
+    def get_deleted_pk():
+        if branch_pks:
+            return (branch_pks.pop(rng.randrange(len(branch_pks))),)
+        return (post.comments.exclude(pk=root_pk).values_list('pk', flat=True).last(),)
+
+    def get_deeper_node(pk):
+        response = client.get(f'/usage/post/{post.pk}/comments/{pk}/get_comments_deeper_node/')
+        assert response.status_code == 200, response.status_code
+
+    operations = (
+        ('get_comments_tree', lambda post: post.get_comments_tree(), get_post),
+        ('get_flat_comments_tree', lambda post: post.get_flat_comments_tree(), get_post),
+        ('get_comments_deeper_node', get_deeper_node, lambda: (root_pk,)),
+        ('get_subtree', lambda node: node.get_comments_deeper_from_node(), get_node(root_pk)),
+        ('add_root', lambda post: comment_class.add_root(post=post, user=user, text='benchmark root'), get_post),
+        ('add_child', lambda node: node.add_child(post=post, user=user, text='benchmark reply'), get_node(root_pk)),
+        ('vote', lambda node: node.add_point(), get_random_node(pks)),
+        ('rerank', lambda: ranking_queue.process(), vote_random_node),
+        ('delete', lambda pk: comment_class.objects.filter(pk=pk).delete(), get_deleted_pk),
+    )
+    if comment_class is not Comment:
+        operations = tuple(operation for operation in operations if operation[0] != 'get_comments_deeper_node')
+    return {name: measure(operation, prepare, repeats) for name, operation, prepare in operations}
+
+
+async def request_asgi(application, path):
+    """Выполняет GET-запрос к ASGI-приложению внутри процесса и возвращает код ответа."""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'testserver')], 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+    }
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    status = None
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # Клиент не отключается: обработчик отменит ожидание после ответа.
+        return await asyncio.Future()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await application(scope, receive, send)
+    return status
+
+
+async def run_concurrent_requests(application, path, concurrency, total):
+    """
+    Выполняет `total` запросов, из которых одновременно выполняется не больше `concurrency`.
+
+    ## Returns:
+    - dict: Пропускная способность в запросах в секунду и время ответа в миллисекундах.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def run_one():
+        async with semaphore:
+            start = time.perf_counter()
+            status = await request_asgi(application, path)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert status == 200, status
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests_per_second': round(total / elapsed, 1),
+        'latency_ms': {'median': round(statistics.median(timings), 3), 'max': round(max(timings), 3)},
+    }
+
+
+def run_concurrency_benchmarks(posts, concurrency=16, total=200):
+    """
+    Нагружает синхронный (DRF) и асинхронный эндпоинты дерева самого большого поста одновременными запросами
+    через ASGI-приложение проекта, как при запуске под `backend/asgi.py`.
+
+    ## Returns:
+    - dict: Результаты `run_concurrent_requests` по эндпоинтам `sync` и `async`.
+    """
+    post = max(posts, key=lambda post: post.comments.count())
+    application = ASGIHandler()
+    paths = {
+        'sync': f'/usage/post/{post.pk}/get_comments_tree/',
+        'async': f'/usage/async/post/{post.pk}/get_comments_tree/',
+    }
+    return {
+        name: asyncio.run(run_concurrent_requests(application, path, concurrency, total))
+        for name, path in paths.items()
+    }
+
+
+def get_environment():
+    """Возвращает сведения о коммите и окружении, в котором выполнялись замеры."""
+    try:
+        commit = subprocess.run(
+            ('git', 'rev-parse', 'HEAD'), cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': f'{connection.vendor} {connection.Database.sqlite_version}' if connection.vendor == 'sqlite' else connection.vendor,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def compare_results(baseline, current):
+    """
+    Сравнивает медианное время операций двух прогонов с одинаковыми параметрами.
+
+    ## Returns:
+    - list: Кортежи (форма, количество комментариев, операция, медиана до, медиана после, отношение).
+    """
+    def key(run):
+        return run['shape'], run['comments'], run['posts'], run.get('storage', 'path')
+
+    before = {key(run): run['results'] for run in baseline['runs']}
+    rows = []
+    for run in current['runs']:
+        results = before.get(key(run), {})
+        for name, result in run['results'].items():
+            if name in results:
+                old, new = results[name]['latency_ms']['median'], result['latency_ms']['median']
+                rows.append((run['shape'], run['comments'], name, old, new, round(new / old, 2) if old else None))
+    return rows
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from usage.benchmarks import (SHAPES, STORAGES, compare_results, create_dataset, get_environment, load_results,
+                              run_benchmarks, run_concurrency_benchmarks)
+
+
+class Command(BaseCommand):
+    help = (
+        'Измеряет время, количество запросов и пиковую память операций с деревом комментариев '
+        'на синтетических данных. Каждый набор данных создается в новой тестовой базе SQLite.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shape', action='append', dest='shapes', choices=SHAPES, help='Форма дерева, можно указать несколько раз.')
+        parser.add_argument('--comments', type=int, action='append', help='Общее количество комментариев, можно указать несколько раз.')
+        parser.add_argument('--posts', type=int, default=10, help='Количество постов, между которыми распределяются комментарии.')
+        parser.add_argument('--repeats', type=int, default=5, help='Количество замеров каждой операции.')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора случайных чисел.')
+        parser.add_argument('--storage', choices=STORAGES, default='path', help='Стратегия хранения дерева: path (Comment) или adjacency (ThreadComment, только с настройками backend.test_settings).')
+        parser.add_argument('--cache', action='store_true', help='Включить кэш деревьев (COMMENTS_TREE["TREE_CACHE"]).')
+        parser.add_argument('--database-file', help='Файл тестовой базы SQLite, пересоздается для каждого набора данных; по умолчанию временный файл.')
+        parser.add_argument('--concurrency', type=int, help='Дополнительно нагрузить синхронный и асинхронный эндпоинты дерева через ASGI этим числом одновременных запросов.')
+        parser.add_argument('--output', help='Файл, в который записываются результаты в формате JSON.')
+        parser.add_argument('--compare', help='Файл с результатами предыдущего прогона для сравнения.')
+
+    def handle(self, *args, **options):
+        self.check_options(options)
+        baseline = load_results(options['compare']) if options['compare'] else None
+        results = {
+            'environment': get_environment(),
+            'params': {key: options[key] for key in ('posts', 'repeats', 'seed', 'storage', 'cache', 'concurrency')},
+            'runs': self.run_all(options),
+        }
+        self.write_results(results)
+        if baseline:
+            self.write_comparison(baseline, results)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Результаты записаны в {options['output']}"))
+
+    def check_options(self, options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Бенчмарк выполняется только на SQLite.')
+        if options['posts'] < 1 or options['repeats'] < 1:
+            raise CommandError('--posts и --repeats должны быть положительными.')
+
+    def run_all(self, options):
+        """Выполняет замеры для каждой формы и размера дерева в тестовой базе SQLite."""
+        runs = []
+        setup_test_environment()
+        tempdir = tempfile.TemporaryDirectory()
+        connection.settings_dict['TEST']['NAME'] = options['database_file'] or os.path.join(tempdir.name, 'benchmark.sqlite3')
+        try:
+            with override_settings(COMMENTS_TREE={'TREE_CACHE': options['cache']}):
+                for shape in options['shapes'] or list(SHAPES):
+                    for size in options['comments'] or [1000]:
+                        self.stderr.write(f'{shape}, {size} комментариев...')
+                        runs.append({
+                            'shape': shape,
+                            'comments': size,
+                            'posts': options['posts'],
+                            'storage': options['storage'],
+                            **self.run(shape, size, options),
+                        })
+        finally:
+            teardown_test_environment()
+            tempdir.cleanup()
+        return runs
+
+    def write_results(self, results):
+        for run in results['runs']:
+            for name, result in run['results'].items():
+                self.stdout.write(
+                    f"{run['shape']:<7} {run['comments']:>8} {name:<26} "
+                    f"{result['latency_ms']['median']:>10.2f} ms {result['queries']:>5} q "
+                    f"{result['peak_memory_kib']:>10.1f} KiB"
+                )
+            for name, result in run.get('concurrency', {}).items():
+                self.stdout.write(
+                    f"{run['shape']:<7} {run['comments']:>8} {'asgi ' + name:<26} "
+                    f"{result['latency_ms']['median']:>10.2f} ms {result['requests_per_second']:>8.1f} rps"
+                )
+
+    def write_comparison(self, baseline, results):
+        self.stdout.write('')
+        for shape, size, name, old, new, ratio in compare_results(baseline, results):
+            self.stdout.write(f'{shape:<7} {size:>8} {name:<26} {old:>10.2f} -> {new:>10.2f} ms  x{ratio}')
+
+    def run(self, shape, size, options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            posts = create_dataset(shape, size, options['posts'], storage=options['storage'])
+            run = {}
+            if options['concurrency']:
+                run['concurrency'] = run_concurrency_benchmarks(posts, options['concurrency'])
+            run['results'] = run_benchmarks(posts, options['repeats'], options['seed'])
+            return run
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
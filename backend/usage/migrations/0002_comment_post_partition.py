@@ -0,0 +1,70 @@
+from django.db import migrations, models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from treebeard.mp_tree import MP_Node
+from treebeard.numconv import NumConv
+
+STEPLEN = MP_Node.steplen
+NUMCONV = NumConv(len(MP_Node.alphabet), MP_Node.alphabet)
+
+
+def get_step(position):
+    key = NUMCONV.int2str(position)
+    return MP_Node.alphabet[0] * (STEPLEN - len(key)) + key
+
+
+def rewrite_roots(Comment, roots):
+    """Переписывает путь каждой ветки так, чтобы её корень получил новый шаг."""
+    for root_path, post_id, new_step in roots:
+        if root_path == new_step:
+            continue
+        Comment.objects.filter(post_id=post_id, path__startswith=root_path).update(
+            path=Concat(Value(new_step), Substr('path', STEPLEN + 1))
+        )
+
+
+def split_paths_by_post(apps, schema_editor):
+    """
+    Нумерует корни каждого поста заново, начиная с первого шага.
+    Новые шаги не больше старых, поэтому обход по возрастанию не пересекается с ещё не переписанными ветками.
+    """
+    Comment = apps.get_model('usage', 'Comment')
+    roots = []
+    positions = {}
+    for path, post_id in Comment.objects.filter(depth=1).order_by('post_id', 'path').values_list('path', 'post_id'):
+        positions[post_id] = positions.get(post_id, 0) + 1
+        roots.append((path, post_id, get_step(positions[post_id])))
+    rewrite_roots(Comment, roots)
+
+
+def merge_paths(apps, schema_editor):
+    """Возвращает единую нумерацию корней для всех постов."""
+    Comment = apps.get_model('usage', 'Comment')
+    roots = Comment.objects.filter(depth=1).order_by('post_id', 'path').values_list('path', 'post_id')
+    roots = [(path, post_id, get_step(position)) for position, (path, post_id) in enumerate(roots, 1)]
+    # Новые шаги не меньше старых, поэтому обход с конца не пересекается с ещё не переписанными ветками.
+    rewrite_roots(Comment, reversed(roots))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.RunPython(split_paths_by_post, merge_paths),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'depth', 'path'], name='usage_comment_pdp_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='comment',
+            constraint=models.UniqueConstraint(fields=('post', 'path'), name='usage_comment_post_path_uniq'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.14 on 2026-10-18 20:00
+
+from django.db import migrations, models
+from publications.aggregates import compute_aggregates
+from treebeard.mp_tree import MP_Node
+
+
+def fill_aggregates(apps, schema_editor):
+    """Вычисляет агрегаты веток для уже существующих комментариев, по одному посту за раз."""
+    Comment = apps.get_model('usage', 'Comment')
+    for post_id in Comment.objects.order_by().values_list('post_id', flat=True).distinct():
+        nodes = list(Comment.objects.filter(post_id=post_id).only('path', 'rating', 'created_at'))
+        aggregates = compute_aggregates(((node.path, node.rating, node.created_at) for node in nodes), MP_Node.steplen)
+        for node in nodes:
+            node.descendant_count, node.max_subtree_rating, node.last_activity = aggregates[node.path]
+        Comment.objects.bulk_update(nodes, ['descendant_count', 'max_subtree_rating', 'last_activity'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0002_comment_post_partition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='количество ответов в ветке'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='последняя активность в ветке'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='max_subtree_rating',
+            field=models.IntegerField(blank=True, editable=False, null=True, verbose_name='лучший рейтинг в ветке'),
+        ),
+        migrations.RunPython(fill_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.14 on 2026-10-18 21:00
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_vote_counts(apps, schema_editor):
+    """Выводит голоса уже существующих комментариев из их рейтинга."""
+    Comment = apps.get_model('usage', 'Comment')
+    Comment.objects.filter(rating__gt=0).update(upvotes=F('rating'))
+    Comment.objects.filter(rating__lt=0).update(downvotes=-F('rating'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0003_comment_subtree_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='downvotes',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='голосов «против»'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='upvotes',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='голосов «за»'),
+        ),
+        migrations.RunPython(fill_vote_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.14 on 2026-10-18 20:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0004_comment_vote_counts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='revision',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='ревизия'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'revision'], name='usage_comment_prev_idx'),
+        ),
+    ]
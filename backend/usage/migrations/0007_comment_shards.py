@@ -0,0 +1,29 @@
+# Generated by Django 5.0.14 on 2026-10-18 20:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from publications.sharding import uses_shards
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0006_comment_tombstones'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    # Ограничения внешних ключей снимаются, только если в проекте настроено шардирование (`uses_shards`).
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='post',
+            field=models.ForeignKey(db_constraint=not uses_shards(), on_delete=django.db.models.deletion.CASCADE, related_name='comments', to='usage.post', verbose_name='комментарии к посту'),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='user',
+            field=models.ForeignKey(db_constraint=not uses_shards(), on_delete=django.db.models.deletion.CASCADE, related_name='comments', to=settings.AUTH_USER_MODEL, verbose_name='автор комментария'),
+        ),
+    ]
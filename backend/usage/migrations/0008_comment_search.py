@@ -0,0 +1,14 @@
+from django.db import migrations
+
+import publications.search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0007_comment_shards'),
+    ]
+
+    operations = [
+        publications.search.CreateSearchIndex('Comment'),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.14 on 2026-10-18 21:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usage', '0008_comment_search'),
+    ]
+
+    # Значение по умолчанию вычисляется в Python, схема базы данных не меняется. Пересоздание таблицы SQLite
+    # удалило бы триггеры индекса полнотекстового поиска, поэтому изменяется только состояние миграций.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='comment',
+                    name='created_at',
+                    field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+                ),
+            ],
+        ),
+    ]
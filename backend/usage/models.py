@@ -2,6 +2,7 @@ from django.contrib.auth import get_user_model
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
+from publications.sharding import uses_shards
 from publications.models import AbstractComment, AbstractPost
 
 
@@ -22,12 +23,24 @@ class Post(AbstractPost):
 
 
 class Comment(AbstractComment):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments', verbose_name=_('автор комментария'))
-    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments', verbose_name=_('комментарии к посту'))
+    """
+    Комментарий поста. Деревья постов распределяются по шардам `COMMENTS_TREE['SHARDS']`, если в проекте
+    настроено шардирование; тогда внешние ключи на пост и автора не создают ограничений в базе данных,
+    так как могут храниться в другой базе. Без шардирования ограничения сохраняются.
+    """
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='comments', verbose_name=_('автор комментария'),
+        db_constraint=not uses_shards(),
+    )
+    post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, related_name='comments', verbose_name=_('комментарии к посту'),
+        db_constraint=not uses_shards(),
+    )
     text = models.TextField(_('текст комментария'))
     rating = models.IntegerField(_('рейтинг комментария'), default=0)
+    shard_by_post = True
 
-    class Meta:
+    class Meta(AbstractComment.Meta):
         verbose_name = _('комментарий')
         verbose_name_plural = _('комментарии')
 
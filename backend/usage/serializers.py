@@ -7,6 +7,47 @@ class BlankSerializer(serializers.Serializer):
     pass
 
 
+class TreePageSerializer(serializers.Serializer):
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=20, label='Количество узлов верхнего уровня')
+    depth = serializers.IntegerField(min_value=1, max_value=20, required=False, label='Количество уровней')
+    children = serializers.IntegerField(min_value=1, max_value=100, required=False, label='Количество детей у узла')
+    cursor = serializers.CharField(required=False, label='Курсор продолжения')
+
+
+class TreeCollapseSerializer(serializers.Serializer):
+    collapse = serializers.BooleanField(default=False, label='Свернуть ветки с порогами из настроек')
+    min_rating = serializers.IntegerField(required=False, label='Минимальный рейтинг видимого комментария')
+    max_depth = serializers.IntegerField(min_value=1, max_value=50, required=False, label='Количество видимых уровней')
+
+
+class PermalinkSerializer(serializers.Serializer):
+    depth = serializers.IntegerField(min_value=1, max_value=50, required=False, label='Количество уровней ответов')
+
+
+class PostFeedSerializer(serializers.Serializer):
+    top = serializers.IntegerField(min_value=0, max_value=10, required=False, label='Количество лучших комментариев поста')
+
+
+class CommentSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=200, label='Поисковый запрос')
+    post = serializers.IntegerField(required=False, label='Искать только в комментариях поста')
+    limit = serializers.IntegerField(min_value=1, max_value=100, required=False, label='Количество результатов')
+
+
+class CommentChangesSerializer(serializers.Serializer):
+    cursor = serializers.CharField(required=False, label='Курсор синхронизации')
+    limit = serializers.IntegerField(min_value=1, max_value=5000, default=1000, label='Количество комментариев')
+
+
+class CommentImportSerializer(serializers.Serializer):
+    id = serializers.CharField(label='Идентификатор комментария в пакете')
+    parent = serializers.CharField(required=False, allow_null=True, default=None, label='Идентификатор родителя в пакете')
+    user = serializers.IntegerField(required=False, label='Автор комментария')
+    text = serializers.CharField(label='Текст комментария')
+    rating = serializers.IntegerField(default=0, label='Рейтинг комментария')
+    created_at = serializers.DateTimeField(required=False, label='Дата и время создания')
+
+
 class PostSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
@@ -22,4 +63,11 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
-        fields = ('id', 'post', 'user', 'text', 'rating', 'parent_node')
+        fields = ('id', 'post', 'user', 'text', 'rating', 'parent_node', 'deleted_at')
+        read_only_fields = ('deleted_at',)
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.is_tombstone:
+            data.update(dict.fromkeys(set(Comment.tombstone_fields) & set(data)))
+        return data
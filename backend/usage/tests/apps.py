@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class UsageTestsConfig(AppConfig):
+    """
+    Модели для тестов и бенчмарков стратегий хранения дерева. У приложения нет миграций,
+    поэтому таблицы создаются только в тестовых базах данных.
+    """
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'usage.tests'
+    label = 'tests'
@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+from publications.models import AbstractComment, AbstractPost
+
+
+User = get_user_model()
+
+
+class Thread(AbstractPost):
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='threads', verbose_name=_('автор'))
+
+    class Meta:
+        verbose_name = _('обсуждение')
+        verbose_name_plural = _('обсуждения')
+
+    def __str__(self) -> str:
+        return self.title
+
+
+class ThreadComment(AbstractComment):
+    """Комментарий обсуждения, хранящий дерево списком смежности (`publications.storage.AdjacencyStorage`)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='thread_comments', verbose_name=_('автор комментария'))
+    post = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='comments', verbose_name=_('комментарии к обсуждению'))
+    parent = models.ForeignKey(
+        'self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies', verbose_name=_('родительский комментарий'),
+    )
+    tree_storage = 'publications.storage.AdjacencyStorage'
+
+    class Meta(AbstractComment.Meta):
+        verbose_name = _('комментарий обсуждения')
+        verbose_name_plural = _('комментарии обсуждений')
+
+    def __str__(self) -> str:
+        return self.text
@@ -0,0 +1,48 @@
+from django.test import TestCase, override_settings
+
+from ..benchmarks import MAX_DEPTH, SHAPES, build_tree_paths, create_dataset, run_benchmarks
+from ..models import Comment
+from .models import ThreadComment
+
+
+class TreeShapeTests(TestCase):
+
+    def test_shapes_build_valid_trees(self):
+        for shape in SHAPES:
+            with self.subTest(shape=shape):
+                paths = build_tree_paths(shape, 500)
+                self.assertEqual(len(paths), 500)
+                self.assertEqual(len(set(paths)), 500)
+                self.assertLessEqual(max(map(len, paths)) // Comment.steplen, MAX_DEPTH)
+                parents = {Comment._get_parent_path_from_path(path) for path in paths} - {''}
+                self.assertLessEqual(parents, set(paths))
+
+    def test_deep_shape_reaches_max_depth(self):
+        paths = build_tree_paths('deep', MAX_DEPTH * 2)
+        self.assertEqual(max(map(len, paths)) // Comment.steplen, MAX_DEPTH)
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class BenchmarkTests(TestCase):
+
+    def test_dataset_is_consistent(self):
+        posts = create_dataset('skewed', 205, 2, batch_size=50)
+        self.assertEqual(Comment.objects.count(), 205)
+        for post in posts:
+            for node in post.comments.all():
+                self.assertEqual(node.numchild, node.get_children().count())
+
+    def test_run_benchmarks(self):
+        posts = create_dataset('wide', 300, 3)
+        results = run_benchmarks(posts, repeats=2)
+        self.assertEqual(results['get_comments_tree']['queries'], 1)
+        self.assertEqual(results['get_flat_comments_tree']['queries'], 1)
+        for result in results.values():
+            self.assertEqual(set(result), {'latency_ms', 'queries', 'peak_memory_kib'})
+
+    def test_run_benchmarks_adjacency(self):
+        posts = create_dataset('deep', 200, 2, storage='adjacency')
+        self.assertFalse(ThreadComment.objects.filter(depth__gt=1, parent__isnull=True).exists())
+        results = run_benchmarks(posts, repeats=2)
+        self.assertNotIn('get_comments_deeper_node', results)
+        self.assertEqual(results['get_subtree']['queries'], 1)
@@ -1,7 +1,17 @@
+import json
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from publications.cache import TreeCache
+from publications.checks import check_tree_cache_alias
+from publications.ranking import ranking_queue
 from publications.serializers import (create_comment_node_serializer,
-                                      create_post_comment_serializer)
+                                      create_post_comment_serializer,
+                                      get_compiled_node_serializer)
+from publications.storage import get_tree_storage
 
 from ..models import Comment, Post
 
@@ -42,3 +52,291 @@ class CommentSerializerTests(TestCase):
     def test_get_comments_deeper_from_node(self):
         data = self.comment.get_comments_deeper_from_node()
         self.assertIsNotNone(data)
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class CommentTreeQueriesTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='treeuser', password='12345')
+        self.post = Post.objects.create(title='Tree Post', text='This is a tree post.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        for i in range(3):
+            child = self.root.add_child(user=self.user, post=self.post, text=f'child-{i}', rating=i)
+            for y in range(3):
+                child.add_child(user=self.user, post=self.post, text=f'grandchild-{i}-{y}', rating=y)
+
+    def legacy_tree(self):
+        serializer_class = create_comment_node_serializer(Comment)
+        return serializer_class(self.post.comments.filter(depth=1), many=True).data
+
+    def test_get_comments_tree_single_query(self):
+        expected = self.legacy_tree()
+        with self.assertNumQueries(1):
+            data = self.post.get_comments_tree()
+        self.assertEqual(data, expected)
+
+    def test_compiled_serializer_matches_drf(self):
+        expected = json.dumps(self.legacy_tree())
+        data = get_compiled_node_serializer(Comment).serialize(get_tree_storage(Comment).load_post_tree(self.post))
+        self.assertEqual(json.dumps(data), expected)
+
+    def test_get_post_with_comments_single_query(self):
+        expected = self.legacy_tree()
+        with self.assertNumQueries(1):
+            data = self.post.get_post_with_comments()
+        self.assertEqual(data['comments'], expected)
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': False, 'STREAM_CHUNK_SIZE': 1, 'STREAM_BATCH_SIZE': 2})
+    def test_stream_comments_tree_single_query(self):
+        Comment.add_root(user=self.user, post=self.post, text='second root')
+        expected = json.loads(json.dumps(self.legacy_tree()))
+        with self.assertNumQueries(1):
+            chunks = list(self.post.stream_comments_tree())
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(''.join(chunks)), expected)
+
+    def test_get_comments_deeper_from_node_single_query(self):
+        expected = self.legacy_tree()[0]
+        root = Comment.objects.get(pk=self.root.pk)
+        with self.assertNumQueries(1):
+            data = root.get_comments_deeper_from_node()
+        self.assertEqual(data, expected)
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': True, 'TREE_CACHE_ALIAS': 'default', 'TREE_CACHE_TIMEOUT': 300})
+class TreeCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='cacheuser', password='12345')
+        self.post = Post.objects.create(title='Cache Post', text='This is a cached post.', author=self.user)
+        self.first = Comment.add_root(user=self.user, post=self.post, text='first')
+        self.second = Comment.add_root(user=self.user, post=self.post, text='second')
+        self.reply = self.second.add_child(user=self.user, post=self.post, text='reply')
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+    def test_disabled_cache_is_not_touched_by_writes(self):
+        with mock.patch.object(TreeCache, 'cache') as tree_cache_backend:
+            reply = Comment.objects.get(pk=self.reply.pk).add_child(user=self.user, post=self.post, text='late')
+            reply.add_point()
+            Comment.objects.get(pk=self.first.pk).tombstone()
+        self.assertFalse(tree_cache_backend.mock_calls)
+
+    def test_tree_is_served_from_cache(self):
+        data = self.post.get_comments_tree()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.post.get_comments_tree(), data)
+
+    def test_vote_rerenders_only_its_branch(self):
+        self.post.get_comments_tree()
+        Comment.objects.get(pk=self.reply.pk).add_point()
+        ranking_queue.process()
+        with self.assertNumQueries(2):
+            data = self.post.get_comments_tree()
+        self.assertEqual(data[1]['children'][0]['rating'], 1)
+
+    def test_new_comment_is_visible(self):
+        self.post.get_comments_tree()
+        self.first.add_child(user=self.user, post=self.post, text='new reply')
+        self.assertEqual(self.post.get_comments_tree()[0]['children'][0]['text'], 'new reply')
+
+    def test_delete_is_visible(self):
+        self.post.get_comments_tree()
+        self.second.get_comments_deeper_from_node()
+        Comment.objects.get(pk=self.reply.pk).delete()
+        self.assertEqual(self.post.get_comments_tree()[1]['children'], [])
+        second = Comment.objects.get(pk=self.second.pk)
+        self.assertEqual(second.get_comments_deeper_from_node()['children'], [])
+
+    async def test_async_reads_hit_cache_without_thread(self):
+        tree = await sync_to_async(self.post.get_comments_tree)()
+        second = await Comment.objects.aget(pk=self.second.pk)
+        subtree = await sync_to_async(second.get_comments_deeper_from_node)()
+        with mock.patch('publications.models.sync_to_async') as to_thread:
+            self.assertEqual(await self.post.aget_comments_tree(), tree)
+            self.assertEqual(await second.aget_comments_deeper_from_node(), subtree)
+        to_thread.assert_not_called()
+
+    def test_subtree_is_cached_per_branch(self):
+        second = Comment.objects.get(pk=self.second.pk)
+        data = second.get_comments_deeper_from_node()
+        Comment.objects.get(pk=self.first.pk).add_point()
+        ranking_queue.process()
+        with self.assertNumQueries(0):
+            self.assertEqual(second.get_comments_deeper_from_node(), data)
+
+
+class TreeCacheCheckTests(SimpleTestCase):
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': True})
+    def test_process_local_cache_is_reported(self):
+        self.assertEqual([warning.id for warning in check_tree_cache_alias(None)], ['publications.W001'])
+
+    @override_settings(
+        COMMENTS_TREE={'TREE_CACHE': True},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/comments-tree'}},
+    )
+    def test_shared_cache_passes(self):
+        self.assertEqual(check_tree_cache_alias(None), [])
+
+    def test_disabled_cache_passes(self):
+        self.assertEqual(check_tree_cache_alias(None), [])
+
+
+class CommentTreePageTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='pageuser', password='12345')
+        self.post = Post.objects.create(title='Page Post', text='This is a paged post.', author=self.user)
+        for i in range(5):
+            root = Comment.add_root(user=self.user, post=self.post, text=f'root-{i}')
+            for y in range(3):
+                child = root.add_child(user=self.user, post=self.post, text=f'child-{i}-{y}')
+                for z in range(2):
+                    child.add_child(user=self.user, post=self.post, text=f'grandchild-{i}-{y}-{z}')
+
+    def test_page_is_bounded(self):
+        with self.assertNumQueries(2):
+            page = self.post.get_comments_tree_page(limit=2, max_depth=2, max_children=2)
+        self.assertEqual([root['text'] for root in page['results']], ['root-0', 'root-1'])
+        first = page['results'][0]
+        self.assertEqual([child['text'] for child in first['children']], ['child-0-0', 'child-0-1'])
+        self.assertIsNotNone(first['children_cursor'])
+        self.assertEqual(first['children'][0]['children'], [])
+        self.assertIsNotNone(first['children'][0]['children_cursor'])
+        self.assertIsNotNone(page['next'])
+
+    def test_cursors_continue_pages(self):
+        texts = []
+        cursor = None
+        while True:
+            page = self.post.get_comments_tree_page(cursor=cursor, limit=2, max_depth=1)
+            texts.extend(root['text'] for root in page['results'])
+            cursor = page['next']
+            if cursor is None:
+                break
+        self.assertEqual(texts, [f'root-{i}' for i in range(5)])
+
+    def test_children_load_when_rating_order_differs_from_paths(self):
+        # Голос без переупорядочивания путей: последний по пути корень становится первым по рейтингу.
+        Comment.objects.filter(text='root-4').update(rating=10, inverted_rating=-10)
+        page = self.post.get_comments_tree_page(limit=2, max_depth=2)
+        self.assertEqual([root['text'] for root in page['results']], ['root-4', 'root-0'])
+        self.assertEqual([child['text'] for child in page['results'][0]['children']], [f'child-4-{y}' for y in range(3)])
+        self.assertEqual([child['text'] for child in page['results'][1]['children']], [f'child-0-{y}' for y in range(3)])
+
+    def test_children_cursor_fetches_more_replies(self):
+        page = self.post.get_comments_tree_page(limit=1, max_depth=2, max_children=2)
+        root = Comment.objects.get(pk=page['results'][0]['id'])
+        more = root.get_children_page(cursor=page['results'][0]['children_cursor'], limit=10, max_depth=2)
+        self.assertEqual([child['text'] for child in more['results']], ['child-0-2'])
+        self.assertEqual(len(more['results'][0]['children']), 2)
+        self.assertIsNone(more['next'])
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class CollapsedTreeTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='collapseuser', password='12345')
+        self.post = Post.objects.create(title='Collapse Post', text='This is a collapsed post.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root', rating=1)
+        good = self.root.add_child(user=self.user, post=self.post, text='good', rating=2)
+        bad = self.root.add_child(user=self.user, post=self.post, text='bad', rating=-4)
+        for i in range(2):
+            bad.add_child(user=self.user, post=self.post, text=f'under-bad-{i}', rating=5)
+        deep = good.add_child(user=self.user, post=self.post, text='deep')
+        deep.add_child(user=self.user, post=self.post, text='deeper')
+        Comment.add_root(user=self.user, post=self.post, text='buried', rating=-10)
+
+    def test_low_rated_branches_become_stubs(self):
+        with self.assertNumQueries(5):
+            tree = self.post.get_comments_tree(min_rating=0)
+        self.assertEqual(tree[0]['text'], 'root')
+        self.assertEqual(tree[1], {'collapsed': 'rating', 'count': 1, 'total': 1, 'cursor': tree[1]['cursor']})
+        children = tree[0]['children']
+        self.assertEqual(children[0]['text'], 'good')
+        self.assertEqual({key: children[1][key] for key in ('collapsed', 'count', 'total')}, {'collapsed': 'rating', 'count': 1, 'total': 3})
+
+    def test_stub_cursor_expands_hidden_replies(self):
+        stub = self.post.get_comments_tree(min_rating=0)[0]['children'][-1]
+        page = Comment.objects.get(pk=self.root.pk).get_children_page(cursor=stub['cursor'], max_depth=2)
+        self.assertEqual([child['text'] for child in page['results']], ['bad'])
+        self.assertEqual(len(page['results'][0]['children']), 2)
+        root_stub = self.post.get_comments_tree(min_rating=0)[-1]
+        page = self.post.get_comments_tree_page(cursor=root_stub['cursor'])
+        self.assertEqual([root['text'] for root in page['results']], ['buried'])
+
+    def test_stub_cursor_follows_rating_before_rerank(self):
+        # Рейтинги меняются без переупорядочивания путей: скрытый комментарий оказывается раньше видимого по пути.
+        Comment.objects.filter(text='good').update(rating=-6, inverted_rating=6)
+        Comment.objects.filter(text='bad').update(rating=3, inverted_rating=-3)
+        stub = self.post.get_comments_tree(min_rating=0)[0]['children'][-1]
+        page = Comment.objects.get(pk=self.root.pk).get_children_page(cursor=stub['cursor'], max_depth=1)
+        self.assertEqual([child['text'] for child in page['results']], ['good'])
+
+    def test_depth_cutoff(self):
+        with self.assertNumQueries(2):
+            tree = self.post.get_comments_tree(max_depth=2)
+        good = tree[0]['children'][0]
+        self.assertEqual(good['children'], [{'collapsed': 'depth', 'count': 1, 'total': 2, 'cursor': good['children'][0]['cursor']}])
+        self.assertEqual(len(tree), 2)
+
+    def test_collapsed_post_with_comments(self):
+        data = self.post.get_post_with_comments(min_rating=0, max_depth=1)
+        self.assertEqual(data['comments'][0]['children'][0]['collapsed'], 'depth')
+        self.assertEqual(data['comments'][0]['children'][0]['total'], 6)
+        self.assertEqual(data['comments'][-1]['collapsed'], 'rating')
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class PermalinkTreeTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='permalinkuser', password='12345')
+        self.post = Post.objects.create(title='Permalink Post', text='This is a permalink post.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root', rating=1)
+        self.parent = self.root.add_child(user=self.user, post=self.post, text='parent', rating=2)
+        self.root.add_child(user=self.user, post=self.post, text='aunt')
+        self.target = self.parent.add_child(user=self.user, post=self.post, text='target')
+        Comment.objects.get(pk=self.parent.pk).add_child(user=self.user, post=self.post, text='sibling', rating=-1)
+        reply = self.target.add_child(user=self.user, post=self.post, text='reply')
+        reply.add_child(user=self.user, post=self.post, text='nested')
+        Comment.add_root(user=self.user, post=self.post, text='other root')
+
+    def test_ancestors_and_subtree_in_one_query(self):
+        target = Comment.objects.get(pk=self.target.pk)
+        with self.assertNumQueries(1):
+            tree = target.get_permalink_tree()
+        self.assertEqual(tree['text'], 'root')
+        self.assertEqual([child.get('text') for child in tree['children']], ['parent', None])
+        self.assertEqual(tree['children'][1], {'collapsed': 'siblings', 'count': 1, 'total': 1, 'cursor': None})
+        parent = tree['children'][0]
+        self.assertEqual(parent['children'][0]['text'], 'target')
+        self.assertEqual(parent['children'][1]['collapsed'], 'siblings')
+        reply = parent['children'][0]['children'][0]
+        self.assertEqual(reply['children'][0]['text'], 'nested')
+
+    def test_depth_limit(self):
+        target = Comment.objects.get(pk=self.target.pk)
+        reply = target.get_permalink_tree(max_depth=1)['children'][0]['children'][0]['children'][0]
+        self.assertEqual(reply['text'], 'reply')
+        stub = reply['children'][0]
+        self.assertEqual({key: stub[key] for key in ('collapsed', 'count', 'total')}, {'collapsed': 'depth', 'count': 1, 'total': 1})
+        page = Comment.objects.get(text='reply').get_children_page(cursor=stub['cursor'])
+        self.assertEqual([child['text'] for child in page['results']], ['nested'])
+
+    def test_root_permalink(self):
+        tree = Comment.objects.get(text='other root').get_permalink_tree()
+        self.assertEqual((tree['text'], tree['children']), ('other root', []))
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': True})
+    def test_cached_until_branch_changes(self):
+        cache.clear()
+        target = Comment.objects.get(pk=self.target.pk)
+        target.get_permalink_tree()
+        with self.assertNumQueries(0):
+            target.get_permalink_tree()
+        Comment.objects.get(text='reply').add_point()
+        self.assertEqual(target.get_permalink_tree()['children'][0]['children'][0]['children'][0]['rating'], 1)
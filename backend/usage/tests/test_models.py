@@ -0,0 +1,780 @@
+import asyncio
+import json
+import tempfile
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from publications.importing import InvalidImport
+from publications.live import LocalBroker, SocketBroker, get_broker, get_channel
+from publications.models import PostShard
+from publications import scoring
+from publications.ranking import ranking_queue, rerank_post
+from publications.scoring import UnknownSort, get_scorer, sort_tree
+from publications.sharding import get_post_shard, move_post_comments, uses_shards
+from publications.serializers import create_comment_node_serializer, get_compiled_node_serializer
+from publications.storage import AdjacencyStorage, get_tree_storage
+from publications.sync import encode_sync_cursor, get_sync_cursor
+from publications.votes import vote_buffer
+
+from ..models import Comment, Post
+from .models import Thread, ThreadComment
+
+User = get_user_model()
+
+
+class PostTreePartitionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='partitionuser', password='12345')
+        self.first_post = Post.objects.create(title='First Post', text='First.', author=self.user)
+        self.second_post = Post.objects.create(title='Second Post', text='Second.', author=self.user)
+        self.first_root = Comment.add_root(user=self.user, post=self.first_post, text='first root')
+        self.first_root.add_child(user=self.user, post=self.first_post, text='first child')
+
+    def paths(self, post):
+        return list(post.comments.order_by('path').values_list('id', 'path', 'numchild'))
+
+    def test_each_post_starts_own_path_sequence(self):
+        second_root = Comment.add_root(user=self.user, post=self.second_post, text='second root')
+        self.assertEqual(second_root.path, self.first_root.path)
+
+    def test_sorted_root_insert_does_not_touch_other_posts(self):
+        before = self.paths(self.first_post)
+        Comment.add_root(user=self.user, post=self.second_post, text='low', rating=-5)
+        top = Comment.add_root(user=self.user, post=self.second_post, text='top', rating=10)
+        self.assertEqual(self.paths(self.first_post), before)
+        self.assertEqual(list(Comment.get_post_root_nodes(self.second_post.pk)), [top, Comment.objects.get(text='low')])
+
+    def test_add_child_updates_numchild_in_own_post(self):
+        second_root = Comment.add_root(user=self.user, post=self.second_post, text='second root')
+        second_root.add_child(user=self.user, post=self.second_post, text='second child')
+        self.assertEqual(Comment.objects.get(pk=self.first_root.pk).numchild, 1)
+        self.assertEqual(Comment.objects.get(pk=second_root.pk).numchild, 1)
+        self.assertEqual(second_root.get_children().get().text, 'second child')
+
+    def test_delete_keeps_other_posts(self):
+        second_root = Comment.add_root(user=self.user, post=self.second_post, text='second root')
+        child = second_root.add_child(user=self.user, post=self.second_post, text='second child')
+        before = self.paths(self.first_post)
+        child.delete()
+        self.assertEqual(self.paths(self.first_post), before)
+        self.assertEqual(Comment.objects.get(pk=second_root.pk).numchild, 0)
+        second_root.delete()
+        self.assertEqual(self.paths(self.first_post), before)
+        self.assertFalse(self.second_post.comments.exists())
+
+
+class CommentVoteTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='voteuser', password='12345')
+        self.post = Post.objects.create(title='Vote Post', text='Votes.', author=self.user)
+        self.comment = Comment.add_root(user=self.user, post=self.post, text='voted')
+
+    def test_votes_from_stale_instances_are_not_lost(self):
+        first = Comment.objects.get(pk=self.comment.pk)
+        second = Comment.objects.get(pk=self.comment.pk)
+        first.add_point()
+        second.add_point()
+        second.cut_point()
+        first.add_point()
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual(comment.rating, 2)
+        self.assertEqual(comment.inverted_rating, -2)
+        self.assertEqual((comment.upvotes, comment.downvotes), (3, 1))
+
+    def test_vote_is_single_update(self):
+        with self.assertNumQueries(1):
+            self.comment.add_point()
+
+    @override_settings(COMMENTS_TREE={'VOTE_BUFFER': True, 'VOTE_FLUSH_INTERVAL': 60})
+    def test_buffered_votes_are_written_on_flush(self):
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                self.comment.add_point()
+            self.comment.cut_point()
+        self.assertEqual(vote_buffer.pending, 4)
+        self.assertEqual(Comment.objects.get(pk=self.comment.pk).rating, 0)
+        vote_buffer.flush()
+        self.assertEqual(vote_buffer.pending, 0)
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.rating, comment.upvotes, comment.downvotes), (2, 3, 1))
+
+    @override_settings(COMMENTS_TREE={'VOTE_BUFFER': True, 'VOTE_FLUSH_INTERVAL': 60, 'VOTE_MAX_PENDING': 2})
+    def test_buffer_flushes_on_size_limit(self):
+        self.comment.add_point()
+        self.comment.add_point()
+        self.assertEqual(vote_buffer.pending, 0)
+        self.assertEqual(Comment.objects.get(pk=self.comment.pk).rating, 2)
+
+
+class CommentRankingTests(TestCase):
+
+    def setUp(self):
+        # Отметки голосов из других тестов остаются в очереди процесса.
+        ranking_queue.process()
+        self.user = User.objects.create_user(username='rankuser', password='12345')
+        self.post = Post.objects.create(title='Rank Post', text='Ranking.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.children = [self.root.add_child(user=self.user, post=self.post, text=f'child-{i}') for i in range(3)]
+        self.children[0].add_child(user=self.user, post=self.post, text='grandchild')
+
+    def child_texts(self):
+        return [child['text'] for child in self.post.get_comments_tree()[0]['children']]
+
+    def test_insert_respects_rating(self):
+        self.root.add_child(user=self.user, post=self.post, text='best', rating=5)
+        self.assertEqual(self.child_texts()[0], 'best')
+
+    def test_votes_rerank_siblings_on_process(self):
+        last = Comment.objects.get(text='child-2')
+        last.add_point()
+        last.add_point()
+        self.children[1].cut_point()
+        self.assertEqual(ranking_queue.pending, 2)
+        self.assertEqual(ranking_queue.process(), 3)
+        self.assertEqual(self.child_texts(), ['child-2', 'child-0', 'child-1'])
+        self.assertEqual(ranking_queue.pending, 0)
+
+    def test_reads_do_not_rerank(self):
+        Comment.objects.get(text='child-2').add_point()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.child_texts(), ['child-0', 'child-1', 'child-2'])
+        self.assertFalse([query for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertEqual(ranking_queue.pending, 1)
+        ranking_queue.process()
+
+    @override_settings(COMMENTS_TREE={'RERANK_MAX_PENDING': 2})
+    def test_queue_is_processed_at_limit(self):
+        Comment.objects.get(text='child-2').add_point()
+        self.assertEqual(ranking_queue.pending, 1)
+        Comment.objects.get(text='child-1').add_point()
+        self.assertEqual(ranking_queue.pending, 0)
+        self.assertEqual(list(Comment.objects.filter(depth=2).order_by('path').values_list('text', flat=True)),
+                         ['child-1', 'child-2', 'child-0'])
+
+    def test_moved_branch_keeps_descendants(self):
+        Comment.objects.filter(text='child-0').update(rating=-1, inverted_rating=1)
+        self.assertEqual(rerank_post(Comment, self.post.pk), 3)
+        tree = self.post.get_comments_tree()[0]['children']
+        self.assertEqual([child['text'] for child in tree], ['child-1', 'child-2', 'child-0'])
+        self.assertEqual(tree[2]['children'][0]['text'], 'grandchild')
+        grandchild = Comment.objects.get(text='grandchild')
+        self.assertEqual(grandchild.get_parent().text, 'child-0')
+        self.assertEqual(grandchild.depth, 3)
+
+    def test_moves_are_rewritten_in_batches(self):
+        Comment.objects.filter(text='child-0').update(rating=-1, inverted_rating=1)
+        with mock.patch('publications.ranking.REWRITE_BATCH_SIZE', 1):
+            self.assertEqual(rerank_post(Comment, self.post.pk), 3)
+        self.assertEqual(self.child_texts(), ['child-1', 'child-2', 'child-0'])
+        self.assertEqual(Comment.objects.get(text='grandchild').get_parent().text, 'child-0')
+
+    def test_sorted_children_are_not_moved(self):
+        self.assertEqual(rerank_post(Comment, self.post.pk), 0)
+
+
+class CommentImportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='importuser', password='12345')
+        self.post = Post.objects.create(title='Import Post', text='Import.', author=self.user)
+        self.items = [
+            {'id': 1, 'parent': None, 'user': self.user.pk, 'text': 'root', 'rating': 0},
+            {'id': 2, 'parent': 1, 'user': self.user.pk, 'text': 'low', 'rating': 1},
+            {'id': 3, 'parent': 1, 'user': self.user.pk, 'text': 'high', 'rating': 5},
+            {'id': 4, 'parent': 2, 'user': self.user, 'text': 'reply',
+             'created_at': datetime(2020, 1, 1, tzinfo=timezone.utc)},
+            {'id': 5, 'parent': None, 'user': self.user.pk, 'text': 'best root', 'rating': 3},
+        ]
+
+    def test_import_builds_sorted_tree(self):
+        with self.assertNumQueries(6):
+            created = Comment.bulk_import(self.post, self.items, batch_size=2)
+        self.assertEqual(len(created), 5)
+        tree = self.post.get_comments_tree()
+        self.assertEqual([node['text'] for node in tree], ['best root', 'root'])
+        self.assertEqual([node['text'] for node in tree[1]['children']], ['high', 'low'])
+        self.assertEqual(tree[1]['children'][1]['children'][0]['text'], 'reply')
+        reply = Comment.objects.get(text='reply')
+        self.assertEqual(reply.get_parent().text, 'low')
+        self.assertEqual(reply.created_at, datetime(2020, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(Comment.objects.get(text='root').numchild, 2)
+        self.assertEqual(Comment.objects.get(text='high').inverted_rating, -5)
+        root = Comment.objects.get(text='root')
+        self.assertEqual((root.descendant_count, root.max_subtree_rating), (3, 5))
+        self.assertEqual(root.last_activity, root.created_at)
+        self.assertFalse(any(Comment.find_problems()))
+
+    def test_import_appends_to_existing_tree(self):
+        Comment.add_root(user=self.user, post=self.post, text='existing', rating=2)
+        Comment.bulk_import(self.post, self.items)
+        self.assertEqual([node['text'] for node in self.post.get_comments_tree()], ['best root', 'existing', 'root'])
+        Comment.objects.get(text='root').add_child(user=self.user, post=self.post, text='new')
+        self.assertEqual(Comment.objects.get(text='root').numchild, 3)
+
+    def test_invalid_references(self):
+        for items in (
+            self.items + [{'id': 6, 'parent': 99, 'text': 'orphan'}],
+            self.items + [{'id': 1, 'parent': None, 'text': 'duplicate'}],
+            [{'id': 1, 'parent': 2, 'text': 'a'}, {'id': 2, 'parent': 1, 'text': 'b'}],
+        ):
+            with self.subTest(items=items), self.assertRaises(InvalidImport):
+                Comment.bulk_import(self.post, items)
+        self.assertFalse(self.post.comments.exists())
+
+    def test_import_command(self):
+        self.items[3]['user'] = self.user.pk
+        self.items[3]['created_at'] = '2020-01-01T00:00:00Z'
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            json.dump(self.items, file)
+            file.flush()
+            call_command('import_comments', 'usage.Comment', str(self.post.pk), file.name, stdout=mock.Mock())
+        self.assertEqual(self.post.comments.count(), 5)
+        self.assertEqual(Comment.objects.get(text='reply').created_at.year, 2020)
+
+
+class CommentAggregateTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='aggregateuser', password='12345')
+        self.post = Post.objects.create(title='Aggregate Post', text='Aggregates.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.child = self.root.add_child(user=self.user, post=self.post, text='child', rating=2)
+        self.leaf = self.child.add_child(user=self.user, post=self.post, text='leaf', rating=1)
+
+    def aggregates(self, node):
+        node = Comment.objects.get(pk=node.pk)
+        return node.descendant_count, node.max_subtree_rating, node.last_activity
+
+    def test_insert_updates_ancestors(self):
+        self.assertEqual(self.aggregates(self.root), (2, 2, self.leaf.created_at))
+        self.assertEqual(self.aggregates(self.child), (1, 1, self.leaf.created_at))
+        self.assertEqual(self.aggregates(self.leaf), (0, None, self.leaf.created_at))
+
+    def test_insert_writes_activity_with_row(self):
+        with CaptureQueriesContext(connection) as queries:
+            root = Comment.add_root(user=self.user, post=self.post, text='second root')
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
+        self.assertEqual(self.aggregates(root), (0, None, root.created_at))
+        with CaptureQueriesContext(connection) as queries:
+            reply = root.add_child(user=self.user, post=self.post, text='reply')
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertTrue(updates)
+        self.assertFalse([sql for sql in updates if f"'{reply.path}'" in sql])
+        self.assertEqual(self.aggregates(root), (1, 0, reply.created_at))
+
+    def test_votes_update_max_rating(self):
+        leaf = Comment.objects.get(pk=self.leaf.pk)
+        for _ in range(3):
+            leaf.add_point()
+        self.assertEqual(self.aggregates(self.root)[1], 4)
+        self.assertEqual(self.aggregates(self.child)[1], 4)
+        for _ in range(4):
+            leaf.cut_point()
+        self.assertEqual(self.aggregates(self.root)[1], 2)
+        self.assertEqual(self.aggregates(self.child)[1], 0)
+
+    @override_settings(COMMENTS_TREE={'VOTE_BUFFER': True, 'VOTE_FLUSH_INTERVAL': 60})
+    def test_buffered_votes_update_max_rating(self):
+        Comment.objects.get(pk=self.leaf.pk).add_point()
+        Comment.objects.get(pk=self.leaf.pk).add_point()
+        vote_buffer.flush()
+        self.assertEqual(self.aggregates(self.root)[1], 3)
+
+    def test_delete_refreshes_ancestors(self):
+        Comment.objects.filter(pk=self.leaf.pk).delete()
+        self.assertEqual(self.aggregates(self.root), (1, 2, self.child.created_at))
+        self.assertEqual(self.aggregates(self.child), (0, None, self.child.created_at))
+
+    def test_move_rebuilds_aggregates(self):
+        Comment.objects.get(pk=self.leaf.pk).move(Comment.objects.get(pk=self.root.pk), 'sorted-child')
+        self.assertEqual(self.aggregates(self.child), (0, None, self.child.created_at))
+        self.assertEqual(self.aggregates(self.root), (2, 2, self.leaf.created_at))
+
+    def test_aggregates_are_serialized(self):
+        node = self.post.get_comments_tree()[0]
+        self.assertEqual(node['descendant_count'], 2)
+        self.assertEqual(node['max_subtree_rating'], 2)
+        self.assertIsNotNone(node['last_activity'])
+
+
+class CommentScoringTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='scoreuser', password='12345')
+        self.post = Post.objects.create(title='Score Post', text='Scores.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        now = datetime.now(timezone.utc)
+        votes = {'old': (6, 0, 48), 'split': (5, 5, 24), 'sure': (9, 1, 12), 'lucky': (1, 0, 6), 'fresh': (0, 0, 0)}
+        for text, (upvotes, downvotes, hours) in votes.items():
+            child = self.root.add_child(
+                user=self.user, post=self.post, text=text, rating=upvotes - downvotes,
+                upvotes=upvotes, downvotes=downvotes,
+            )
+            Comment.objects.filter(pk=child.pk).update(created_at=now - timedelta(hours=hours))
+
+    def child_texts(self, sort):
+        return [child['text'] for child in self.post.get_comments_tree(sort)[0]['children']]
+
+    def test_sorts(self):
+        self.assertEqual(self.child_texts('top'), ['sure', 'old', 'lucky', 'split', 'fresh'])
+        self.assertEqual(self.child_texts('new'), ['fresh', 'lucky', 'sure', 'split', 'old'])
+        self.assertEqual(self.child_texts('hot'), ['fresh', 'sure', 'lucky', 'split', 'old'])
+        self.assertEqual(self.child_texts('controversial')[0], 'split')
+        self.assertEqual(self.child_texts('wilson'), ['old', 'sure', 'split', 'lucky', 'fresh'])
+
+    def test_new_comment_votes_follow_rating(self):
+        comment = self.root.add_child(user=self.user, post=self.post, text='negative', rating=-3)
+        self.assertEqual((comment.upvotes, comment.downvotes), (0, 3))
+
+    def test_sorted_tree_is_single_query(self):
+        with self.assertNumQueries(1):
+            self.post.get_comments_tree('hot')
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': True})
+    def test_sorted_tree_is_cached_until_vote(self):
+        data = self.post.get_comments_tree('wilson')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.post.get_comments_tree('wilson'), data)
+        Comment.objects.get(text='old').cut_point()
+        self.assertEqual(self.child_texts('wilson')[0], 'sure')
+
+    def test_sorted_subtree(self):
+        root = Comment.objects.get(pk=self.root.pk)
+        children = root.get_comments_deeper_from_node('new')['children']
+        self.assertEqual(children[0]['text'], 'fresh')
+
+    def test_unknown_sort(self):
+        with self.assertRaises(UnknownSort):
+            self.post.get_comments_tree('random')
+
+    @override_settings(COMMENTS_TREE={'SCORERS': {'old': 'usage.tests.test_models.OldScorer'}})
+    def test_custom_scorer(self):
+        self.assertEqual(self.child_texts('old')[0], 'old')
+
+    def test_vectorized_scores_match_rows(self):
+        nodes = list(self.post.comments.all())
+        for name in scoring.DEFAULT_SCORERS:
+            scorer = get_scorer(name)
+            with mock.patch.object(scoring.np, 'asarray', wraps=scoring.np.asarray) as asarray:
+                vectorized = scorer.compute(nodes)
+            asarray.assert_called()
+            with mock.patch.object(scoring, 'np', None):
+                rows = scorer.compute(nodes)
+            with self.subTest(name=name):
+                for first, second in zip(vectorized, rows):
+                    self.assertAlmostEqual(first, second)
+
+    def test_equal_scores_keep_path_order(self):
+        top = sort_tree(get_tree_storage(Comment).load_post_tree(self.post), get_scorer('controversial'))
+        texts = [child.text for child in top[0]._cached_children]
+        self.assertEqual(texts, ['split', 'sure', 'old', 'lucky', 'fresh'])
+
+
+@override_settings(COMMENTS_TREE={'SYNC_LAG': 0})
+class CommentSyncTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='syncuser', password='12345')
+        self.post = Post.objects.create(title='Sync Post', text='Sync.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.child = self.root.add_child(user=self.user, post=self.post, text='child')
+        self.cursor = get_sync_cursor()
+
+    def changed(self, changes):
+        return {item['text']: item for item in changes['changed']}
+
+    def test_snapshot_without_cursor(self):
+        changes = self.post.get_comment_changes()
+        child = self.changed(changes)['child']
+        self.assertEqual(child['parent'], self.root.pk)
+        self.assertEqual(child['path'], self.child.path)
+        self.assertNotIn('children', child)
+        self.assertIsNone(self.changed(changes)['root']['parent'])
+
+    def test_changes_since_cursor(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(self.post.get_comment_changes(self.cursor)['changed'], [])
+        reply = Comment.objects.get(pk=self.child.pk).add_child(user=self.user, post=self.post, text='reply')
+        changes = self.post.get_comment_changes(self.cursor)
+        self.assertEqual(set(self.changed(changes)), {'root', 'child', 'reply'})
+        self.assertEqual(self.changed(changes)['reply']['parent'], self.child.pk)
+
+        cursor = changes['cursor']
+        Comment.objects.get(pk=reply.pk).add_point()
+        changes = self.post.get_comment_changes(cursor)
+        self.assertEqual(self.changed(changes)['reply']['rating'], 1)
+
+        cursor = changes['cursor']
+        Comment.objects.filter(pk=self.child.pk).delete()
+        changes = self.post.get_comment_changes(cursor)
+        self.assertEqual(changes['deleted'], [{'id': self.child.pk, 'path': self.child.path}])
+        self.assertEqual(set(self.changed(changes)), {'root'})
+
+    def test_moved_paths_are_changes(self):
+        Comment.add_root(user=self.user, post=self.post, text='better', rating=3)
+        changes = self.changed(self.post.get_comment_changes(self.cursor))
+        self.assertEqual(set(changes), {'better', 'root', 'child'})
+        self.assertEqual(changes['root']['path'], Comment.objects.get(pk=self.root.pk).path)
+        self.assertEqual(changes['child']['path'], Comment.objects.get(pk=self.child.pk).path)
+
+    def test_pages_split_by_revision_and_pk(self):
+        for i in range(3):
+            Comment.add_root(user=self.user, post=self.post, text=f'more-{i}')
+        texts = []
+        cursor = self.cursor
+        while True:
+            changes = self.post.get_comment_changes(cursor, limit=1)
+            texts.extend(self.changed(changes))
+            cursor = changes['cursor']
+            if not changes['has_more']:
+                break
+        self.assertEqual(texts, ['more-0', 'more-1', 'more-2'])
+
+    def test_expired_cursor_resets(self):
+        self.assertTrue(self.post.get_comment_changes(encode_sync_cursor(1))['reset'])
+
+
+class OldScorer(scoring.NewScorer):
+
+    def score_arrays(self, created_at):
+        return -created_at
+
+    def score_row(self, created_at):
+        return -created_at
+
+
+@override_settings(COMMENTS_TREE={'LIVE_COALESCE_INTERVAL': 0, 'LIVE_MAX_PENDING': 3})
+class CommentLiveTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='liveuser', password='12345')
+        self.post = Post.objects.create(title='Live Post', text='Live.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.channel = get_channel(Comment, self.post.pk)
+
+    def receive(self, broker, publish, timeout=1):
+        async def run():
+            subscription = broker.subscribe(self.channel)
+            try:
+                publish()
+                return await subscription.get(timeout)
+            finally:
+                broker.unsubscribe(self.channel, subscription)
+        return asyncio.run(run())
+
+    def test_comment_and_vote_events(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            child = self.root.add_child(user=self.user, post=self.post, text='child')
+            for _ in range(3):
+                child.add_point()
+            child.cut_point()
+        events = self.receive(get_broker(), lambda: [callback() for callback in callbacks])
+        comment, vote = events
+        self.assertEqual(comment['comment']['text'], 'child')
+        self.assertEqual(comment['comment']['parent'], self.root.pk)
+        self.assertEqual(comment['comment']['path'], child.path)
+        self.assertEqual(vote, {'type': 'vote', 'id': child.pk, 'delta': 2, 'upvotes': 3, 'downvotes': 1})
+
+    def test_overflow_resets(self):
+        broker = LocalBroker()
+
+        def publish():
+            for pk in range(5):
+                broker.publish(self.channel, {'type': 'vote', 'id': pk, 'delta': 1, 'upvotes': 1, 'downvotes': 0})
+        self.assertEqual(self.receive(broker, publish), [{'type': 'reset', 'id': None}])
+
+    def test_socket_broker_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            subscriber, publisher = SocketBroker(directory), SocketBroker(directory)
+            try:
+                event = {'type': 'vote', 'id': self.root.pk, 'delta': 1, 'upvotes': 1, 'downvotes': 0}
+                self.assertEqual(self.receive(subscriber, lambda: publisher.publish(self.channel, event)), [event])
+            finally:
+                subscriber.close()
+                publisher.close()
+
+
+class CommentTombstoneTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='tombstoneuser', password='12345')
+        self.post = Post.objects.create(title='Tombstone Post', text='Tombstones.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.child = self.root.add_child(user=self.user, post=self.post, text='child')
+        self.leaf = Comment.objects.get(pk=self.child.pk).add_child(user=self.user, post=self.post, text='leaf')
+        self.other = Comment.objects.get(pk=self.root.pk).add_child(user=self.user, post=self.post, text='other')
+
+    def test_tombstone_keeps_placeholder(self):
+        with self.assertNumQueries(1):
+            self.child.tombstone()
+        self.assertEqual(Comment.objects.count(), 4)
+        self.assertEqual(Comment.objects.get(pk=self.root.pk).numchild, 2)
+        tree = self.post.get_comments_tree()
+        child = next(node for node in tree[0]['children'] if node['id'] == self.child.pk)
+        self.assertIsNone(child['text'])
+        self.assertIsNone(child['user'])
+        self.assertIsNotNone(child['deleted_at'])
+        self.assertEqual(child['children'][0]['text'], 'leaf')
+
+    def test_compiled_serializer_matches_drf(self):
+        self.child.tombstone()
+        node = Comment.objects.get(pk=self.child.pk)
+        node._cached_children = []
+        drf = create_comment_node_serializer(Comment)(node).data
+        compiled = get_compiled_node_serializer(Comment).to_representation(node)
+        self.assertEqual(json.loads(json.dumps(compiled, default=str)), json.loads(json.dumps(drf, default=str)))
+
+    def test_compaction_removes_only_dead_subtrees(self):
+        self.child.tombstone()
+        self.other.tombstone()
+        self.assertEqual(Comment.compact_tombstones(older_than=0), 1)
+        self.assertFalse(Comment.objects.filter(pk=self.other.pk).exists())
+        self.assertEqual(Comment.objects.get(pk=self.root.pk).numchild, 1)
+
+        Comment.objects.get(pk=self.leaf.pk).tombstone()
+        self.assertEqual(Comment.compact_tombstones(older_than=3600), 0)
+        call_command('compact_comments', 'usage.Comment', '--older-than', '0', stdout=mock.Mock())
+        self.assertEqual(list(Comment.objects.values_list('pk', flat=True)), [self.root.pk])
+        root = Comment.objects.get(pk=self.root.pk)
+        self.assertEqual((root.numchild, root.descendant_count), (0, 0))
+
+    def test_compaction_keeps_recently_deleted_descendants(self):
+        self.child.tombstone()
+        Comment.objects.get(pk=self.leaf.pk).tombstone()
+        Comment.objects.filter(pk=self.child.pk).update(deleted_at=datetime.now(timezone.utc) - timedelta(hours=2))
+        self.assertEqual(Comment.compact_tombstones(older_than=3600), 0)
+        self.assertTrue(Comment.objects.filter(pk=self.leaf.pk).exists())
+        Comment.objects.filter(pk=self.leaf.pk).update(deleted_at=datetime.now(timezone.utc) - timedelta(hours=2))
+        self.assertEqual(Comment.compact_tombstones(older_than=3600), 2)
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class TreeStorageTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='storageuser', password='12345')
+        self.post = Post.objects.create(title='Path Post', text='Paths.', author=self.user)
+        self.thread = Thread.objects.create(title='Adjacency Thread', text='Adjacency.', author=self.user)
+        self.roots = {}
+        for model_class, post in ((Comment, self.post), (ThreadComment, self.thread)):
+            first = model_class.add_root(user=self.user, post=post, text='first')
+            model_class.add_root(user=self.user, post=post, text='best', rating=5)
+            for text, rating in (('low', 1), ('high', 3), ('middle', 2)):
+                child = model_class.objects.get(pk=first.pk).add_child(user=self.user, post=post, text=text, rating=rating)
+            model_class.objects.get(text='high', post=post).add_child(user=self.user, post=post, text='reply')
+            self.roots[model_class] = model_class.objects.get(pk=first.pk)
+        self.child = child
+
+    def shape(self, nodes):
+        return [(node['text'], self.shape(node['children'])) for node in nodes]
+
+    def test_adjacency_storage_selected(self):
+        self.assertIsInstance(get_tree_storage(ThreadComment), AdjacencyStorage)
+        self.assertFalse(get_tree_storage(ThreadComment).sorted_paths)
+        self.assertTrue(get_tree_storage(Comment).sorted_paths)
+
+    def test_adjacency_tree_matches_path_tree(self):
+        expected = self.shape(self.post.get_comments_tree())
+        self.assertEqual(expected[0][0], 'best')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.shape(self.thread.get_comments_tree()), expected)
+        with override_settings(COMMENTS_TREE={'TREE_CACHE': True}):
+            self.assertEqual(self.shape(self.thread.get_comments_tree()), expected)
+            self.assertEqual(self.shape(self.thread.get_comments_tree(sort='new')), self.shape(self.post.get_comments_tree(sort='new')))
+
+    def test_subtree_loaded_by_recursive_query(self):
+        expected = self.roots[Comment].get_comments_deeper_from_node()
+        root = self.roots[ThreadComment]
+        with self.assertNumQueries(1):
+            data = root.get_comments_deeper_from_node()
+        self.assertEqual(self.shape(data['children']), self.shape(expected['children']))
+
+    async def test_async_reads_match(self):
+        expected = await sync_to_async(self.post.get_comments_tree)()
+        self.assertEqual(self.shape(await self.thread.aget_comments_tree()), self.shape(expected))
+        expected = await sync_to_async(self.roots[Comment].get_comments_deeper_from_node)()
+        data = await self.roots[ThreadComment].aget_comments_deeper_from_node()
+        self.assertEqual(self.shape(data['children']), self.shape(expected['children']))
+
+    def test_insert_and_vote_keep_sibling_paths(self):
+        root = self.roots[ThreadComment]
+        paths = dict(ThreadComment.objects.values_list('pk', 'path'))
+        child = root.add_child(user=self.user, post=self.thread, text='top', rating=10)
+        self.assertEqual(child.parent_id, root.pk)
+        self.assertEqual(dict(ThreadComment.objects.exclude(pk=child.pk).values_list('pk', 'path')), paths)
+        pending = ranking_queue.pending
+        child.cut_point()
+        self.assertEqual(ranking_queue.pending, pending)
+        tree = self.shape(self.thread.get_comments_tree())
+        self.assertEqual([text for text, _ in tree[1][1]], ['top', 'high', 'middle', 'low'])
+
+    def test_move_and_import_fill_parent(self):
+        reply = ThreadComment.objects.get(text='reply')
+        reply.move(ThreadComment.objects.get(text='best'), 'sorted-child')
+        self.assertEqual(ThreadComment.objects.get(pk=reply.pk).parent.text, 'best')
+        created = ThreadComment.bulk_import(self.thread, [
+            {'id': 1, 'parent': None, 'user': self.user.pk, 'text': 'imported'},
+            {'id': 2, 'parent': 1, 'user': self.user.pk, 'text': 'imported reply'},
+        ])
+        self.assertEqual(ThreadComment.objects.get(pk=created[2].pk).parent_id, created[1].pk)
+        self.assertEqual([text for text, _ in self.shape(self.thread.get_comments_tree())], ['best', 'first', 'imported'])
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class CommentSearchTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='searchuser', password='12345')
+        self.post = Post.objects.create(title='Search Post', text='Search.', author=self.user)
+        self.other_post = Post.objects.create(title='Other Search Post', text='Search.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='Обсуждаем деревья комментариев: деревья')
+        self.child = self.root.add_child(user=self.user, post=self.post, text='Материализованный путь <b>удобен</b>')
+        self.leaf = Comment.objects.get(pk=self.child.pk).add_child(
+            user=self.user, post=self.post, text='Путь и рекурсивный CTE: что быстрее для глубоких деревьев?',
+        )
+        Comment.add_root(user=self.user, post=self.other_post, text='Деревья в другом посте, где много других слов')
+
+    def test_hits_with_ancestors_and_post(self):
+        with self.assertNumQueries(3):
+            hits = Comment.search('рекурсивный путь')
+        self.assertEqual(len(hits), 1)
+        hit = hits[0]
+        self.assertEqual(hit['comment']['id'], self.leaf.pk)
+        self.assertNotIn('children', hit['comment'])
+        self.assertEqual([node['id'] for node in hit['ancestors']], [self.root.pk, self.child.pk])
+        self.assertEqual(hit['post']['title'], 'Search Post')
+        self.assertIn('<mark>рекурсивный</mark>', hit['snippet'])
+
+    def test_ranking_and_post_filter(self):
+        hits = Comment.search('деревья')
+        self.assertEqual(len(hits), 2)
+        self.assertEqual(hits[0]['comment']['id'], self.root.pk)
+        self.assertGreater(hits[0]['rank'], hits[1]['rank'])
+        self.assertEqual(hits[1]['post']['id'], self.other_post.pk)
+        self.assertEqual(len(Comment.search('деревья', limit=1)), 1)
+        self.assertEqual(len(Comment.search('деревья', post_id=self.other_post.pk)), 1)
+        self.assertEqual(Comment.search('деревьев', post_id=self.other_post.pk), [])
+        self.assertEqual(Comment.search('"(*'), [])
+
+    def test_snippet_is_escaped(self):
+        hit = Comment.search('удобен')[0]
+        self.assertEqual(hit['snippet'], 'Материализованный путь &lt;b&gt;<mark>удобен</mark>&lt;/b&gt;')
+
+    def test_index_follows_edit_and_delete(self):
+        child = Comment.objects.get(pk=self.child.pk)
+        child.text = 'Смежные списки'
+        child.save()
+        self.assertEqual(Comment.search('удобен'), [])
+        self.assertEqual(Comment.search('смежные')[0]['comment']['id'], self.child.pk)
+        Comment.objects.get(pk=self.leaf.pk).tombstone()
+        self.assertEqual(Comment.search('рекурсивный'), [])
+        Comment.objects.filter(pk=self.leaf.pk).delete()
+        self.assertEqual(Comment.search('деревьев'), [])
+        created = Comment.bulk_import(self.post, [{'id': 1, 'parent': None, 'user': self.user.pk, 'text': 'Импортированный ответ'}])
+        self.assertEqual(Comment.search('импортированный')[0]['comment']['id'], created[1].pk)
+
+
+SHARDS = ('default', 'comments_1', 'comments_2')
+
+
+@override_settings(COMMENTS_TREE={'SHARDS': SHARDS, 'TREE_CACHE': False})
+class CommentShardingTests(TestCase):
+    databases = set(SHARDS)
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user(username='sharduser', password='12345')
+        self.posts = [Post.objects.create(title=f'Shard {number}', text='Shards.', author=self.user) for number in range(3)]
+        for post in self.posts:
+            root = Comment.add_root(user=self.user, post=post, text='root')
+            child = root.add_child(user=self.user, post=post, text='child')
+            Comment.objects.for_post(post.pk).get(pk=child.pk).add_child(user=self.user, post=post, text='reply')
+            root.add_child(user=self.user, post=post, text='second', rating=2)
+        self.post = self.posts[0]
+
+    def shape(self, nodes):
+        return [(node['id'], node['text'], self.shape(node['children'])) for node in nodes]
+
+    def test_foreign_key_constraints_only_without_sharding(self):
+        self.assertTrue(uses_shards())
+        with override_settings(COMMENTS_TREE={}, DATABASE_ROUTERS=[]):
+            self.assertFalse(uses_shards())
+
+    def test_post_tree_stored_on_one_shard(self):
+        shards = {get_post_shard(Comment, post.pk) for post in self.posts}
+        self.assertEqual(shards, set(SHARDS))
+        for post in self.posts:
+            alias = get_post_shard(Comment, post.pk)
+            for other in SHARDS:
+                count = Comment.objects.using(other).filter(post_id=post.pk).count()
+                self.assertEqual(count, 4 if other == alias else 0)
+            tree = post.get_comments_tree()
+            self.assertEqual([node['text'] for node in tree[0]['children']], ['second', 'child'])
+            self.assertEqual(tree[0]['children'][1]['children'][0]['text'], 'reply')
+            self.assertEqual(len(post.comments.all()), 4)
+
+    def test_post_delete_removes_comments_on_shard(self):
+        post = next(post for post in self.posts if get_post_shard(Comment, post.pk) != 'default')
+        alias = get_post_shard(Comment, post.pk)
+        post.delete()
+        self.assertFalse(Comment.objects.using(alias).filter(post_id=post.pk).exists())
+        self.assertFalse(PostShard.objects.filter(post_id=post.pk).exists())
+        self.assertEqual(sum(Comment.objects.using(other).count() for other in SHARDS), 8)
+
+    def test_ids_unique_across_shards(self):
+        ids = [pk for alias in SHARDS for pk in Comment.objects.using(alias).values_list('pk', flat=True)]
+        self.assertEqual(len(ids), 12)
+        self.assertEqual(len(set(ids)), 12)
+
+    def test_votes_and_tombstones_on_shard(self):
+        alias = get_post_shard(Comment, self.post.pk)
+        child = Comment.objects.for_post(self.post.pk).get(text='child')
+        self.assertEqual(child._state.db, alias)
+        for _ in range(3):
+            child.add_point()
+        ranking_queue.process()
+        child.tombstone()
+        tree = self.post.get_comments_tree()
+        self.assertEqual(tree[0]['children'][0]['id'], child.pk)
+        self.assertIsNone(tree[0]['children'][0]['text'])
+        self.assertEqual(Comment.objects.using(alias).get(pk=child.pk).rating, 3)
+
+    def test_move_keeps_ids_and_tree(self):
+        source = get_post_shard(Comment, self.post.pk)
+        target = next(alias for alias in SHARDS if alias != source)
+        expected = self.shape(self.post.get_comments_tree())
+        call_command('move_comments', 'usage.Comment', str(self.post.pk), target, stdout=mock.Mock())
+        self.assertEqual(get_post_shard(Comment, self.post.pk), target)
+        self.assertFalse(Comment.objects.using(source).filter(post_id=self.post.pk).exists())
+        self.assertEqual(self.shape(self.post.get_comments_tree()), expected)
+        reply = Comment.objects.for_post(self.post.pk).get(text='reply')
+        self.assertEqual(reply.get_parent().text, 'child')
+        self.assertEqual(move_post_comments(Comment, self.post.pk, target), 0)
+        with self.assertRaises(ValueError):
+            move_post_comments(Comment, self.post.pk, 'unknown')
+
+    def test_comment_summaries_across_shards(self):
+        caches['default'].clear()
+        # Размещения постов закрепляются двумя запросами, затем по одному запросу на каждый шард.
+        with self.assertNumQueries(3, using='default'), self.assertNumQueries(1, using='comments_1'):
+            summaries = Post.get_comment_summaries([post.pk for post in self.posts], top_comments=1)
+        for post in self.posts:
+            self.assertEqual(summaries[post.pk]['comment_count'], 4)
+            self.assertEqual([comment['text'] for comment in summaries[post.pk]['top_comments']], ['root'])
+
+    def test_search_across_shards(self):
+        hits = Comment.search('reply')
+        self.assertEqual(len(hits), 3)
+        self.assertEqual({hit['post']['id'] for hit in hits}, {post.pk for post in self.posts})
+        for hit in hits:
+            self.assertEqual([node['text'] for node in hit['ancestors']], ['root', 'child'])
+        self.assertEqual(len(Comment.search('reply', post_id=self.post.pk)), 1)
@@ -2,7 +2,15 @@ import json
 import random
 import unittest
 
+import msgpack
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from publications.metrics import metrics_registry
+from publications.ranking import ranking_queue
 from rest_framework.test import APIClient
 
 from ..models import Comment, Post
@@ -44,9 +52,8 @@ class TestViewSet(unittest.TestCase):
         self.assertEqual(len(content[0]['children']), 5)
         children_l_3 = content[0]['children'][0]['children']
         self.assertEqual(len(children_l_3), 5)
-        # По факту работает, но в тесте сортировать не хочет.
-        # for i in range(5):
-        #     self.assertLessEqual(children_l_3[i + 1]['rating'], children_l_3[i]['rating'])
+        for i in range(4):
+            self.assertLessEqual(children_l_3[i + 1]['rating'], children_l_3[i]['rating'])
 
     def test_get_post_and_comments(self):
         response = self.client.get(f'/usage/post/{self.post.pk}/get_post_and_comments/')
@@ -71,3 +78,463 @@ class TestViewSet(unittest.TestCase):
     def test_get_comments_deeper_node(self):
         response = self.client.get(f'/usage/post/{self.post.pk}/comments/{self.comment.pk}/get_comments_deeper_node/')
         self.assertEqual(response.status_code, 200)
+
+    def test_tree_endpoints_support_conditional_get(self):
+        urls = (
+            f'/usage/post/{self.post.pk}/get_comments_tree/',
+            f'/usage/post/{self.post.pk}/get_post_and_comments/',
+            f'/usage/post/{self.post.pk}/comments/{self.comment.pk}/get_comments_deeper_node/',
+        )
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Last-Modified', response)
+            etag = response['ETag']
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            comment_queries = [query['sql'] for query in queries if 'usage_comment' in query['sql']]
+            self.assertEqual(len(comment_queries), 1)
+            self.assertIn('MAX("usage_comment"."revision")', comment_queries[0])
+            cache.clear()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+            self.client.post(f'/usage/post/{self.post.pk}/comments/{self.comment.pk}/add_point/')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_comments_tree_page(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/', {'limit': 1, 'depth': 2, 'children': 3})
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertIsNone(content['next'])
+        root = content['results'][0]
+        self.assertEqual(len(root['children']), 3)
+        response = self.client.get(
+            f'/usage/post/{self.post.pk}/comments/{root["id"]}/get_comments_deeper_node/',
+            {'cursor': root['children_cursor'], 'depth': 1},
+        )
+        self.assertEqual(len(json.loads(response.content)['results']), 2)
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/', {'cursor': '!!!'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_streaming_matches_regular_response(self):
+        for url in (f'/usage/post/{self.post.pk}/get_comments_tree/', f'/usage/post/{self.post.pk}/get_post_and_comments/'):
+            regular = self.client.get(url)
+            streamed = self.client.get(url, {'stream': 1})
+            self.assertEqual(streamed.status_code, 200)
+            self.assertTrue(streamed.streaming)
+            self.assertEqual(b''.join(streamed.streaming_content), regular.content)
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False, 'METRICS': True})
+class TreeMetricsTests(TestCase):
+
+    def setUp(self):
+        metrics_registry.reset()
+        self.admin = User.objects.create_superuser(username='metrics_admin', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Metrics Post', text='Metrics.', author=self.admin)
+        root = Comment.add_root(post=self.post, text='root', user=self.admin)
+        root.add_child(post=self.post, text='child', user=self.admin).add_child(post=self.post, text='leaf', user=self.admin)
+        self.client = APIClient()
+
+    def test_server_timing_header(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/')
+        timing = response['Server-Timing']
+        for name in ('sql;dur=', 'tree;dur=', 'serialize;dur=', 'render;dur=', 'total;dur='):
+            self.assertIn(name, timing)
+        self.assertIn('desc="3 nodes, depth 3"', timing)
+
+    def test_metrics_endpoint(self):
+        self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/')
+        self.assertEqual(self.client.get('/usage/metrics/').status_code, 403)
+        self.client.force_login(self.admin)
+        response = self.client.get('/usage/metrics/')
+        self.assertEqual(response.status_code, 200)
+        histograms = json.loads(response.content)['usage:post-get-comments-tree']
+        self.assertEqual(histograms['nodes']['count'], 1)
+        self.assertEqual(histograms['nodes']['sum'], 3)
+        self.assertEqual(histograms['max_depth']['buckets']['4'], 1)
+        self.assertIn('serialize_ms', histograms)
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+    def test_disabled_by_default(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(metrics_registry.snapshot(), {})
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get('/usage/metrics/').status_code, 404)
+
+
+class CommentImportViewTests(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='import_admin', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Import View Post', text='Import.', author=self.admin)
+        self.url = f'/usage/post/{self.post.pk}/comments/bulk_import/'
+        self.items = [
+            {'id': 'a', 'text': 'root'},
+            {'id': 'b', 'parent': 'a', 'text': 'reply', 'rating': 2},
+        ]
+        self.client = APIClient()
+
+    def test_bulk_import(self):
+        self.assertEqual(self.client.post(self.url, self.items, format='json').status_code, 403)
+        self.client.force_login(self.admin)
+        response = self.client.post(self.url, self.items, format='json')
+        self.assertEqual(response.status_code, 201)
+        ids = response.json()
+        reply = Comment.objects.get(pk=ids['b'])
+        self.assertEqual(reply.get_parent().pk, ids['a'])
+        self.assertEqual(reply.user, self.admin)
+
+    def test_bulk_import_rejects_invalid_batch(self):
+        self.client.force_login(self.admin)
+        response = self.client.post(self.url, self.items + [{'id': 'c', 'parent': 'x', 'text': 'orphan'}], format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url, [{'id': 'a', 'text': 'root', 'user': 999999}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.post.comments.exists())
+
+
+class TreeSortViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='sort_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Sort View Post', text='Sort.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.root.add_child(user=self.user, post=self.post, text='liked', rating=3)
+        self.root.add_child(user=self.user, post=self.post, text='newest')
+        self.client = APIClient()
+
+    def test_sorted_tree(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/', {'sort': 'new'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([child['text'] for child in response.json()[0]['children']], ['newest', 'liked'])
+        response = self.client.get(f'/usage/post/{self.post.pk}/comments/{self.root.pk}/get_comments_deeper_node/', {'sort': 'new'})
+        self.assertEqual(response.json()['children'][0]['text'], 'newest')
+
+    def test_votes_reorder_tree_after_rerank(self):
+        newest = Comment.objects.get(text='newest')
+        for _ in range(4):
+            self.client.post(f'/usage/post/{self.post.pk}/comments/{newest.pk}/add_point/')
+        ranking_queue.process()
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/')
+        self.assertEqual([child['text'] for child in response.json()[0]['children']], ['newest', 'liked'])
+
+    def test_sorted_etag_differs(self):
+        url = f'/usage/post/{self.post.pk}/get_comments_tree/'
+        self.assertNotEqual(self.client.get(url)['ETag'], self.client.get(url, {'sort': 'hot'})['ETag'])
+
+    def test_invalid_sort(self):
+        url = f'/usage/post/{self.post.pk}/get_comments_tree/'
+        self.assertEqual(self.client.get(url, {'sort': 'random'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'sort': 'hot', 'limit': 5}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'sort': 'hot', 'stream': 1}).status_code, 400)
+
+
+@override_settings(COMMENTS_TREE={'COLLAPSE_MIN_RATING': 0, 'COLLAPSE_DEPTH': 1})
+class TreeCollapseViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='collapse_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Collapse View Post', text='Collapse.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.root.add_child(user=self.user, post=self.post, text='reply')
+        Comment.add_root(user=self.user, post=self.post, text='buried', rating=-3)
+        self.client = APIClient()
+
+    def test_collapse_with_defaults(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/', {'collapse': 1})
+        tree = response.json()
+        self.assertEqual([item.get('text', item.get('collapsed')) for item in tree], ['root', 'rating'])
+        self.assertEqual(tree[0]['children'][0]['collapsed'], 'depth')
+
+    def test_explicit_thresholds(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_post_and_comments/', {'min_rating': -5, 'sort': 'new'})
+        comments = response.json()['comments']
+        self.assertEqual([comment['text'] for comment in comments], ['buried', 'root'])
+        self.assertEqual(comments[1]['children'][0]['text'], 'reply')
+
+    def test_invalid_collapse(self):
+        url = f'/usage/post/{self.post.pk}/get_comments_tree/'
+        self.assertEqual(self.client.get(url, {'max_depth': 0}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'collapse': 1, 'limit': 5}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'collapse': 0}).status_code, 200)
+
+
+@override_settings(COMMENTS_TREE={'SYNC_LAG': 0})
+class CommentChangesViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='sync_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Sync View Post', text='Sync.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.client = APIClient()
+
+    def test_changes_since_tree(self):
+        response = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/')
+        cursor = response['X-Comments-Cursor']
+        self.root.add_child(user=self.user, post=self.post, text='reply')
+        url = f'/usage/post/{self.post.pk}/get_comment_changes/'
+        changes = self.client.get(url, {'cursor': cursor}).json()
+        self.assertEqual([item['text'] for item in changes['changed']], ['root', 'reply'])
+        self.assertEqual(changes['changed'][0]['revision'], str(Comment.objects.get(pk=self.root.pk).revision))
+        self.assertNotIn('revision', response.json()[0])
+        self.assertFalse(changes['has_more'])
+        self.assertEqual(self.client.get(url, {'cursor': changes['cursor']}).json()['changed'], [])
+
+    def test_invalid_cursor(self):
+        url = f'/usage/post/{self.post.pk}/get_comment_changes/'
+        self.assertEqual(self.client.get(url, {'cursor': 'broken'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'limit': 0}).status_code, 400)
+
+
+class PostEventsViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='live_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Live View Post', text='Live.', author=self.user)
+
+    async def test_stream_starts_with_hello(self):
+        response = await AsyncClient().get(f'/usage/post/{self.post.pk}/events/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        hello = (await anext(events)).decode()
+        await events.aclose()
+        self.assertTrue(hello.startswith('event: hello\n'))
+        self.assertIn('"cursor"', hello)
+
+    async def test_unknown_post(self):
+        response = await AsyncClient().get(f'/usage/post/{self.post.pk + 1}/events/')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False, 'METRICS': True})
+class AsyncTreeViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='async_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Async View Post', text='Async.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root', rating=1)
+        self.child = self.root.add_child(user=self.user, post=self.post, text='child')
+        self.root.add_child(user=self.user, post=self.post, text='voted', rating=3).add_child(
+            user=self.user, post=self.post, text='leaf',
+        )
+        Comment.add_root(user=self.user, post=self.post, text='second')
+
+    async def assertSameResponse(self, path, params=None):
+        expected = await sync_to_async(APIClient().get)(f'/usage/{path}', params)
+        response = await AsyncClient().get(f'/usage/async/{path}', params)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(json.loads(response.content), json.loads(expected.content))
+        self.assertEqual(response['ETag'], expected['ETag'])
+        return response
+
+    async def test_matches_sync_endpoints(self):
+        post = self.post.pk
+        await self.assertSameResponse(f'post/{post}/get_comments_tree/')
+        await self.assertSameResponse(f'post/{post}/get_comments_tree/', {'sort': 'new'})
+        await self.assertSameResponse(f'post/{post}/get_comments_tree/', {'collapse': 1, 'max_depth': 1})
+        await self.assertSameResponse(f'post/{post}/get_comments_tree/', {'limit': 2, 'depth': 1})
+        await self.assertSameResponse(f'post/{post}/get_post_and_comments/', {'sort': 'top'})
+        await self.assertSameResponse(f'post/{post}/comments/{self.root.pk}/get_comments_deeper_node/')
+        await self.assertSameResponse(f'post/{post}/comments/{self.child.pk}/get_comments_deeper_node/')
+        await self.assertSameResponse(f'post/{post}/comments/{self.root.pk}/get_comments_deeper_node/', {'limit': 1})
+
+    async def test_streaming(self):
+        response = await AsyncClient().get(f'/usage/async/post/{self.post.pk}/get_comments_tree/', {'stream': 1})
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        expected = await sync_to_async(APIClient().get)(f'/usage/post/{self.post.pk}/get_comments_tree/')
+        self.assertEqual(json.loads(content), json.loads(expected.content))
+
+    async def test_not_modified_and_errors(self):
+        client = AsyncClient()
+        url = f'/usage/async/post/{self.post.pk}/get_comments_tree/'
+        response = await client.get(url)
+        self.assertEqual((await client.get(url, headers={'If-None-Match': response['ETag']})).status_code, 304)
+        self.assertEqual((await client.get(url, {'sort': 'unknown'})).status_code, 400)
+        self.assertEqual((await client.get(f'/usage/async/post/{self.post.pk + 1}/get_comments_tree/')).status_code, 404)
+
+    async def test_server_timing(self):
+        response = await AsyncClient().get(f'/usage/async/post/{self.post.pk}/get_comments_tree/')
+        self.assertIn('sql;dur=', response['Server-Timing'])
+        self.assertIn('desc="5 nodes, depth 3"', response['Server-Timing'])
+
+
+class CommentTombstoneViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='tombstone_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Tombstone View Post', text='Tombstones.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.reply = self.root.add_child(user=self.user, post=self.post, text='reply')
+        self.client = APIClient()
+        self.client.force_login(self.user)
+
+    def test_delete_leaves_placeholder(self):
+        url = f'/usage/post/{self.post.pk}/comments/{self.root.pk}/'
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertIsNone(self.client.get(url).json()['text'])
+        tree = self.client.get(f'/usage/post/{self.post.pk}/get_comments_tree/').json()
+        self.assertIsNone(tree[0]['text'])
+        self.assertEqual(tree[0]['children'][0]['text'], 'reply')
+
+        comments = f'/usage/post/{self.post.pk}/comments/'
+        self.assertEqual(self.client.post(comments, {'text': 'late', 'parent_node': self.root.pk}).status_code, 400)
+        self.assertEqual(self.client.post(f'{comments}{self.root.pk}/add_point/').status_code, 404)
+
+
+class PermalinkViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='permalink_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Permalink View Post', text='Permalink.', author=self.user)
+        root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.reply = root.add_child(user=self.user, post=self.post, text='reply')
+        self.reply.add_child(user=self.user, post=self.post, text='nested')
+        self.client = APIClient()
+
+    def test_permalink(self):
+        url = f'/usage/post/{self.post.pk}/comments/{self.reply.pk}/get_permalink/'
+        response = self.client.get(url, {'depth': 1})
+        self.assertEqual(response.status_code, 200)
+        tree = response.json()
+        self.assertEqual(tree['children'][0]['children'][0]['text'], 'nested')
+        self.assertEqual(self.client.get(url, {'depth': 1}, headers={'If-None-Match': response['ETag']}).status_code, 304)
+        self.assertEqual(self.client.get(url, {'depth': 0}).status_code, 400)
+        self.assertEqual(self.client.get(f'/usage/post/{self.post.pk + 1}/comments/{self.reply.pk}/get_permalink/').status_code, 404)
+
+
+class CommentSearchViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='search_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Search View Post', text='Search.', author=self.user)
+        root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.reply = root.add_child(user=self.user, post=self.post, text='searchable reply')
+        self.client = APIClient()
+
+    def test_search(self):
+        response = self.client.get('/usage/search/', {'q': 'searchable', 'post': self.post.pk})
+        self.assertEqual(response.status_code, 200)
+        hits = response.json()
+        self.assertEqual(hits[0]['comment']['id'], self.reply.pk)
+        self.assertEqual(hits[0]['ancestors'][0]['text'], 'root')
+        self.assertEqual(hits[0]['post']['id'], self.post.pk)
+        self.assertEqual(self.client.get('/usage/search/').status_code, 400)
+        self.assertEqual(self.client.get('/usage/search/', {'q': 'searchable', 'limit': 0}).status_code, 400)
+
+
+class FlatTreeViewTests(TestCase):
+    flat_json = 'application/vnd.comments-tree.flat+json'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='flat_views', password='1234GLKLl5')
+        self.post = Post.objects.create(title='Flat View Post', text='Flat.', author=self.user)
+        self.root = Comment.add_root(user=self.user, post=self.post, text='root')
+        self.reply = self.root.add_child(user=self.user, post=self.post, text='reply')
+        self.nested = self.reply.add_child(user=self.user, post=self.post, text='nested')
+        Comment.add_root(user=self.user, post=self.post, text='second', rating=3)
+        self.client = APIClient()
+
+    def rebuild(self, columns):
+        """Собирает вложенное дерево (текст, дети) из колонок плоского формата."""
+        nodes = [(text, []) for text in columns['text']]
+        top = []
+        for node, parent in zip(nodes, columns['parent']):
+            (top if parent == -1 else nodes[parent][1]).append(node)
+        return top
+
+    def shape(self, nodes):
+        return [(node['text'], self.shape(node['children'])) for node in nodes]
+
+    def test_flat_tree_matches_nested(self):
+        url = f'/usage/post/{self.post.pk}/get_comments_tree/'
+        nested = self.client.get(url)
+        response = self.client.get(url, headers={'Accept': self.flat_json})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], self.flat_json)
+        self.assertIn('Accept', response['Vary'])
+        self.assertNotEqual(response['ETag'], nested['ETag'])
+        columns = response.json()
+        self.assertEqual(list(columns), ['id', 'parent', 'user', 'rating', 'created_at', 'text'])
+        self.assertEqual(self.rebuild(columns), self.shape(nested.json()))
+        self.assertEqual(columns['user'], [self.user.pk] * 4)
+        self.assertIsInstance(columns['created_at'][0], int)
+        self.assertEqual(self.client.get(url, headers={'Accept': self.flat_json, 'If-None-Match': response['ETag']}).status_code, 304)
+        self.assertEqual(self.client.get(url, {'sort': 'new'}, headers={'Accept': self.flat_json}).status_code, 400)
+
+    def test_flat_subtree_and_tombstones(self):
+        Comment.objects.get(pk=self.reply.pk).tombstone()
+        url = f'/usage/post/{self.post.pk}/comments/{self.reply.pk}/get_comments_deeper_node/'
+        columns = self.client.get(url, headers={'Accept': self.flat_json}).json()
+        self.assertEqual(columns['id'], [self.reply.pk, self.nested.pk])
+        self.assertEqual(columns['parent'], [-1, 0])
+        self.assertEqual(columns['text'], [None, 'nested'])
+        self.assertEqual(columns['user'], [None, self.user.pk])
+
+    @override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+    def test_flat_tree_single_query(self):
+        with self.assertNumQueries(1):
+            columns = self.post.get_flat_comments_tree()
+        self.assertEqual(columns['parent'], [-1, -1, 1, 2])
+
+    def test_flat_tree_msgpack(self):
+        flat_msgpack = 'application/vnd.comments-tree.flat+msgpack'
+        for url in (
+            f'/usage/post/{self.post.pk}/get_comments_tree/',
+            f'/usage/post/{self.post.pk}/comments/{self.root.pk}/get_comments_deeper_node/',
+        ):
+            response = self.client.get(url, headers={'Accept': flat_msgpack})
+            self.assertEqual(response['Content-Type'], flat_msgpack)
+            columns = msgpack.unpackb(response.content)
+            self.assertEqual(columns, self.client.get(url, headers={'Accept': self.flat_json}).json())
+
+
+@override_settings(COMMENTS_TREE={'TREE_CACHE': False})
+class PostFeedViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='feed_views', password='1234GLKLl5')
+        self.posts = [Post.objects.create(title=f'Feed Post {number}', text='Feed.', author=self.user) for number in range(4)]
+        for post in self.posts[1:]:
+            for rating in (1, 5, 3, 4):
+                root = Comment.add_root(user=self.user, post=post, text=f'root {rating}', rating=rating)
+            root.add_child(user=self.user, post=post, text='reply')
+        self.deleted = Comment.objects.get(post=self.posts[1], rating=5)
+        self.deleted.tombstone()
+        self.client = APIClient()
+
+    def test_feed(self):
+        response = self.client.get('/usage/post/feed/', {'limit': 3, 'top': 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([item['id'] for item in page['results']], [post.pk for post in self.posts[::-1][:3]])
+        newest = page['results'][0]
+        self.assertEqual(newest['comment_count'], 5)
+        self.assertEqual([comment['text'] for comment in newest['top_comments']], ['root 5', 'root 4'])
+        self.assertNotIn('children', newest['top_comments'][0])
+        reply = Comment.objects.get(post=self.posts[-1], text='reply')
+        self.assertEqual(newest['last_activity'], reply.created_at.isoformat().replace('+00:00', 'Z'))
+
+        page = self.client.get(page['next']).json()
+        self.assertIsNone(page['next'])
+        self.assertEqual([item['id'] for item in page['results']], [self.posts[0].pk])
+        self.assertEqual(page['results'][0]['comment_count'], 0)
+        self.assertIsNone(page['results'][0]['last_activity'])
+        self.assertEqual(page['results'][0]['top_comments'], [])
+
+    def test_deleted_roots_not_in_top(self):
+        item = next(item for item in self.client.get('/usage/post/feed/').json()['results'] if item['id'] == self.posts[1].pk)
+        self.assertEqual(item['comment_count'], 5)
+        self.assertEqual([comment['text'] for comment in item['top_comments']], ['root 4', 'root 3', 'root 1'])
+        item = self.client.get('/usage/post/feed/', {'top': 0}).json()['results'][0]
+        self.assertEqual((item['comment_count'], item['top_comments']), (5, []))
+        self.assertEqual(self.client.get('/usage/post/feed/', {'top': 11}).status_code, 400)
+
+    def test_feed_queries_do_not_depend_on_page_size(self):
+        for limit in (1, 4):
+            with self.subTest(limit=limit), self.assertNumQueries(2):
+                self.assertEqual(len(self.client.get('/usage/post/feed/', {'limit': limit}).json()['results']), limit)
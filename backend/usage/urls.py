@@ -7,5 +7,14 @@ router.register('post', views.PostViewSet, basename='post')
 router.register(r'post/(?P<post_id>\d+)/comments', views.CommentViewSet, basename='comments')
 
 urlpatterns = [
+    path('search/', views.CommentSearchView.as_view(), name='comments-search'),
+    path('metrics/', views.TreeMetricsView.as_view(), name='metrics'),
+    path('post/<int:post_id>/events/', views.post_events, name='post-events'),
+    path('async/post/<int:pk>/get_post_and_comments/', views.AsyncPostAndCommentsView.as_view(),
+         name='async-post-get-post-and-comments'),
+    path('async/post/<int:pk>/get_comments_tree/', views.AsyncCommentsTreeView.as_view(),
+         name='async-post-get-comments-tree'),
+    path('async/post/<int:post_id>/comments/<int:pk>/get_comments_deeper_node/', views.AsyncCommentsDeeperNodeView.as_view(),
+         name='async-comments-get-comments-deeper-node'),
     path('', include(router.urls)),
 ]
@@ -1,32 +1,235 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from functools import partial
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
 from django.db.models.query import QuerySet
-from django.http import HttpRequest, HttpResponse
-from django.shortcuts import get_object_or_404
+from django.http import (Http404, HttpRequest, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
+from django.http.response import HttpResponseBase
+from django.shortcuts import aget_object_or_404, get_object_or_404
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.views import View
+from publications.aio import aiter_in_thread, run_in_pool
+from publications.conf import get_setting
+from publications.importing import InvalidImport
+from publications.live import iter_post_events
+from publications.metrics import metrics_registry
+from publications.pagination import InvalidCursor
+from publications.renderers import FLAT_TREE_RENDERERS, TreeJSONRenderer
+from publications.scoring import get_scorers
+from publications.sync import get_post_revision, get_sync_cursor
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import IsAdminUser
+from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.serializers import ModelSerializer
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
+from treebeard.exceptions import PathOverflow
 from usage.models import Comment, Post
-from usage.serializers import (BlankSerializer, CommentSerializer,
-                               PostSerializer)
+from usage.serializers import (BlankSerializer, CommentChangesSerializer,
+                               CommentImportSerializer,
+                               CommentSearchSerializer, CommentSerializer,
+                               PermalinkSerializer, PostFeedSerializer,
+                               PostSerializer, TreeCollapseSerializer,
+                               TreePageSerializer)
+
+User = get_user_model()
+
+# Рендереры эндпоинтов дерева: форматы по умолчанию и плоский формат, выбираемый заголовком `Accept`.
+TREE_RENDERER_CLASSES = (*api_settings.DEFAULT_RENDERER_CLASSES, *FLAT_TREE_RENDERERS)
+
+
+class ConditionalTreeMixin:
+
+    def get_conditional_response(self, post_id, etag_suffix, get_data, last_modified=None) -> HttpResponse:
+        """
+        Возвращает 304 Not Modified, если дерево не менялось с версии клиента, иначе ответ с данными.
+        Версия — последняя ревизия дерева поста в базе данных (`get_post_revision`), поэтому для ответа 304
+        комментарии не загружаются, а ETag совпадает во всех процессах.
+        Заголовок `X-Comments-Cursor` содержит курсор, с которого клиент запрашивает изменения дерева.
+        """
+        validators = self.get_tree_validators(post_id, etag_suffix, last_modified)
+        response = get_conditional_response(self.request, etag=validators[0], last_modified=validators[1])
+        if response is None:
+            response = get_data()
+            if not isinstance(response, HttpResponseBase):
+                response = Response(response, status=status.HTTP_200_OK)
+        return self.set_tree_headers(response, *validators)
+
+    def get_tree_validators(self, post_id, etag_suffix, last_modified=None) -> tuple:
+        """Возвращает ETag, время последнего изменения (timestamp) и курсор синхронизации дерева поста."""
+        sync_cursor = get_sync_cursor()
+        revision = get_post_revision(Comment, post_id)
+        etag = quote_etag(f'{revision}-{etag_suffix}')
+        # Ревизия — время изменения в наносекундах.
+        modified = datetime.fromtimestamp(revision / 1e9, timezone.utc) if revision else None
+        last_modified = max(filter(None, (modified, last_modified)), default=None)
+        return etag, last_modified and int(last_modified.timestamp()), sync_cursor
+
+    def set_tree_headers(self, response, etag, last_modified, sync_cursor) -> HttpResponseBase:
+        response.headers['ETag'] = etag
+        if last_modified is not None:
+            response.headers['Last-Modified'] = http_date(last_modified)
+        response.headers['X-Comments-Cursor'] = sync_cursor
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    def is_flat(self) -> bool:
+        """Проверяет, выбран ли по заголовку `Accept` плоский формат дерева (`publications.flat`)."""
+        return getattr(getattr(self.request, 'accepted_renderer', None), 'flat_tree', False)
+
+    def check_flat(self, params, options) -> None:
+        if params is not None or options or self.is_streaming():
+            raise ValidationError({'format': 'Плоский формат отдает дерево целиком, без страниц, сортировки и потоковой выдачи.'})
+
+    def is_streaming(self) -> bool:
+        return self.request.query_params.get('stream') in ('1', 'true')
+
+    def get_streaming_response(self, stream) -> StreamingHttpResponse:
+        """Отдает JSON частями по мере чтения строк из базы данных."""
+        return StreamingHttpResponse(stream(), content_type='application/json')
+
+    def get_page_params(self) -> dict | None:
+        """Возвращает параметры страницы дерева или None, если клиент запросил дерево целиком."""
+        if not set(self.request.query_params) & set(TreePageSerializer().fields):
+            return None
+        serializer = TreePageSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        return {
+            'cursor': params.get('cursor'),
+            'limit': params['limit'],
+            'max_depth': params.get('depth'),
+            'max_children': params.get('children'),
+        }
+
+    def get_sort(self, params) -> str | None:
+        """
+        Возвращает имя сортировки из параметра `sort` или None для порядка по рейтингу в путях.
+        Сортировка применяется к дереву целиком, поэтому не сочетается со страницами и потоковой выдачей.
+        """
+        sort = self.request.query_params.get('sort')
+        if sort is None:
+            return None
+        if sort not in get_scorers():
+            raise ValidationError({'sort': f'Неизвестная сортировка. Доступны: {", ".join(get_scorers())}.'})
+        if params is not None or self.is_streaming():
+            raise ValidationError({'sort': 'Сортировка недоступна для страниц и потоковой выдачи.'})
+        return sort
+
+    def get_collapse(self, params) -> dict | None:
+        """
+        Возвращает пороги сворачивания веток или None, если клиент не запросил сворачивание.
+        `collapse=1` включает пороги `COMMENTS_TREE['COLLAPSE_MIN_RATING']` и `COMMENTS_TREE['COLLAPSE_DEPTH']`,
+        а `min_rating` и `max_depth` задают их явно.
+        """
+        if not set(self.request.query_params) & set(TreeCollapseSerializer().fields):
+            return None
+        serializer = TreeCollapseSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        if not data['collapse'] and set(data) == {'collapse'}:
+            return None
+        if params is not None or self.is_streaming():
+            raise ValidationError({'collapse': 'Сворачивание недоступно для страниц и потоковой выдачи.'})
+        if data['collapse']:
+            data = {'min_rating': get_setting('COLLAPSE_MIN_RATING'), 'max_depth': get_setting('COLLAPSE_DEPTH'), **data}
+        return {'min_rating': data.get('min_rating'), 'max_depth': data.get('max_depth')}
+
+    def get_tree_options(self, params) -> dict:
+        """Возвращает параметры отображения дерева: сортировку и пороги сворачивания."""
+        options = {'sort': self.get_sort(params), **(self.get_collapse(params) or {})}
+        return {name: value for name, value in options.items() if value is not None}
+
+    def get_page(self, loader, params) -> dict:
+        try:
+            return loader(**params)
+        except InvalidCursor:
+            raise ValidationError({'cursor': 'Некорректный курсор.'})
 
 
-class PostViewSet(ModelViewSet):
+class PostFeedPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class PostViewSet(ConditionalTreeMixin, ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
 
+    @action(detail=False, methods=('get',), pagination_class=PostFeedPagination)
+    def feed(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """
+        Возвращает страницу ленты постов, начиная с новых. Каждый пост дополнен числом комментариев,
+        временем последней активности и `top` лучшими комментариями первого уровня
+        (по умолчанию `COMMENTS_TREE['FEED_TOP_COMMENTS']`). Число запросов не зависит от размера страницы.
+        """
+        serializer = PostFeedSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        posts = self.paginate_queryset(self.get_queryset())
+        summaries = Post.get_comment_summaries([post.pk for post in posts], serializer.validated_data.get('top'))
+        data = self.get_serializer(posts, many=True).data
+        return self.get_paginated_response([{**item, **summaries[post.pk]} for post, item in zip(posts, data)])
+
     @action(detail=True, methods=('get',))
     def get_post_and_comments(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
         instance = self.get_object()
-        return Response(instance.get_post_with_comments(), status=status.HTTP_200_OK)
+        options = self.get_tree_options(None)
+        get_data = partial(instance.get_post_with_comments, **options)
+        if self.is_streaming():
+            get_data = partial(self.get_streaming_response, instance.stream_post_with_comments)
+        return self.get_conditional_response(
+            instance.pk, f'post-{instance.updated_at.timestamp()}-{urlencode(options)}', get_data, instance.updated_at
+        )
 
-    @action(detail=True, methods=('get',))
+    @action(detail=True, methods=('get',), renderer_classes=TREE_RENDERER_CLASSES)
     def get_comments_tree(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
         instance = self.get_object()
-        return Response(instance.get_comments_tree(), status=status.HTTP_200_OK)
+        params = self.get_page_params()
+        options = self.get_tree_options(params)
+        if self.is_flat():
+            self.check_flat(params, options)
+            return self.get_conditional_response(instance.pk, 'flat', instance.get_flat_comments_tree)
+        if options:
+            return self.get_conditional_response(
+                instance.pk, f'tree-{urlencode(options)}', partial(instance.get_comments_tree, **options)
+            )
+        if params is None and self.is_streaming():
+            return self.get_conditional_response(
+                instance.pk, 'tree', partial(self.get_streaming_response, instance.stream_comments_tree)
+            )
+        if params is None:
+            return self.get_conditional_response(instance.pk, 'tree', instance.get_comments_tree)
+        return self.get_conditional_response(
+            instance.pk, f'tree-{request.query_params.urlencode()}',
+            lambda: self.get_page(instance.get_comments_tree_page, params),
+        )
+
+    @action(detail=True, methods=('get',))
+    def get_comment_changes(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """
+        Возвращает комментарии, созданные, измененные или удаленные после курсора синхронизации.
+        Без курсора возвращает все комментарии поста с путями для построения дерева на клиенте.
+        """
+        instance = self.get_object()
+        serializer = CommentChangesSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        return Response(self.get_page(instance.get_comment_changes, {'cursor': params.get('cursor'), 'limit': params['limit']}))
 
 
-class CommentViewSet(ModelViewSet):
+class CommentViewSet(ConditionalTreeMixin, ModelViewSet):
     serializer_class = CommentSerializer
 
     def get_queryset(self) -> QuerySet:
@@ -38,6 +241,8 @@ class CommentViewSet(ModelViewSet):
     def get_serializer_class(self):
         if (self.action == 'add_point' or self.action == 'cut_point') and self.request.method == 'POST':
             return BlankSerializer
+        if self.action == 'bulk_import':
+            return CommentImportSerializer
         return CommentSerializer
 
     def perform_create(self, serializer: ModelSerializer) -> None:
@@ -54,21 +259,217 @@ class CommentViewSet(ModelViewSet):
             Comment.add_root(instance=comment)
         else:
             parent_node = get_object_or_404(post.comments, id=parent_node)
+            if parent_node.is_tombstone:
+                raise ValidationError({'parent_node': 'Нельзя ответить на удаленный комментарий.'})
             parent_node.add_child(instance=comment)
 
+    def perform_destroy(self, instance: Comment) -> None:
+        """Удаляет комментарий, оставляя в дереве заглушку; ответы на него сохраняются."""
+        instance.tombstone()
+
+    @action(detail=False, methods=('post',), permission_classes=(IsAdminUser,))
+    def bulk_import(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """
+        Импортирует в пост плоский список комментариев со ссылками на родителей внутри пакета.
+        Если автор не указан, комментарий создается от имени текущего пользователя.
+        """
+        post = get_object_or_404(Post, id=kwargs.get('post_id'))
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = [{'user': request.user.pk, **item} for item in serializer.validated_data]
+        users = {item['user'] for item in items}
+        missing = users - set(User.objects.filter(pk__in=users).values_list('pk', flat=True))
+        if missing:
+            raise ValidationError({'user': f'Пользователи не найдены: {sorted(missing)}'})
+        try:
+            created = Comment.bulk_import(post, items)
+        except (InvalidImport, PathOverflow) as error:
+            raise ValidationError({'non_field_errors': [str(error)]})
+        return Response({ref: comment.pk for ref, comment in created.items()}, status=status.HTTP_201_CREATED)
+
     @action(detail=True, methods=('post',))
     def add_point(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
-        comment = get_object_or_404(Comment, id=kwargs.get('pk'))
+        comment = get_object_or_404(Comment.objects.for_post(kwargs.get('post_id')), id=kwargs.get('pk'), deleted_at__isnull=True)
         comment.add_point()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=('post',))
     def cut_point(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
-        comment = get_object_or_404(Comment, id=kwargs.get('pk'))
+        comment = get_object_or_404(Comment.objects.for_post(kwargs.get('post_id')), id=kwargs.get('pk'), deleted_at__isnull=True)
         comment.cut_point()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=('get',))
+    def get_permalink(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """
+        Возвращает комментарий вместе с цепочкой предков и ветку ответов не глубже `depth` уровней
+        (по умолчанию `COMMENTS_TREE['PERMALINK_DEPTH']`) одной вложенной структурой.
+        """
+        post_id = int(kwargs.get('post_id'))
+        serializer = PermalinkSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        depth = serializer.validated_data.get('depth', get_setting('PERMALINK_DEPTH'))
+
+        def get_data():
+            comment = get_object_or_404(Comment.objects.for_post(post_id), pk=kwargs.get('pk'))
+            return comment.get_permalink_tree(depth)
+
+        return self.get_conditional_response(post_id, f'permalink-{kwargs.get("pk")}-{depth}', get_data)
+
+    @action(detail=True, methods=('get',), renderer_classes=TREE_RENDERER_CLASSES)
     def get_comments_deeper_node(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
-        comment = get_object_or_404(Comment, pk=kwargs.get('pk'))
-        return Response(comment.get_comments_deeper_from_node(), status=status.HTTP_200_OK)
+        post_id = int(kwargs.get('post_id'))
+        params = self.get_page_params()
+        sort = self.get_sort(params)
+        if self.is_flat():
+            self.check_flat(params, sort)
+
+            def get_flat_data():
+                return get_object_or_404(Comment.objects.for_post(post_id), pk=kwargs.get('pk')).get_flat_subtree()
+
+            return self.get_conditional_response(post_id, f'node-flat-{kwargs.get("pk")}', get_flat_data)
+
+        def get_data():
+            comment = get_object_or_404(Comment.objects.for_post(post_id), pk=kwargs.get('pk'))
+            if params is None:
+                return comment.get_comments_deeper_from_node(sort)
+            return self.get_page(comment.get_children_page, params)
+
+        return self.get_conditional_response(
+            post_id, f'node-{kwargs.get("pk")}-{request.query_params.urlencode()}', get_data
+        )
+
+
+class CommentSearchView(APIView):
+
+    def get(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """
+        Ищет комментарии по словам запроса `q` во всех постах или в посте `post`.
+        Каждый результат содержит фрагмент текста с выделенными совпадениями, комментарий, его предков и пост.
+        """
+        serializer = CommentSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        return Response(Comment.search(params['q'], params.get('post'), params.get('limit')))
+
+
+class TreeMetricsView(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        """Возвращает гистограммы метрик запросов, накопленные в этом процессе."""
+        if not get_setting('METRICS'):
+            raise NotFound('Сбор метрик выключен.')
+        return Response(metrics_registry.snapshot())
+
+
+async def post_events(request: HttpRequest, post_id: int) -> HttpResponse:
+    """
+    Поток Server-Sent Events с новыми комментариями и изменениями рейтинга поста.
+    Первое событие `hello` содержит курсор синхронизации: после переподключения или события `reset`
+    клиент запрашивает пропущенные изменения через `get_comment_changes`. Требует запуска под ASGI.
+    """
+    if not await Post.objects.filter(pk=post_id).aexists():
+        raise Http404('Пост не найден.')
+    response = StreamingHttpResponse(
+        iter_post_events(Comment, post_id, {'cursor': get_sync_cursor()}), content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class AsyncTreeView(ConditionalTreeMixin, View, ABC):
+    """
+    Базовый класс асинхронных эндпоинтов чтения дерева для запуска под ASGI. Параметры, ETag и заголовки
+    совпадают с действиями `PostViewSet` и `CommentViewSet`, но запрос не занимает поток, пока строится дерево:
+    комментарии загружаются асинхронным ORM, а сериализация и рендеринг JSON выполняются в ограниченном пуле
+    потоков `publications.aio`. Страницы дерева строятся синхронной версией в потоке запроса.
+    """
+    renderer_class = TreeJSONRenderer
+
+    def setup(self, request: HttpRequest, *args, **kwargs) -> None:
+        super().setup(Request(request), *args, **kwargs)
+
+    async def get(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        try:
+            return await self.get_tree_response(**kwargs)
+        except APIException as error:
+            detail = error.detail if isinstance(error.detail, (dict, list)) else {'detail': error.detail}
+            return JsonResponse(detail, status=error.status_code, safe=False)
+
+    @abstractmethod
+    async def get_tree_response(self, **kwargs) -> HttpResponse:
+        """
+        Строит ответ с деревом по параметрам URL.
+        Ошибки DRF (`APIException`) метод `get` превращает в JSON-ответы с соответствующим статусом.
+        """
+
+    async def aget_conditional_response(self, post_id, etag_suffix, get_data, last_modified=None) -> HttpResponse:
+        """Асинхронная версия `get_conditional_response`: `get_data` — корутинная функция."""
+        validators = await sync_to_async(self.get_tree_validators)(post_id, etag_suffix, last_modified)
+        response = get_conditional_response(self.request, etag=validators[0], last_modified=validators[1])
+        if response is None:
+            response = await get_data()
+            if not isinstance(response, HttpResponseBase):
+                content = await run_in_pool(self.renderer_class().render, response)
+                response = HttpResponse(content, content_type='application/json')
+        return self.set_tree_headers(response, *validators)
+
+    async def aget_streaming_response(self, stream) -> StreamingHttpResponse:
+        return StreamingHttpResponse(aiter_in_thread(stream()), content_type='application/json')
+
+    async def aget_page(self, loader, params) -> dict:
+        return await sync_to_async(self.get_page)(loader, params)
+
+
+class AsyncPostAndCommentsView(AsyncTreeView):
+
+    async def get_tree_response(self, pk: int) -> HttpResponse:
+        instance = await aget_object_or_404(Post, pk=pk)
+        options = self.get_tree_options(None)
+        get_data = partial(instance.aget_post_with_comments, **options)
+        if self.is_streaming():
+            get_data = partial(self.aget_streaming_response, instance.stream_post_with_comments)
+        return await self.aget_conditional_response(
+            instance.pk, f'post-{instance.updated_at.timestamp()}-{urlencode(options)}', get_data, instance.updated_at
+        )
+
+
+class AsyncCommentsTreeView(AsyncTreeView):
+
+    async def get_tree_response(self, pk: int) -> HttpResponse:
+        instance = await aget_object_or_404(Post, pk=pk)
+        params = self.get_page_params()
+        options = self.get_tree_options(params)
+        if options:
+            return await self.aget_conditional_response(
+                instance.pk, f'tree-{urlencode(options)}', partial(instance.aget_comments_tree, **options)
+            )
+        if params is None and self.is_streaming():
+            return await self.aget_conditional_response(
+                instance.pk, 'tree', partial(self.aget_streaming_response, instance.stream_comments_tree)
+            )
+        if params is None:
+            return await self.aget_conditional_response(instance.pk, 'tree', instance.aget_comments_tree)
+        return await self.aget_conditional_response(
+            instance.pk, f'tree-{self.request.query_params.urlencode()}',
+            partial(self.aget_page, instance.get_comments_tree_page, params),
+        )
+
+
+class AsyncCommentsDeeperNodeView(AsyncTreeView):
+
+    async def get_tree_response(self, post_id: int, pk: int) -> HttpResponse:
+        params = self.get_page_params()
+        sort = self.get_sort(params)
+
+        async def get_data():
+            comment = await aget_object_or_404(await Comment.objects.afor_post(post_id), pk=pk)
+            if params is None:
+                return await comment.aget_comments_deeper_from_node(sort)
+            return await self.aget_page(comment.get_children_page, params)
+
+        return await self.aget_conditional_response(
+            post_id, f'node-{pk}-{self.request.query_params.urlencode()}', get_data
+        )